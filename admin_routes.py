@@ -9,19 +9,23 @@ Features:
     - /create_admin: Create a new admin user.
     - /promote_user: Promote an existing user to admin status.
     - /demote_user: Demote an admin user to regular status.
-    - /list_fishy_users: View users flagged for suspicious admin access attempts.
+    - /list_fishy_users: View users flagged for suspicious admin access attempts (shared across workers).
+
+- Monitoring:
+    - /admin/metrics: Per-endpoint request metrics of all workers in Prometheus text format.
+    - /admin/slow_queries: The most recent slow SQL statements and the routes that ran them.
 
 - Admin Help:
     - /admin/help: View a list of available admin commands and their descriptions.
 
 - Data Generation and Testing:
-    - /add_dummy_entry: Generate dummy test entries for testing the form pipeline.
+    - /add_dummy_entry: Generate dummy test entries for testing the form pipeline (large counts run as a job).
     - /add_dummy_saves: Generate dummy in-progress form saves (session-based).
     - /check_dummy_count: Count the number of dummy (test=True) entries in the database.
 
 - Data Clearing and Cleanup:
-    - /clear_history: Delete all test history and uploaded files.
-    - /clear_dummy_history: Delete only dummy (test=True) entries and associated files.
+    - /clear_history: Delete all test history and its uploaded files (background job).
+    - /clear_dummy_history: Delete only dummy (test=True) entries and the files uploaded for them (background job).
     - /clear_saves: Clear all saved form progress for the current user.
     - /clear_dummy_saves: Clear only dummy saves for the current user.
 
@@ -30,6 +34,15 @@ Features:
     - /admin/clear_lock/<entry_id>: Remove a lock from a TestEntry.
     - /admin/delete_form/<entry_id>: Delete a TestEntry and archive it in DeletedEntry.
     - /admin/deleted_entries: View all deleted/archived entries for audit or recovery.
+    - /admin/entry_history/<entry_id>: Timeline of who changed which fields of an entry, and the
+      entry rebuilt as of any point in it (`?seq=`), see entry_history.py.
+    - /admin/bulk/<action>: Delete, unlock, clear-failed or restore many entries in one transaction,
+      selected by id or by filter (see bulk_entries.py); reports the outcome per id.
+
+- Background Jobs (see jobs.py):
+    - /admin/jobs: Recent jobs with their progress, and forms to start exports and rebuilds (`?format=json` to poll).
+    - /admin/jobs/<job_id>: Status of one job; /cancel stops it, /download fetches a finished CSV export.
+    - /admin/backups: Database snapshots taken by the scheduled backup job (see backup.py), as JSON.
 
 Security:
 All routes require:
@@ -41,20 +54,27 @@ Dummy data and cleanup routes are intended for development/debugging and may be
 or removed in production environments.
 """
 
-import os
 from datetime import datetime
-from random import randint, uniform, choice
-from flask import render_template, request, redirect, url_for, session, current_app, Blueprint
-
-from models import db, TestEntry, DeletedEntry, User
-from form_config import FORMS_NON_DICT
-from utils import (current_user, authenticate_admin)
-from constants import SERIAL_MIN, SERIAL_MAX
+from flask import (render_template, request, redirect, url_for, session, Blueprint, Response, jsonify,
+                   send_file, abort)
+
+from models import db, TestEntry, DeletedEntry, User, Job
+from utils import (current_user, authenticate_admin, commit_entry_changes, dummy_test_data)
+from db_engine import read_only_route, read_snapshot_route
+from security_events import event_counts, ADMIN_DENIED
+from metrics import prometheus_text, recent_slow_queries
+from queries import unfinished_entries
+from bulk_entries import run_bulk, selection_from_filter, ACTIONS, STATUSES
+from entry_history import timeline, version_at, delete_history
+from backup import list_snapshots, backup_folder
+from jobs import (enqueue, cancel as cancel_job, kick as kick_jobs, recent_jobs, job_dict, has_export, export_path,
+                  JOB_KINDS, ACTIVE as ACTIVE_JOBS)
+
+# /add_dummy_entry runs larger counts as a background job
+DUMMY_INLINE_MAX = 100
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
-fishy_users = {}
-
 ## Admin commands for managing admin's debugging and generating test data
 
 @admin_bp.route('/create_admin', methods=['GET', 'POST'])
@@ -164,7 +184,8 @@ def demote_user():
 @admin_bp.route('/list_fishy_users')
 def list_fishy_users():
     """lists current list of "fishy users" for the current session user becomes fishy by
-    attempting to pass a authenticate_admin() check"""
+    attempting to pass a authenticate_admin() check. Counts cover the retention window
+    of security_events and are shared by all workers."""
 
     if not authenticate_admin():
         return "Permission Denied"
@@ -172,11 +193,37 @@ def list_fishy_users():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
+    fishy_users = event_counts(ADMIN_DENIED)
     if not fishy_users:
         return "No such users"
 
     return fishy_users
 
+@admin_bp.route('/metrics')
+def metrics():
+    """Request metrics of all workers (latency, SQL, templates, uploads per endpoint) for Prometheus."""
+
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    if not authenticate_admin():
+        return "Permission Denied"
+
+    return Response(prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+@admin_bp.route('/slow_queries')
+def slow_queries():
+    """Most recent SQL statements slower than metrics.SLOW_QUERY_SECONDS, newest first."""
+
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    if not authenticate_admin():
+        return "Permission Denied"
+
+    limit = request.args.get('limit', default=100, type=int)
+    return recent_slow_queries(limit)
+
 @admin_bp.route('/help')
 def list_admin_commands():
     """
@@ -199,14 +246,20 @@ def list_admin_commands():
         '/admin/forms/': 'View and edit form fields, pages, and help page entries.',
         '/admin/forms/help': 'View help documentation for form editing.',
         '/admin/list_fishy_users': 'View users flagged for suspicious admin access attempts.',
-        '/admin/add_dummy_entry?count=#': 'Add dummy test entries to the database.',
+        '/admin/metrics': 'Per-endpoint request metrics (Prometheus text format).',
+        '/admin/slow_queries?limit=#': 'Most recent slow SQL statements and their routes.',
+        '/admin/add_dummy_entry?count=#': 'Add dummy test entries to the database (use `flask generate-entries` for bulk loads).',
         #'/admin/clear_history': 'Delete all test history and uploaded files.',
         '/admin/clear_dummy_history': 'Delete only test=True (dummy) history entries and files.',
         '/admin/check_dummy_count': 'Show the number of dummy entries in the database.',
         '/admin/admin_dashboard': 'Admin dashboard for viewing in-progress forms.',
         #'/admin/clear_lock/<entry_id>': 'Clear the lock on a form so it can be edited.',
         #'/admin/delete_form/<entry_id>': 'Delete a form and archive it in DeletedEntry.',
+        '/admin/bulk/<action>': 'POST: delete, unlock, clear_failed or restore many entries (by ids or filter).',
+        '/admin/jobs': 'Background jobs: CSV exports, dummy data, index rebuilds, backups; progress, cancel and downloads.',
+        '/admin/backups': 'Database snapshots (newest first) with sizes and changed uploads.',
         '/admin/deleted_entries': 'View forms that have been deleted from the dashboard.',
+        '/admin/entry_history/<entry_id>?seq=#': 'Change timeline of an entry; with seq, the entry as of that change.',
     }
 
     return render_template('admin/admin_commands.html', commands=commands)
@@ -234,31 +287,14 @@ def add_dummy_entry():
 
     user = current_user()
 
-    for _ in range(count):
-        test_data = {}
-
-        for form_iter in FORMS_NON_DICT:
-            for field in form_iter.fields:
-                name = getattr(field, "name", None)
-                ftype = getattr(field, "type_field", None)
-
-                if not name or ftype is None:
-                    continue
-
-                if ftype == "boolean":
-                    test_data[name] = choice(["yes", "no"])
-                elif ftype == "integer":
-                    test_data[name] = str(randint(SERIAL_MIN, SERIAL_MAX)) if name == "CM_serial" else str(randint(0, 9999))
-                elif ftype == "float":
-                    test_data[name] = f"{uniform(0.0, 10.0):.2f}"
-                elif ftype == "text":
-                    test_data[name] = "Auto-generated entry"
-                elif ftype == "file":
-                    test_data[name] = ""  # Leave blank for file fields
+    if count > DUMMY_INLINE_MAX:
+        job = enqueue("add_dummy_entries", {"count": count, "username": user.username}, user.username)
+        return redirect(url_for('admin.job_status', job_id=job.id))
 
+    for _ in range(count):
         entry = TestEntry(
             contributors=[user.username],
-            data=test_data,
+            data=dummy_test_data(),
             timestamp=datetime.utcnow(),
             test=True
         )
@@ -269,52 +305,33 @@ def add_dummy_entry():
 
 @admin_bp.route('/clear_history')
 def clear_history():
-    '''clears all entries from history to be TODO removed later (same as clear_dummy_history now)'''
+    '''clears all entries from history to be TODO removed later (same as clear_dummy_history now)
+    runs as a background job (jobs.py), redirects to its status page'''
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
     if not authenticate_admin():
         return "Permission Denied"
-    with current_app.app_context():
-        #db.session.query(TestEntry).delete() # uncomment this line to delete all history entries keep disabled for actual web app run
-        db.session.query(TestEntry).filter_by(test=True).delete() # is now the same method as 'clear_dummy_history' - editing history is not allowed on full release
-        db.session.commit()
-
-        upload_dir = current_app.config['UPLOAD_FOLDER']
-        for filename in os.listdir(upload_dir):
-            file_path = os.path.join(upload_dir, filename)
-            try:
-                os.remove(file_path)
-            except Exception:
-                pass  # Silently ignore errors
 
-    return redirect(request.referrer or url_for('history'))
+    # only test=True entries, like 'clear_dummy_history' - editing history is not allowed on full release
+    username = current_user().get_username()
+    job = enqueue("clear_history", username=username)
+    return redirect(url_for('admin.job_status', job_id=job.id))
 
 @admin_bp.route('/clear_dummy_history')
 def clear_dummy_history():
-    """clears only entries with test=True from history"""
+    """clears only entries with test=True from history, as a background job (jobs.py)"""
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
     if not authenticate_admin():
         return "Permission Denied"
 
-    with current_app.app_context():
-        db.session.query(TestEntry).filter_by(test=True).delete()
-        db.session.commit()
-
-
-        upload_dir = current_app.config['UPLOAD_FOLDER']
-        for filename in os.listdir(upload_dir):
-            file_path = os.path.join(upload_dir, filename)
-            try:
-                os.remove(file_path)
-            except Exception:
-                pass  # Silently ignore errors
-
-    return redirect(request.referrer or url_for('history'))
+    job = enqueue("clear_history", username=current_user().get_username())
+    return redirect(url_for('admin.job_status', job_id=job.id))
 
 @admin_bp.route('/check_dummy_count')
+@read_only_route
 def check_dummy_count():
     """returns number of dummy entires in history"""
     if 'user_id' not in session:
@@ -328,6 +345,7 @@ def check_dummy_count():
 
 # for admin dashboard:
 @admin_bp.route('/admin_dashboard')
+@read_only_route
 def admin_dashboard():
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -335,14 +353,9 @@ def admin_dashboard():
     if not authenticate_admin():
         return "Permission Denied"
 
-    forms = (
-        TestEntry.query
-        .filter(TestEntry.is_finished.is_(False))
-        .order_by(TestEntry.timestamp.desc())
-        .all()
-    )
+    forms = unfinished_entries().all()
 
-    return render_template("admin/admin_dashboard.html", forms=forms)
+    return render_template("admin/admin_dashboard.html", forms=forms, statuses=STATUSES)
 
 @admin_bp.route('/clear_lock/<int:entry_id>', methods=['POST'])
 def clear_lock(entry_id):
@@ -355,7 +368,8 @@ def clear_lock(entry_id):
     entry = TestEntry.query.get(entry_id)
     if entry and entry.lock_owner:
         entry.lock_owner = None
-        db.session.commit()
+        entry.lock_acquired_at = None
+        commit_entry_changes()  # a concurrent write wins; the admin just sees the fresh row
 
     return redirect(url_for('admin.admin_dashboard'))
 
@@ -380,16 +394,162 @@ def delete_form(entry_id):
             fail_reason=entry.fail_reason,
             failure=entry.failure,
             was_locked=entry.lock_owner,
+            test=entry.test,
         )
         db.session.add(deleted)
+        delete_history([entry.id])
         db.session.delete(entry)
-        db.session.commit()
+        commit_entry_changes()  # DELETE is version-checked too; never archive a stale copy
 
     return redirect(url_for('admin.admin_dashboard'))
 
+@admin_bp.route('/bulk/<action>', methods=['POST'])
+def bulk_entries(action):
+    """Apply one bulk action to the selected entry ids (form field `entry_ids`, JSON `ids`)
+    or, without ids, to every entry matching the filter fields / JSON `filter`."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    if not authenticate_admin():
+        return "Permission Denied"
+
+    if action not in ACTIONS:
+        return f"Unknown bulk action {action}.", 404
+
+    payload = request.get_json(silent=True) or {}
+    ids = payload.get("ids") or request.form.getlist('entry_ids')
+    try:
+        if not ids:
+            ids = selection_from_filter(action, payload.get("filter") or request.form.to_dict())
+        outcomes = run_bulk(action, ids, current_user().get_username())
+    except ValueError as err:
+        if request.is_json:
+            return jsonify(error=str(err)), 400
+        return f"Invalid bulk request: {err}", 400
+
+    if request.is_json:
+        return jsonify(action=action, outcomes=outcomes)
+    return render_template('admin/bulk_results.html', action=action, outcomes=outcomes)
+
+@admin_bp.route('/entry_history/<int:entry_id>')
+@read_snapshot_route
+def entry_history(entry_id):
+    """Who changed what in an entry, newest first; `seq` selects a version to rebuild and show."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    if not authenticate_admin():
+        return "Permission Denied"
+
+    rows = timeline(entry_id)
+    seq = request.args.get('seq', type=int)
+    version = version_at(entry_id, seq) if seq is not None else None
+    return render_template('admin/entry_history.html', entry_id=entry_id, rows=rows[::-1],
+                           seq=seq, version=version)
+
+@admin_bp.route('/backups')
+def backups():
+    """Manifests of the database snapshots, newest first; `flask backup restore` restores one."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    if not authenticate_admin():
+        return "Permission Denied"
+
+    return list_snapshots(backup_folder())
+
+# background jobs (jobs.py):
+
+@admin_bp.route('/jobs')
+@read_only_route
+def jobs():
+    """Recent background jobs and forms to start new ones; `format=json` for polling."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    if not authenticate_admin():
+        return "Permission Denied"
+
+    kick_jobs()     # picks up jobs left queued or abandoned by another worker
+    listed = [job_dict(job) for job in recent_jobs()]
+    if request.args.get('format') == 'json':
+        return listed
+    return render_template('admin/jobs.html', jobs=listed, kinds=JOB_KINDS,
+                           active=any(job["status"] in ACTIVE_JOBS for job in listed))
+
+@admin_bp.route('/jobs/<int:job_id>')
+@read_only_route
+def job_status(job_id):
+    """Status and progress of one job; `format=json` for polling."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    if not authenticate_admin():
+        return "Permission Denied"
+
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return abort(404)
+    kick_jobs()
+    status = job_dict(job)
+    if request.args.get('format') == 'json':
+        return status
+    return render_template('admin/jobs.html', jobs=[status], kinds=JOB_KINDS, job=status,
+                           active=status["status"] in ACTIVE_JOBS)
+
+@admin_bp.route('/jobs/enqueue/<kind>', methods=['POST'])
+def enqueue_job(kind):
+    """Queue a job of `kind`; export_csv takes `unique` / `all_time`, add_dummy_entries `count`."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    if not authenticate_admin():
+        return "Permission Denied"
+
+    if kind not in JOB_KINDS:
+        return f"Unknown job kind {kind}.", 404
+
+    username = current_user().get_username()
+    params = {}
+    if kind == "export_csv":
+        params = {"unique": request.form.get('unique') == "true", "all_time": request.form.get('all_time') == "true"}
+    elif kind == "add_dummy_entries":
+        params = {"count": max(1, request.form.get('count', 1, type=int)), "username": username}
+    job = enqueue(kind, params, username)
+    return redirect(url_for('admin.job_status', job_id=job.id))
+
+@admin_bp.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job_route(job_id):
+    """Cancel a queued job or stop a running one at its next progress report."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    if not authenticate_admin():
+        return "Permission Denied"
+
+    cancel_job(job_id)
+    return redirect(url_for('admin.job_status', job_id=job_id))
+
+@admin_bp.route('/jobs/<int:job_id>/download')
+@read_only_route
+def download_job(job_id):
+    """The CSV written by a finished export job, while it is kept (jobs.EXPORT_KEEP)."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    if not authenticate_admin():
+        return "Permission Denied"
+
+    job = db.session.get(Job, job_id)
+    if job is None or not has_export(job):
+        return abort(404)
+    return send_file(export_path(job.id), mimetype='text/csv', as_attachment=True,
+                     download_name=(job.result or {}).get("download_name", "test_results.csv"))
+
 # for admin view of deleted entries:
 
 @admin_bp.route('/deleted_entries')
+@read_snapshot_route
 def deleted_entries():
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -401,6 +561,7 @@ def deleted_entries():
     return render_template('admin/deleted_entries.html', entries=entries)
 
 @admin_bp.route('/users', methods=['GET', 'POST'])
+@read_only_route
 def list_users():
     if 'user_id' not in session:
         return redirect(url_for('login'))
@@ -0,0 +1,213 @@
+"""
+analytics.py
+
+Yield and distribution statistics over all test entries, computed with NumPy on columnar
+arrays for `/analytics`.
+
+Loading: one query for the entries (id, last_step, failure) and one for their typed values
+from the `measurement` table (measurements.py); the values are scattered into an
+entries x fields float matrix (NaN = not answered), booleans as 1.0 / 0.0.
+
+Computed in one vectorized pass per kind of field:
+- page yield: of the entries that got past page p or failed on it, the fraction that got
+  past it (a failed entry fails on its `last_step` page)
+- boolean yield: share of "yes" among the answered values of every boolean field
+- numeric fields (integer / float): count, mean, std, min, max, percentiles, a histogram,
+  and outliers by robust z-score (|x - median| / (1.4826 * MAD) > OUTLIER_Z)
+
+Scope: every entry, or with `latest` only the newest entry per CM serial; dummy entries
+(`test=True`) only with `include_dummy`.
+
+Results are cached per worker by scope, data version and form configuration version: the
+data version is a signature of test_entry, measurement and entry_history that changes with
+every insert, data or status change and delete, the form version (`form_config.forms_version`)
+changes with every form edit, so repeated page loads cost four aggregate queries.
+"""
+
+import threading
+
+import numpy as np
+from sqlalchemy import select, func
+
+from models import db, TestEntry, Measurement, EntryHistory, json_key
+from form_config import FORMS_NON_DICT, forms_version
+from measurements import field_types
+from queries import latest_per_serial
+
+PERCENTILES = (1, 5, 25, 50, 75, 95, 99)
+HISTOGRAM_BINS = 20
+OUTLIER_Z = 3.5
+MAX_OUTLIERS = 20               # listed per field
+CACHE_SIZE = 8
+YES = ("yes", "true", "pass", "1")
+NO = ("no", "false", "fail", "0")
+
+_cache = {}                     # (version, form version, latest, include_dummy) -> result
+_cache_lock = threading.Lock()
+
+
+def data_version():
+    """Signature that changes whenever entries or their values change."""
+    return (
+        db.session.query(func.count(TestEntry.id), func.max(TestEntry.id)).one(),
+        db.session.query(func.count(Measurement.id), func.max(Measurement.id)).one(),
+        db.session.scalar(select(func.max(EntryHistory.id))),
+    )
+
+
+## loading
+
+def _entries(latest, include_dummy):
+    criteria = [] if include_dummy else [TestEntry.test.isnot(True)]
+    query = latest_per_serial(*criteria) if latest else TestEntry.query.filter(*criteria)
+    rows = query.with_entities(
+        TestEntry.id, json_key(TestEntry.data, "CM_serial"),
+        json_key(TestEntry.data, "last_step", as_integer=True), TestEntry.failure,
+    ).order_by(TestEntry.id).all()
+    return (
+        np.array([r[0] for r in rows], dtype=np.int64),
+        np.array([r[1] or "" for r in rows], dtype=object),
+        np.array([r[2] or 0 for r in rows], dtype=np.int64),
+        np.array([bool(r[3]) for r in rows], dtype=bool),
+    )
+
+
+def _boolean(text_values):
+    lowered = np.char.lower(np.char.strip(text_values.astype(str)))
+    return np.where(np.isin(lowered, YES), 1.0, np.where(np.isin(lowered, NO), 0.0, np.nan))
+
+
+def load_columns(latest=False, include_dummy=False):
+    """(entry ids, serials, last steps, failed flags, field names, types, values matrix)."""
+    ids, serials, steps, failed = _entries(latest, include_dummy)
+    types = {name: kind for name, kind in field_types().items()
+             if kind in ("integer", "float", "boolean") and name != "CM_serial"}
+    names = list(types)
+    column_of = {name: j for j, name in enumerate(names)}
+    values = np.full((len(ids), len(names)), np.nan)
+    if ids.size == 0 or not names:
+        return ids, serials, steps, failed, names, types, values
+
+    query = (
+        select(Measurement.entry_id, Measurement.field_name, Measurement.num_value, Measurement.text_value)
+        .where(Measurement.field_name.in_(names))
+    )
+    if not include_dummy:
+        query = query.join(TestEntry, TestEntry.id == Measurement.entry_id).where(TestEntry.test.isnot(True))
+    rows = db.session.execute(query).all()
+    if rows:
+        entry_ids = np.array([r[0] for r in rows], dtype=np.int64)
+        columns = np.array([column_of[r[1]] for r in rows], dtype=np.int64)
+        numbers = np.array([np.nan if r[2] is None else r[2] for r in rows], dtype=float)
+        texts = np.array([r[3] or "" for r in rows], dtype=object)
+
+        is_bool = np.array([types[name] == "boolean" for name in names])[columns]
+        numbers[is_bool] = _boolean(texts[is_bool])
+
+        # keep only rows of loaded entries, then scatter into the matrix
+        positions = np.clip(np.searchsorted(ids, entry_ids), 0, len(ids) - 1)
+        keep = ids[positions] == entry_ids
+        values[positions[keep], columns[keep]] = numbers[keep]
+    return ids, serials, steps, failed, names, types, values
+
+
+## statistics
+
+def page_yields(steps, failed, page_count):
+    """Per form page: (passed, failed, yield or None)."""
+    step_counts = np.bincount(np.clip(steps, 0, page_count), minlength=page_count + 1)
+    # a failed entry got past the pages before its last_step and failed on that one
+    got_past = step_counts[::-1].cumsum()[::-1][1:page_count + 1]      # last_step > p
+    failed_on = np.bincount(np.clip(steps[failed], 0, page_count), minlength=page_count + 1)[:page_count]
+    total = got_past + failed_on
+    with np.errstate(invalid="ignore", divide="ignore"):
+        yields = np.where(total > 0, got_past / np.maximum(total, 1), np.nan)
+    return got_past, failed_on, yields
+
+
+def numeric_stats(values, ids, serials):
+    """Stats of the columns of `values` (one per numeric field), in one pass over the matrix."""
+    answered = ~np.isnan(values)
+    counts = answered.sum(axis=0)
+    stats = [None] * values.shape[1]
+    has = counts > 0
+    if not has.any():
+        return stats
+
+    sub = values[:, has]
+    with np.errstate(invalid="ignore"):
+        mean = np.nanmean(sub, axis=0)
+        std = np.nanstd(sub, axis=0)
+        low, high = np.nanmin(sub, axis=0), np.nanmax(sub, axis=0)
+        pcts = np.nanpercentile(sub, PERCENTILES, axis=0)
+        median = pcts[PERCENTILES.index(50)]
+        mad = np.nanmedian(np.abs(sub - median), axis=0)
+        robust_z = np.abs(sub - median) / np.where(mad > 0, 1.4826 * mad, np.inf)
+    outlier = np.nan_to_num(robust_z) > OUTLIER_Z
+
+    for j, column in enumerate(np.flatnonzero(has)):
+        present = sub[:, j][answered[:, column]]
+        hist, edges = np.histogram(present, bins=HISTOGRAM_BINS)
+        flagged = np.flatnonzero(outlier[:, j])
+        order = flagged[np.argsort(-robust_z[flagged, j])][:MAX_OUTLIERS]
+        stats[column] = {
+            "count": int(counts[column]), "mean": float(mean[j]), "std": float(std[j]),
+            "min": float(low[j]), "max": float(high[j]),
+            "percentiles": {f"p{p}": float(pcts[i, j]) for i, p in enumerate(PERCENTILES)},
+            "histogram": {"counts": hist.tolist(), "edges": edges.tolist()},
+            "outlier_count": int(flagged.size),
+            "outliers": [{"entry_id": int(ids[i]), "cm_serial": serials[i], "value": float(sub[i, j])}
+                         for i in order],
+        }
+    return stats
+
+
+def compute(latest=False, include_dummy=False):
+    """The full analytics result as plain (JSON-ready) data."""
+    ids, serials, steps, failed, names, types, values = load_columns(latest, include_dummy)
+    page_count = len(FORMS_NON_DICT)
+    passed, failed_on, yields = page_yields(steps, failed, page_count)
+
+    bool_columns = [j for j, name in enumerate(names) if types[name] == "boolean"]
+    num_columns = [j for j, name in enumerate(names) if types[name] != "boolean"]
+
+    answers = values[:, bool_columns]
+    answered = (~np.isnan(answers)).sum(axis=0)
+    yes = np.nansum(answers, axis=0)
+    stats = numeric_stats(values[:, num_columns], ids, serials)
+
+    return {
+        "entries": int(len(ids)),
+        "latest_only": latest,
+        "include_dummy": include_dummy,
+        "finished": int((steps >= page_count).sum()),
+        "failed": int(failed.sum()),
+        "pages": [
+            {"page": p, "label": FORMS_NON_DICT[p].label, "passed": int(passed[p]), "failed": int(failed_on[p]),
+             "yield": None if np.isnan(yields[p]) else float(yields[p])}
+            for p in range(page_count)
+        ],
+        "checks": [
+            {"field": names[j], "answered": int(answered[k]), "passed": int(yes[k]),
+             "yield": float(yes[k] / answered[k]) if answered[k] else None}
+            for k, j in enumerate(bool_columns)
+        ],
+        "readings": [
+            {"field": names[j], "type": types[names[j]], **(stats[k] or {"count": 0})}
+            for k, j in enumerate(num_columns)
+        ],
+    }
+
+
+def analytics(latest=False, include_dummy=False):
+    """`compute()`, cached per scope until the data or the form configuration changes."""
+    key = (data_version(), forms_version(), latest, include_dummy)
+    with _cache_lock:
+        if key in _cache:
+            return _cache[key]
+    result = compute(latest, include_dummy)
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > CACHE_SIZE:
+            _cache.pop(next(iter(_cache)))
+    return result
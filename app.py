@@ -4,9 +4,20 @@ Flask web application for managing test entries with user authentication.
 Features:
 - User registration and login
 - Form submission for test data with file upload
-- History view of all test entries
-- CSV export of test results
+- History view of all test entries (`?all_time=true` includes the archive database)
+- CSV export of test results (`background=true` runs it as a background job for admins, see jobs.py)
+- Streamed ZIP traveler bundle of a CM (record + all uploads), or of a serial range (/cm/<serial>/bundle)
+- Field-by-field diff of a retest against its parent, or of any two entries (/diff)
+- Retest timeline of one CM, from a single recursive query (/lineage/<serial>)
+- Time spent per form page and where saved forms stall (/step_times)
+- Throughput and technician trends per day / week / month, from daily rollups (/trends)
+- Yield and reading statistics of all entries (/analytics, NumPy)
+- Fleet status board of every CM serial, from an in-memory array (/fleet)
+- Full-text search over fail reasons, text answers and contributors (/search, SQLite FTS5)
+- JSON range / top-K lookups of entries by one numeric form field (/measurements/<field>)
 - File download for uploaded reports
+- Optional read snapshot of the test database for the heavy read-only views (`CM_READ_SNAPSHOT=1`,
+  see db_engine.py), so history / export / analytics never compete with form saves
 """
 # TODO fix formatting of code and make constantly repeated code into helper functions?
 # TODO block using back button on forms?
@@ -16,15 +27,37 @@ import os
 import io
 import csv
 from datetime import datetime
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, flash, send_from_directory, abort
+from flask import (Flask, Response, render_template, request, redirect, url_for, session, send_file, flash,
+                   send_from_directory, abort, stream_with_context)
 from sqlalchemy.orm.attributes import flag_modified #TODO include in the .yml and enviroment if needed later
 
-from models import db, User, TestEntry
+from models import db, User, TestEntry, add_missing_columns, add_missing_indexes
 from form_config import FORMS_NON_DICT
 from admin_routes import admin_bp
 from admin_form_editor import form_editor_bp
-from utils import (validate_form, determine_step_from_data, release_lock, process_file_fields, current_user, acquire_lock)
+from utils import (validate_form, determine_step_from_data, release_lock, process_file_fields, current_user, acquire_lock,
+                   remember_entry_version, entry_changed_elsewhere, commit_entry_changes, entry_status, authenticate_admin,
+                   export_fields, export_header, export_row)
 from constants import EASTERN_TZ
+from db_engine import init_engine_profile, read_only_binds, read_only_route, read_snapshot_binds, read_snapshot_route
+from migrate_db import copy_db_command
+from uploads import uploads_cli
+from archive import with_archive, archive_entries_command
+from queries import (latest_per_serial, failed_pending_retest, serial_in_use, saved_entries, lineage, with_parents,
+                     measurement_range, measurement_top, check_query_plans_command)
+from measurements import measurements_cli, numeric_fields
+from analytics import analytics as compute_analytics
+from bundles import stream_bundle, serials_in_range
+from entry_diff import diff_entries, parent_diff, retest_diffs, FLOAT_REL_TOL
+from step_timing import mark_entered, record_step, step_stats, STATS_DAYS
+from rollups import rollups_cli, trends as rollup_trends, default_start, parse_day, BUCKETS
+from fleet import rebuild_fleet, fleet_status, serial_status, STATUSES as FLEET_STATUSES
+from search import create_search_index, search_entries, available as search_available, rebuild_search_index_command, PAGE_SIZE
+from datagen import generate_entries_command
+from security_events import login_throttled, record_login_failure, flush as flush_security_events
+from metrics import init_metrics
+from jobs import init_jobs, enqueue, jobs_cli
+from backup import backup_cli
 
 app = Flask(__name__)
 
@@ -33,20 +66,80 @@ data_path = os.path.join(basedir, 'data')
 
 app.config['SECRET_KEY'] = 'testsecret'
 app.config['UPLOAD_FOLDER'] = 'uploads'
+# database snapshots (backup.py); best on another disk than data/
+app.config['BACKUP_FOLDER'] = os.environ.get('CM_BACKUP_FOLDER', os.path.join(data_path, 'backups'))
 
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(data_path, 'test.db')}"
+# SQLite files by default; point either bind at PostgreSQL (postgresql://user:pw@host/db) to switch
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('CM_DATABASE_URI', f"sqlite:///{os.path.join(data_path, 'test.db')}")
 app.config['SQLALCHEMY_BINDS'] = {
-    'main': f"sqlite:///{os.path.join(data_path, 'test.db')}",
-    'users': f"sqlite:///{os.path.join(data_path, 'users.db')}"
+    'main': app.config['SQLALCHEMY_DATABASE_URI'],
+    'users': os.environ.get('CM_USERS_DATABASE_URI', f"sqlite:///{os.path.join(data_path, 'users.db')}"),
+    'metrics': os.environ.get('CM_METRICS_DATABASE_URI', f"sqlite:///{os.path.join(data_path, 'metrics.db')}"),
+    'archive': os.environ.get('CM_ARCHIVE_DATABASE_URI', f"sqlite:///{os.path.join(data_path, 'archive.db')}")
 }
 
+# per-connection pragmas, see db_engine.SQLITE_PROFILE_DEFAULTS for the keys that can be overridden
+app.config['SQLITE_ENGINE_PROFILE'] = {}
+# serve GET views marked @read_only_route through mode=ro connections
+app.config['SQLITE_READ_ONLY_ROUTES'] = True
+if app.config['SQLITE_READ_ONLY_ROUTES']:
+    app.config['SQLALCHEMY_BINDS'].update(read_only_binds(app.config['SQLALCHEMY_BINDS']))
+# serve views marked @read_snapshot_route from a periodically refreshed copy of test.db (main_snap bind),
+# falling back to test.db itself when the copy is more than SQLITE_READ_SNAPSHOT_MAX_AGE seconds old
+app.config['SQLITE_READ_SNAPSHOT'] = os.environ.get('CM_READ_SNAPSHOT') == '1'
+app.config['SQLITE_READ_SNAPSHOT_MAX_AGE'] = int(os.environ.get('CM_READ_SNAPSHOT_MAX_AGE', 60))
+if app.config['SQLITE_READ_SNAPSHOT']:
+    app.config['SQLALCHEMY_BINDS'].update(read_snapshot_binds(app.config['SQLALCHEMY_BINDS']))
+
 db.init_app(app)
+init_engine_profile(app, db)
+init_metrics(app)
+init_jobs(app)
 
 app.register_blueprint(admin_bp)
 app.register_blueprint(form_editor_bp)
 
+app.cli.add_command(copy_db_command)
+app.cli.add_command(generate_entries_command)
+app.cli.add_command(check_query_plans_command)
+app.cli.add_command(uploads_cli)
+app.cli.add_command(archive_entries_command)
+app.cli.add_command(measurements_cli)
+app.cli.add_command(rollups_cli)
+app.cli.add_command(rebuild_search_index_command)
+app.cli.add_command(jobs_cli)
+app.cli.add_command(backup_cli)
+
+@app.teardown_request
+def flush_buffered_security_events(_exc):
+    flush_security_events()
+
 with app.app_context():
     db.create_all()
+    add_missing_columns()
+    add_missing_indexes()
+    create_search_index()
+    rebuild_fleet()
+
+def entry_conflict(user, entry_id):
+    """Clean response for a form write that lost an optimistic-concurrency race.
+
+    If the entry now belongs to someone else (e.g. an admin cleared the lock and another
+    technician resumed it) the user is detached from it, otherwise (a second tab) the form
+    is reloaded from the latest saved version."""
+    db.session.rollback()
+    session.pop('form_data', None)
+    session.pop('entry_version', None)
+
+    entry = db.session.get(TestEntry, entry_id) if entry_id is not None else None
+    if entry is None or (entry.lock_owner and entry.lock_owner != user.username):
+        user.form_id = None
+        db.session.commit()
+        flash("This form was changed by someone else while you were editing it. Your last step was not saved.", "warning")
+        return redirect(url_for('dashboard'))
+
+    flash("This form was updated in another tab or window. Showing the latest saved version.", "warning")
+    return redirect(url_for('form'))
 
 @app.route('/uploads/<path:filename>')
 def uploaded_file(filename):
@@ -82,10 +175,14 @@ def login():
     """Login form route"""
     if request.method == 'POST':
         username = request.form['username'].strip()
+        # refuse before the (deliberately slow) pbkdf2 check so brute force can't tie up workers
+        if login_throttled(username, request.remote_addr):
+            return 'Too many failed login attempts. Try again later.', 429
         user = User.query.filter_by(username=username).first()
         if user and user.check_password(request.form['password']):
             session['user_id'] = user.id
             return redirect(url_for('home'))
+        record_login_failure(username, request.remote_addr)
         return 'Invalid credentials'
     return render_template('login.html')
 
@@ -124,8 +221,9 @@ def form():
             last_step = held_entry.data.get("last_step", -1)
             #DEBUG PRINT
             #print(f"last step:{last_step}")
-            if form_index != last_step:
+            if form_index != last_step or entry_changed_elsewhere(held_entry):
                 session['form_data'] = held_entry.data.copy()
+                remember_entry_version(held_entry)
                 return redirect(url_for('form', step=last_step))
 
     # #DEBUG PRINT
@@ -161,17 +259,7 @@ def form():
 
             if posted_serial and posted_serial.isdigit():
 
-                existing_entry = TestEntry.query.filter(
-                        TestEntry.data["CM_serial"].as_string() == str(cm_serial),
-                        db.or_(
-                            TestEntry.is_saved.is_(True),
-                            db.and_(
-                                TestEntry.failure.is_(True),
-                                TestEntry.fail_stored.is_(True),
-                                TestEntry.is_finished.is_(False)
-                            )
-                        )
-                    ).first()
+                existing_entry = serial_in_use(cm_serial).first()
 
                 if existing_entry:
                     session.pop('form_data', None)
@@ -202,6 +290,8 @@ def form():
                 #DEBUG PRINT
                 #print(f"DEBUG Save - NEW ENTRY - no entry found for user {user.username} with form_id {user.form_id}")
                 entry = TestEntry(data={})
+            elif entry_changed_elsewhere(entry):
+                return entry_conflict(user, entry.id)
 
             # Merge new data; do NOT overwrite existing uploaded filenames if none chosen
             entry.data.update(session['form_data'])
@@ -215,12 +305,16 @@ def form():
             if user.username not in (entry.contributors or []):
                 entry.contributors = (entry.contributors or []) + [user.username]
 
+            entry_id = user.form_id
             user.form_id = None
 
             db.session.add(entry)
-            db.session.commit()
+            record_step(entry, form_index, "save", user.username)
+            if not commit_entry_changes():
+                return entry_conflict(user, entry_id)
             release_lock(entry)
             session.pop('form_data', None)      # clear browser session copy
+            session.pop('entry_version', None)
             return redirect(url_for('dashboard'))
 
         # 1st Check for Error Valid Serial Number
@@ -262,34 +356,13 @@ def form():
             reason = request.form.get("fail_reason", "").strip()
             user = current_user()
 
-            # Update session data with latest input
-            for field in current_form.fields:
-                value = request.form.get(field.name)
-                if value is not None:
-                    session['form_data'][field.name] = value
-
-            session['form_data'] = process_file_fields(
-                current_form.fields,
-                request,
-                app.config['UPLOAD_FOLDER'],
-                session['form_data']
-            )
-
-            # Update session data with latest input
-            for field in current_form.fields:
-                value = request.form.get(field.name)
-                if value is not None:
-                    session['form_data'][field.name] = value
-
-            session['form_data'] = process_file_fields(
-                current_form.fields,
-                request,
-                app.config['UPLOAD_FOLDER'],
-                session['form_data']
-            )
+            # inputs and uploads of this page were already stored in session['form_data'] above
 
             entry = TestEntry.query.filter(TestEntry.id == user.form_id).first()
 
+            if entry and entry_changed_elsewhere(entry):
+                return entry_conflict(user, entry.id)
+
             if entry:
                 entry.data = session['form_data']
                 flag_modified(entry, "data")
@@ -310,13 +383,17 @@ def form():
             if user.username not in (entry.contributors or []):
                 entry.contributors = (entry.contributors or []) + [user.username]
 
+            entry_id = user.form_id
             user.form_id = None
             db.session.add(entry)
-            db.session.commit()
+            record_step(entry, form_index, "fail", user.username)
+            if not commit_entry_changes():
+                return entry_conflict(user, entry_id)
             release_lock(entry)
             entry.is_saved = False
 
             session.pop('form_data', None)
+            session.pop('entry_version', None)
 
             return render_template('form_complete.html')
 
@@ -334,6 +411,8 @@ def form():
             else:
                 if entry.lock_owner and entry.lock_owner != user.username:
                     return "This form is currently being edited by another user."
+                if entry_changed_elsewhere(entry):
+                    return entry_conflict(user, entry.id)
                 entry.data = session['form_data']
                 flag_modified(entry, "data")
 
@@ -345,11 +424,14 @@ def form():
             entry.data['last_step'] = form_index + 1
             flag_modified(entry, "data")
             user.form_id = entry.id
+            record_step(entry, form_index, "next", user.username)
 
             #DEBUG PRINT
             #print(f"assigned {user.username} id: {user.form_id}")
 
-            db.session.commit()
+            if not commit_entry_changes():
+                return entry_conflict(user, user.form_id)
+            remember_entry_version(entry)
 
             if form_index + 1 < len(FORMS_NON_DICT):
                 return redirect(url_for('form', step=form_index + 1))
@@ -360,11 +442,14 @@ def form():
             entry.failure = False
             entry.fail_reason = None
             entry.fail_stored = False
+            entry_id = user.form_id
             user.form_id = None
 
-            db.session.commit()
+            if not commit_entry_changes():
+                return entry_conflict(user, entry_id)
             release_lock(entry)
             session.pop('form_data', None)
+            session.pop('entry_version', None)
             return render_template("form_complete.html")
 
         # Step 5: re-render form with inline errors
@@ -380,6 +465,7 @@ def form():
             name="Form"
         )
 
+    mark_entered(form_index)
     return render_template(
         "form.html",
         fields=current_form.fields,
@@ -398,91 +484,317 @@ def restart_forms():
     return redirect(url_for('form'))
 
 @app.route('/history')
+@read_snapshot_route
 def history():
     """Show history of all test entries."""
     if 'user_id' not in session:
         return redirect(url_for('login'))
     unique_toggle = request.args.get('unique') == "true"
+    all_time = request.args.get('all_time') == "true"
 
     all_fields = []
     for single_form in FORMS_NON_DICT:
         all_fields.extend([f for f in single_form.fields if getattr(f, "display_history", True)])
 
     if unique_toggle:
-        subquery = (
-            db.session.query(
-                TestEntry.data["CM_serial"].as_integer().label("cm_serial"),
-                db.func.max(TestEntry.timestamp).label("latest")
-            )
-            .group_by(TestEntry.data["CM_serial"].as_integer())
-            .subquery()
-        )
-
-        entries = (
-            db.session.query(TestEntry)
-            .join(subquery, db.and_(
-                TestEntry.data["CM_serial"].as_integer() == subquery.c.cm_serial,
-                TestEntry.timestamp == subquery.c.latest
-            ))
-            .order_by(TestEntry.timestamp.desc())
-            .all()
-        )
+        entries = with_parents(latest_per_serial()).all()
 
     else:
-        entries = TestEntry.query.order_by(TestEntry.timestamp.desc()).all()
+        entries = with_parents(TestEntry.query.order_by(TestEntry.timestamp.desc())).all()
+
+    # archived entries are only read when asked for
+    if all_time:
+        entries = with_archive(entries, unique=unique_toggle)
 
-    return render_template('history.html', entries=entries, fields=all_fields, show_unique=unique_toggle, now=datetime.now(EASTERN_TZ))
+    return render_template('history.html', entries=entries, fields=all_fields, show_unique=unique_toggle,
+                           all_time=all_time, now=datetime.now(EASTERN_TZ))
 
 @app.route('/export_csv')
+@read_snapshot_route
 def export_csv():
     """Export all test entries to CSV."""
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
     unique_toggle = request.args.get('unique') == "true"
+    all_time = request.args.get('all_time') == "true"
 
-    # Combine all fields from all forms for CSV export
-    all_fields = []
-    for single_form in FORMS_NON_DICT:
-        all_fields.extend(single_form.fields)
+    if request.args.get('background') == "true":
+        # large exports: written by a job, downloaded from its page when done
+        if not authenticate_admin():
+            return "Permission Denied"
+        job = enqueue("export_csv", {"unique": unique_toggle, "all_time": all_time}, current_user().get_username())
+        return redirect(url_for('admin.job_status', job_id=job.id))
 
+    # Combine all fields from all forms for CSV export
+    all_fields = export_fields()
 
     if unique_toggle:
-        subquery = (
-            db.session.query(
-                TestEntry.data["CM_serial"].as_integer().label("cm_serial"),
-                db.func.max(TestEntry.timestamp).label("latest")
-            )
-            .group_by(TestEntry.data["CM_serial"].as_integer())
-            .subquery()
-        )
-
-        entries = (
-            db.session.query(TestEntry)
-            .join(subquery, db.and_(
-                TestEntry.data["CM_serial"].as_integer() == subquery.c.cm_serial,
-                TestEntry.timestamp == subquery.c.latest
-            ))
-            .order_by(TestEntry.timestamp.desc())
-            .all()
-        )
+        entries = latest_per_serial().all()
     else:
         entries = TestEntry.query.order_by(TestEntry.timestamp.desc()).all()
 
+    if all_time:
+        entries = with_archive(entries, unique=unique_toggle)
+
     output = io.StringIO()
     writer = csv.writer(output)
-    writer.writerow(['Time', 'User'] + [f.label for f in all_fields] + ['File', "Test Aborted", "Reason Aborted"])
+    writer.writerow(export_header(all_fields))
 
     for e in entries:
-        row = [e.timestamp, e.user.username]
-        row += [e.data.get(f.name) for f in all_fields]
-        row += [e.file_name, "yes" if e.failure else "no", e.fail_reason or ""]
-        writer.writerow(row)
+        writer.writerow(export_row(e, all_fields))
 
     output.seek(0)
     return send_file(io.BytesIO(output.read().encode()), mimetype='text/csv',
                      as_attachment=True, download_name='test_results.csv')
 
+@app.route('/analytics')
+@read_snapshot_route
+def analytics():
+    """Page / check yields and reading distributions; `latest=true` counts only the newest
+    entry per CM, `dummy=true` includes generated entries, `format=json` for the raw numbers."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    result = compute_analytics(latest=request.args.get('latest') == 'true',
+                               include_dummy=request.args.get('dummy') == 'true')
+    if request.args.get('format') == 'json':
+        return result
+    return render_template('analytics.html', result=result)
+
+@app.route('/trends')
+@read_snapshot_route
+def trends():
+    """Finished / failed / cleared tests, mean test time, failures per page and work per
+    technician from the daily rollups; `by=day|week|month`, `start` / `end` as YYYY-MM-DD,
+    `format=json` for the raw series."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    by = request.args.get('by', 'day')
+    if by not in BUCKETS:
+        return {"error": f"by must be one of {', '.join(BUCKETS)}"}, 400
+    start = parse_day(request.args.get('start')) or default_start(by)
+    result = rollup_trends(start, parse_day(request.args.get('end')), by)
+    if request.args.get('format') == 'json':
+        return result
+    return render_template('trends.html', result=result, buckets=BUCKETS,
+                           labels={i: page.label for i, page in enumerate(FORMS_NON_DICT)})
+
+@app.route('/step_times')
+@read_snapshot_route
+def step_times():
+    """Median / p90 time per form page over the last `days` days and the saved forms waiting
+    on each page; `format=json` for the raw numbers."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    days = max(1, request.args.get('days', STATS_DAYS, type=int))
+    result = step_stats(days)
+    if request.args.get('format') == 'json':
+        return result
+    return render_template('step_times.html', result=result)
+
+@app.route('/fleet')
+def fleet():
+    """Status of every CM serial at a glance; `format=json` for the raw board."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    board = fleet_status()
+    if request.args.get('format') == 'json':
+        return board
+    counts = {status: sum(1 for slot in board if slot["status"] == status) for status in FLEET_STATUSES}
+    return render_template('fleet.html', board=board, counts=counts, pages=len(FORMS_NON_DICT))
+
+@app.route('/fleet/<int:cm_serial>')
+def fleet_serial(cm_serial):
+    """Status of one CM serial as JSON."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    slot = serial_status(cm_serial)
+    if slot is None:
+        return {"error": f"CM{cm_serial} is outside the serial range"}, 404
+    return slot
+
+@app.route('/search')
+@read_only_route
+def search():
+    """Ranked full-text search over entries, PAGE_SIZE hits per page."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    query = request.args.get('q', '').strip()
+    page = max(1, request.args.get('page', 1, type=int))
+    enabled = search_available(db.engines[TestEntry.__bind_key__])
+    total, hits = search_entries(query, page) if enabled and query else (0, [])
+
+    if request.args.get('format') == 'json':
+        return {
+            "query": query, "page": page, "total": total,
+            "hits": [
+                {"entry_id": hit["entry"].id, "cm_serial": hit["entry"].data.get("CM_serial"),
+                 "timestamp": hit["entry"].timestamp.isoformat() if hit["entry"].timestamp else None,
+                 "rank": hit["rank"], "snippet": str(hit["snippet"])}
+                for hit in hits
+            ],
+        }
+    pages = max(1, -(-total // PAGE_SIZE))
+    return render_template('search.html', query=query, page=page, pages=pages, total=total,
+                           hits=hits, enabled=enabled)
+
+@app.route('/measurements/<field_name>')
+@read_only_route
+def measurements(field_name):
+    """Entries by the value of one numeric form field, as JSON.
+    ?min=&max= selects a range (lowest first, at most `limit` rows),
+    ?top=K the K largest (or smallest with order=asc)."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+
+    if field_name not in numeric_fields():
+        return {"error": f"{field_name} is not a numeric form field", "fields": numeric_fields()}, 404
+
+    top = request.args.get('top', type=int)
+    if top is not None:
+        rows = measurement_top(field_name, max(1, min(top, 1000)), largest=request.args.get('order') != 'asc')
+    else:
+        limit = max(1, min(request.args.get('limit', 1000, type=int), 10000))
+        rows = measurement_range(field_name, request.args.get('min', type=float),
+                                 request.args.get('max', type=float)).limit(limit)
+
+    return [
+        {
+            "entry_id": entry.id,
+            "cm_serial": entry.data.get("CM_serial"),
+            "value": value,
+            "timestamp": entry.timestamp.isoformat() if entry.timestamp else None,
+            "failure": bool(entry.failure),
+            "is_finished": bool(entry.is_finished),
+        }
+        for entry, value in rows
+    ]
+
+def _lineage_response(rows, title):
+    attempts = [
+        {
+            "entry_id": entry.id,
+            "parent_id": entry.parent_id,
+            "depth": depth,
+            "cm_serial": entry.data.get("CM_serial"),
+            "status": entry_status(entry),
+            "last_step": entry.data.get("last_step"),
+            "fail_reason": entry.fail_reason,
+            "contributors": entry.contributors or [],
+            "created_at": entry.created_at.isoformat() if entry.created_at else None,
+            "timestamp": entry.timestamp.isoformat() if entry.timestamp else None,
+        }
+        for entry, depth in rows
+    ]
+    if request.args.get('format') == 'json':
+        return attempts
+    return render_template('lineage.html', attempts=attempts, title=title,
+                           labels={i: page.label for i, page in enumerate(FORMS_NON_DICT)})
+
+@app.route('/lineage/<int:cm_serial>')
+@read_only_route
+def serial_lineage(cm_serial):
+    """All attempts at one CM with their retest tree, oldest first; `format=json` for the list."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    return _lineage_response(lineage(cm_serial).all(), f"CM{cm_serial}")
+
+@app.route('/lineage/entry/<int:entry_id>')
+@read_only_route
+def entry_lineage(entry_id):
+    """The retest tree containing one entry (first attempt to latest retest)."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    rows = lineage(entry_id=entry_id).all()
+    if not rows:
+        return abort(404)
+    return _lineage_response(rows, f"Test{entry_id}")
+
+def _tolerance():
+    tolerance = request.args.get('tol', FLOAT_REL_TOL, type=float)
+    return tolerance if 0 <= tolerance < 1 else FLOAT_REL_TOL
+
+def _diff_response(diffs, batch=False):
+    if request.args.get('format') == 'json':
+        return diffs if batch else diffs[0]
+    return render_template('diff.html', diffs=diffs, batch=batch, show_same=request.args.get('all') == 'true',
+                           tolerance=_tolerance(), link_args={**request.view_args, **request.args.to_dict()})
+
+@app.route('/diff/<int:entry_id>')
+@read_only_route
+def diff_parent(entry_id):
+    """Diff of a retest against the failed attempt it retests."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    result = parent_diff(entry_id, _tolerance())
+    if result is None:
+        return {"error": f"Test{entry_id} does not exist or is not a retest"}, 404
+    return _diff_response([result])
+
+@app.route('/diff/<int:old_id>/<int:new_id>')
+@read_only_route
+def diff_pair(old_id, new_id):
+    """Diff of any two entries, `old_id` taken as the earlier one."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    old, new = db.session.get(TestEntry, old_id), db.session.get(TestEntry, new_id)
+    if old is None or new is None:
+        return abort(404)
+    return _diff_response([diff_entries(old, new, _tolerance())])
+
+@app.route('/diff/retests')
+@read_only_route
+def diff_retests():
+    """Every retest of the CMs in `serial_min`..`serial_max` against its parent, changed fields
+    only (all fields with `all=true`)."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    serial_min = request.args.get('serial_min', type=int)
+    serial_max = request.args.get('serial_max', serial_min, type=int)
+    if serial_min is None or serial_max is None or serial_max < serial_min:
+        return {"error": "serial_min (and serial_max >= serial_min) are required"}, 400
+    diffs = retest_diffs(serial_min, serial_max, _tolerance(), changed_only=request.args.get('all') != 'true')
+    return _diff_response(diffs, batch=True)
+
+def _bundle_response(serials, filename):
+    return Response(
+        stream_with_context(stream_bundle(serials, app.config['UPLOAD_FOLDER'])),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'},
+    )
+
+@app.route('/cm/<int:cm_serial>/bundle')
+@read_only_route
+def cm_bundle(cm_serial):
+    """ZIP of the traveler (HTML + JSON) and all uploads of one CM, streamed."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    if not serials_in_range(cm_serial, cm_serial):
+        return abort(404)
+    return _bundle_response([cm_serial], f"CM{cm_serial}-traveler.zip")
+
+@app.route('/cm/bundle')
+@read_only_route
+def cm_bundle_range():
+    """One ZIP with the bundles of every CM in `serial_min`..`serial_max` that has entries
+    (the first BULK_MAX_SERIALS of them)."""
+    if 'user_id' not in session:
+        return redirect(url_for('login'))
+    serial_min = request.args.get('serial_min', type=int)
+    serial_max = request.args.get('serial_max', serial_min, type=int)
+    if serial_min is None or serial_max is None or serial_max < serial_min:
+        return {"error": "serial_min (and serial_max >= serial_min) are required"}, 400
+    serials = serials_in_range(serial_min, serial_max)
+    if not serials:
+        return abort(404)
+    return _bundle_response(serials, f"CM{serials[0]}-CM{serials[-1]}-travelers.zip")
+
 @app.route('/help')
 def help_button():
     """Render help page grouped by form section, showing only fields with help_text, help_link, or help_label."""
@@ -514,16 +826,12 @@ def prod_test_doc():
     return send_from_directory("static", "Apollo_CMv3_Production_Testing_04Nov2024.html")
 
 @app.route("/dashboard")
+@read_only_route
 def dashboard():
     if "user_id" not in session:
         return redirect(url_for("login"))
 
-    entries = (
-        TestEntry.query
-        .filter_by(is_saved=True)
-        .order_by(TestEntry.timestamp.desc())
-        .all()
-    )
+    entries = saved_entries().all()
 
     for e in entries:
         step_idx = e.data.get("last_step")
@@ -562,39 +870,23 @@ def resume_entry(entry_id):
     entry.is_saved = False
 
     user.form_id = entry.id
-    db.session.commit()
+    if not commit_entry_changes():
+        return "Entry is being edited by someone else. Try again later."
 
     # prime session data and redirect into the normal /form workflow
     session['form_data'] = entry.data.copy()
+    remember_entry_version(entry)
     step = entry.data.get("last_step", 0)
     return redirect(url_for('form', step=step))
 
 @app.route('/failed_tests')
+@read_only_route
 def failed_tests():
     if 'user_id' not in session:
         return redirect(url_for('login'))
 
-    # Subquery: get latest timestamp per failed CM_serial
-    subquery = (
-        db.session.query(
-            TestEntry.data["CM_serial"].as_integer().label("cm_serial"),
-            db.func.max(TestEntry.timestamp).label("latest")
-        )
-        .filter(TestEntry.failure.is_(True), TestEntry.fail_stored.is_(True))
-        .group_by(TestEntry.data["CM_serial"].as_integer())
-        .subquery()
-    )
-
-    # Main query: get full entries that match the latest timestamp per serial
-    entries = (
-        db.session.query(TestEntry)
-        .join(subquery, db.and_(
-            TestEntry.data["CM_serial"].as_integer() == subquery.c.cm_serial,
-            TestEntry.timestamp == subquery.c.latest
-        ))
-        .order_by(TestEntry.timestamp.desc())
-        .all()
-    )
+    # latest failed entry per CM_serial that still waits for a retest
+    entries = with_parents(failed_pending_retest()).all()
 
     return render_template('failed_tests.html', entries=entries, now=datetime.now(EASTERN_TZ))
 
@@ -616,9 +908,12 @@ def retest_failed(entry_id):
         flash("This failed test has already been resumed or cleared.", "warning")
         return redirect(url_for('failed_tests'))
 
-    # Mark the old entry as no longer available for retest
+    # Mark the old entry as no longer available for retest; losing this race to another
+    # technician means they already started the retest
     old_entry.fail_stored = False
-    db.session.commit()
+    if not commit_entry_changes():
+        flash("This failed test has already been resumed or cleared.", "warning")
+        return redirect(url_for('failed_tests'))
 
     retest_data = old_entry.data.copy()
     retest_data["last_step"] = old_entry.data.get("last_step", 0)
@@ -642,6 +937,7 @@ def retest_failed(entry_id):
     db.session.commit()
 
     session['form_data'] = retest_data.copy()
+    remember_entry_version(new_entry)
     return redirect(url_for('form', step=retest_data["last_step"]))
 
 @app.route('/clear_failed/<int:entry_id>', methods=['POST'])
@@ -653,7 +949,8 @@ def clear_failed(entry_id):
     if entry and entry.failure and entry.fail_stored:
         entry.fail_stored = False
         entry.is_finished = True
-        db.session.commit()
+        if not commit_entry_changes():
+            flash("This failed test was changed by someone else; nothing was cleared.", "warning")
 
     return redirect(url_for('failed_tests'))
 
@@ -0,0 +1,209 @@
+"""
+archive.py
+
+Cold-storage tier for old entries.
+
+`flask archive-entries` moves TestEntry rows that are
+- older than `--older-than-days` (default ARCHIVE_AFTER),
+- finished, or failed and cleared/retested (`failure` and no longer `fail_stored`),
+- not saved, not locked,
+from the main database into the `archived_entry` table of the `archive` bind
+(data/archive.db), one zlib-compressed JSON record per entry. The EntryHistory rows of
+those entries move in the same batch as `entry_history` records. DeletedEntry rows older
+than the same age are moved along as `deleted_entry` records.
+
+Retest chains: a parent can only leave test_entry once none of its retests remain there
+(`parent_id` is a foreign key), so each pass archives entries without children left in the
+main table and passes repeat until nothing is eligible; a chain moves leaf first.
+
+Archive rows are written and committed before the source rows are deleted, and re-inserting
+an already archived row is ignored, so an interrupted run is simply repeated.
+
+Read-through: `/history?all_time=true` and `/export_csv?all_time=true` add archived entries
+(rebuilt as transient TestEntry objects) to the rows from the main table. Without
+`all_time` only the main table is read.
+
+Usage:
+    flask --app app archive-entries --dry-run
+    flask --app app archive-entries --older-than-days 365 --batch-size 200
+"""
+
+import json
+import zlib
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select, delete, exists, func
+from sqlalchemy.orm import aliased
+
+from models import db, TestEntry, DeletedEntry, EntryHistory, ArchivedEntry
+from db_engine import upsert_insert
+from constants import ARCHIVE_AFTER
+
+TEST_ENTRY = "test_entry"
+DELETED_ENTRY = "deleted_entry"
+ENTRY_HISTORY = "entry_history"
+SOURCES = {TEST_ENTRY: TestEntry, DELETED_ENTRY: DeletedEntry, ENTRY_HISTORY: EntryHistory}
+
+
+## records
+
+def _pack(table, row):
+    values = {}
+    for column in table.columns:
+        value = row[column.key]
+        values[column.key] = value.isoformat() if isinstance(value, datetime) else value
+    return zlib.compress(json.dumps(values, separators=(",", ":")).encode(), 9)
+
+
+def unpack(archived):
+    """Column values of the archived source row, with datetimes restored."""
+    values = json.loads(zlib.decompress(archived.record))
+    table = SOURCES[archived.kind].__table__
+    for column in table.columns:
+        if isinstance(column.type, db.DateTime) and values.get(column.key):
+            values[column.key] = datetime.fromisoformat(values[column.key])
+    return values
+
+
+def as_entry(archived):
+    """A transient (never added to the session) TestEntry rebuilt from an archive record."""
+    entry = TestEntry(**unpack(archived))
+    entry.archived = True
+    return entry
+
+
+def _serial(data):
+    try:
+        return int((data or {}).get("CM_serial"))
+    except (TypeError, ValueError):
+        return None
+
+
+## moving rows
+
+def _eligible_entries(cutoff):
+    child = aliased(TestEntry)
+    return (
+        select(TestEntry.__table__)
+        .where(
+            TestEntry.timestamp < cutoff,
+            TestEntry.is_saved.isnot(True),
+            TestEntry.lock_owner.is_(None),
+            db.or_(TestEntry.is_finished.is_(True),
+                   db.and_(TestEntry.failure.is_(True), TestEntry.fail_stored.isnot(True))),
+            ~exists().where(child.parent_id == TestEntry.id),
+        )
+        .order_by(TestEntry.id)
+    )
+
+
+def _eligible_deleted(cutoff):
+    return select(DeletedEntry.__table__).where(DeletedEntry.deleted_at < cutoff).order_by(DeletedEntry.id)
+
+
+def _archive_rows(kind, rows):
+    """Insert archive records for `rows` (mappings of source rows), ignoring ones already there."""
+    table = SOURCES[kind].__table__
+    records = []
+    for row in rows:
+        if kind == TEST_ENTRY:
+            entry_id, parent_id, stamp, serial = row["id"], row["parent_id"], row["timestamp"], _serial(row["data"])
+        elif kind == ENTRY_HISTORY:
+            entry_id, parent_id, stamp, serial = row["entry_id"], None, row["timestamp"], None
+        else:
+            entry_id, parent_id, stamp, serial = row["original_entry_id"], None, row["deleted_at"], _serial(row["data"])
+        records.append({
+            "kind": kind, "source_id": row["id"], "entry_id": entry_id, "parent_id": parent_id,
+            "cm_serial": serial, "timestamp": stamp,
+            "archived_at": datetime.utcnow(), "record": _pack(table, row),
+        })
+
+    engine = db.engines[ArchivedEntry.__bind_key__]
+    stmt = upsert_insert(engine)(ArchivedEntry.__table__).on_conflict_do_nothing(index_elements=["kind", "source_id"])
+    if records:
+        with engine.begin() as conn:
+            conn.execute(stmt, records)
+
+
+def archive_old_entries(*, older_than=ARCHIVE_AFTER, batch_size=500, dry_run=False):
+    """Move eligible entries and deleted entries to the archive; returns {kind: count}.
+    With `dry_run` nothing is moved and the counts only cover the first pass, i.e. retest
+    chains count with their newest member."""
+    cutoff = datetime.utcnow() - older_than
+    main = db.engines[TestEntry.__bind_key__]
+    moved = {TEST_ENTRY: 0, DELETED_ENTRY: 0}
+
+    for kind, eligible in ((TEST_ENTRY, _eligible_entries), (DELETED_ENTRY, _eligible_deleted)):
+        source = SOURCES[kind].__table__
+        if dry_run:
+            with main.connect() as conn:
+                moved[kind] = conn.execute(select(func.count()).select_from(eligible(cutoff).subquery())).scalar()
+            continue
+
+        while True:
+            with main.connect() as conn:
+                rows = conn.execute(eligible(cutoff).limit(batch_size)).mappings().all()
+            if not rows:
+                break
+            ids = [row["id"] for row in rows]
+            history = EntryHistory.__table__
+            if kind == TEST_ENTRY:
+                with main.connect() as conn:
+                    _archive_rows(ENTRY_HISTORY, conn.execute(
+                        select(history).where(history.c.entry_id.in_(ids))).mappings().all())
+            _archive_rows(kind, rows)
+            with main.begin() as conn:
+                if kind == TEST_ENTRY:
+                    conn.execute(delete(history).where(history.c.entry_id.in_(ids)))
+                conn.execute(delete(source).where(source.c.id.in_(ids)))
+            moved[kind] += len(rows)
+    return moved
+
+
+## read-through
+
+def archived_entries(unique=False):
+    """Archived TestEntries as transient objects, newest first; with `unique` only the latest
+    per CM serial."""
+    query = db.session.query(ArchivedEntry).filter(ArchivedEntry.kind == TEST_ENTRY)
+    if unique:
+        latest = (
+            db.session.query(ArchivedEntry.cm_serial, func.max(ArchivedEntry.timestamp).label("latest"))
+            .filter(ArchivedEntry.kind == TEST_ENTRY)
+            .group_by(ArchivedEntry.cm_serial)
+            .subquery()
+        )
+        query = query.join(latest, db.and_(ArchivedEntry.cm_serial == latest.c.cm_serial,
+                                           ArchivedEntry.timestamp == latest.c.latest))
+    return [as_entry(archived) for archived in query.order_by(ArchivedEntry.timestamp.desc())]
+
+
+def with_archive(entries, unique=False):
+    """Main-table `entries` plus the archived ones, newest first. With `unique`, keeps the
+    newest entry per CM serial across both (`entries` must already be latest per serial)."""
+    seen = {entry.id for entry in entries}
+    combined = list(entries) + [e for e in archived_entries(unique) if e.id not in seen]
+
+    if unique:
+        newest = {}
+        for entry in combined:
+            serial = _serial(entry.data)
+            if serial not in newest or entry.timestamp > newest[serial].timestamp:
+                newest[serial] = entry
+        combined = list(newest.values())
+    return sorted(combined, key=lambda e: e.timestamp or datetime.min, reverse=True)
+
+
+@click.command("archive-entries")
+@click.option("--older-than-days", default=ARCHIVE_AFTER.days, show_default=True,
+              help="Archive finished or cleared entries older than this.")
+@click.option("--batch-size", default=500, show_default=True, help="Entries moved per transaction.")
+@click.option("--dry-run", is_flag=True, help="Only count what would be archived.")
+@with_appcontext
+def archive_entries_command(older_than_days, batch_size, dry_run):
+    """Move old finished entries and deleted entries into the archive database."""
+    moved = archive_old_entries(older_than=timedelta(days=older_than_days), batch_size=batch_size, dry_run=dry_run)
+    verb = "Would archive at least" if dry_run else "Archived"
+    click.echo(f"{verb} {moved[TEST_ENTRY]} entries and {moved[DELETED_ENTRY]} deleted entries.")
@@ -0,0 +1,316 @@
+"""
+backup.py
+
+Online backups of the SQLite databases into rotated, compressed point-in-time snapshots, and
+restoring one. Copying the database files while a worker writes can capture a torn database;
+these copies never do.
+
+Taking a snapshot (`create_snapshot`), for each database in BACKUP_BINDS:
+- it is copied with SQLite's online backup API (`sqlite3.Connection.backup`), BACKUP_PAGES
+  pages per step with a BACKUP_PAUSE pause after each step, so a writer waits for at most one
+  step (and in WAL mode not at all). The backup API starts over when another connection
+  writes during the copy; after BACKUP_MAX_RESTARTS restarts the copy is finished in one step.
+- the copy is verified with `PRAGMA integrity_check`, hashed (sha256) and gzipped.
+The snapshot also lists the upload files added or changed since the previous snapshot
+(`uploads.json`, from the upload manifest and the files' mtimes), so they can be copied off
+alongside it; the uploads themselves are not in the snapshot. `manifest.json` is written
+last and the snapshot folder is renamed into place only when complete. Only the newest
+BACKUP_KEEP snapshots are kept.
+
+Layout: <BACKUP_FOLDER>/<YYYYmmddTHHMMSSZ>/{main,users,archive}.db.gz, uploads.json, manifest.json
+
+Schedule: jobs.py queues a `backup` background job every BACKUP_INTERVAL (one per interval
+across all workers); `flask backup create` takes one at once, e.g. from cron.
+
+Restoring (`flask backup restore`): the snapshot's copy is decompressed next to the database,
+checked against its checksum and with `PRAGMA integrity_check`, copied over the live
+database with the backup API (so there is never a half-written file) and checked again.
+Stop the app first; its caches and open transactions predate the restore.
+
+Databases on PostgreSQL are skipped (use pg_dump); the metrics database only holds
+instrumentation and is not backed up.
+
+Usage:
+    flask --app app backup create
+    flask --app app backup list
+    flask --app app backup restore                            # newest snapshot, all databases
+    flask --app app backup restore 20250101T060000Z --bind users
+    flask --app app backup restore --at "2025-01-01 12:00"     # newest snapshot taken before (UTC)
+"""
+
+import os
+import gzip
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+
+from models import db, Upload
+from db_engine import online_copy
+from constants import BACKUP_KEEP
+
+BACKUP_BINDS = ("main", "users", "archive")
+BACKUP_PAGES = 256          # pages per step (1 MiB at the default 4 KiB page size)
+BACKUP_PAUSE = 0.01         # seconds after each step, for writers
+BACKUP_MAX_RESTARTS = 20
+CHUNK_SIZE = 1024 * 1024
+STAMP_FORMAT = "%Y%m%dT%H%M%SZ"
+MANIFEST = "manifest.json"
+UPLOADS = "uploads.json"
+
+
+class BackupError(Exception):
+    """A copy or a snapshot failed verification."""
+
+
+def backup_folder():
+    """Where snapshots are kept (`BACKUP_FOLDER` in the app config)."""
+    return current_app.config['BACKUP_FOLDER']
+
+
+def database_path(bind):
+    """File of a SQLite bind, None for any other database."""
+    engine = db.engines[bind]
+    if engine.dialect.name != "sqlite" or not engine.url.database:
+        return None
+    return os.path.abspath(engine.url.database)
+
+
+## copying
+
+def integrity_problems(path):
+    """`PRAGMA integrity_check` messages of a database file; empty if it is sound."""
+    with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as conn:
+        rows = [row[0] for row in conn.execute("PRAGMA integrity_check")]
+    return [] if rows == ["ok"] else rows
+
+
+def _compress(path, gz_path):
+    """gzip `path` into `gz_path`; returns the sha256 of the uncompressed file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as source, gzip.open(gz_path, "wb", compresslevel=6) as target:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            target.write(chunk)
+    return digest.hexdigest()
+
+
+def _decompress(gz_path, path):
+    """Inverse of `_compress`; returns the sha256 of the decompressed file."""
+    digest = hashlib.sha256()
+    with gzip.open(gz_path, "rb") as source, open(path, "wb") as target:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            target.write(chunk)
+    return digest.hexdigest()
+
+
+def _snapshot_database(bind, source_path, folder, progress=None):
+    copy_path = os.path.join(folder, f"{bind}.db")
+    pages = online_copy(source_path, copy_path, pages=BACKUP_PAGES, pause=BACKUP_PAUSE,
+                        max_restarts=BACKUP_MAX_RESTARTS, progress=progress)
+    problems = integrity_problems(copy_path)
+    if problems:
+        raise BackupError(f"{bind}: copy failed integrity_check: {'; '.join(problems[:5])}")
+    size = os.path.getsize(copy_path)
+    sha256 = _compress(copy_path, f"{copy_path}.gz")
+    os.remove(copy_path)
+    return {"file": f"{bind}.db.gz", "source": source_path, "pages": pages, "size": size,
+            "compressed_size": os.path.getsize(f"{copy_path}.gz"), "sha256": sha256}
+
+
+## uploads
+
+def changed_uploads(since, upload_folder):
+    """Upload files added or changed after `since` (naive UTC, None for all): manifest rows
+    uploaded since then plus files on disk with a newer mtime, by path."""
+    query = Upload.query.with_entities(Upload.path, Upload.size, Upload.entry_id)
+    if since is not None:
+        query = query.filter(Upload.uploaded_at > since)
+    files = {path: {"path": path, "size": size, "entry_id": entry_id} for path, size, entry_id in query}
+
+    cutoff = since.replace(tzinfo=timezone.utc).timestamp() if since is not None else None
+    for root, _dirs, names in os.walk(upload_folder):
+        for name in names:
+            full_path = os.path.join(root, name)
+            stat = os.stat(full_path)
+            if cutoff is None or stat.st_mtime > cutoff:
+                path = os.path.relpath(full_path, upload_folder).replace(os.sep, "/")
+                files.setdefault(path, {"path": path, "size": stat.st_size, "entry_id": None})
+    return sorted(files.values(), key=lambda f: f["path"])
+
+
+## snapshots
+
+def list_snapshots(folder):
+    """Manifests of the complete snapshots in `folder`, newest first."""
+    manifests = []
+    for name in sorted(os.listdir(folder), reverse=True) if os.path.isdir(folder) else []:
+        path = os.path.join(folder, name, MANIFEST)
+        if not name.startswith(".") and os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as manifest_file:
+                manifests.append(json.load(manifest_file))
+    return manifests
+
+
+def find_snapshot(folder, name=None, at=None):
+    """The snapshot called `name`, else the newest taken at or before `at` (naive UTC), else
+    the newest; None if there is no such snapshot."""
+    for manifest in list_snapshots(folder):
+        if name is not None:
+            if manifest["name"] == name:
+                return manifest
+        elif at is None or datetime.fromisoformat(manifest["created_at"]) <= at:
+            return manifest
+    return None
+
+
+def rotate(folder, keep=BACKUP_KEEP):
+    """Delete all but the newest `keep` snapshots, and unfinished ones older than a day;
+    returns the names deleted."""
+    removed = [manifest["name"] for manifest in list_snapshots(folder)[keep:]]
+    for name in removed:
+        shutil.rmtree(os.path.join(folder, name), ignore_errors=True)
+    stale = time.time() - 86400
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        if name.startswith(".") and name.endswith(".partial") and os.path.getmtime(path) < stale:
+            shutil.rmtree(path, ignore_errors=True)
+    return removed
+
+
+def create_snapshot(folder, upload_folder, progress=None):
+    """Take a snapshot of every SQLite database in BACKUP_BINDS into `folder` and rotate;
+    returns its manifest. `progress(pages done, pages total)` is called after each step."""
+    started = datetime.utcnow()
+    name = started.strftime(STAMP_FORMAT)
+    while os.path.exists(os.path.join(folder, name)):
+        started += timedelta(seconds=1)
+        name = started.strftime(STAMP_FORMAT)
+    os.makedirs(folder, exist_ok=True)
+    partial = os.path.join(folder, f".{name}.partial")
+    os.makedirs(partial)
+
+    try:
+        databases = {}
+        for bind in BACKUP_BINDS:
+            path = database_path(bind)
+            if path is None:
+                databases[bind] = {"skipped": "not a SQLite database"}
+                continue
+            databases[bind] = _snapshot_database(bind, path, partial, progress)
+
+        previous = find_snapshot(folder)
+        since = datetime.fromisoformat(previous["created_at"]) if previous else None
+        uploads = changed_uploads(since, upload_folder)
+        with open(os.path.join(partial, UPLOADS), "w", encoding="utf-8") as uploads_file:
+            json.dump(uploads, uploads_file, indent=1)
+
+        manifest = {
+            "name": name, "created_at": started.isoformat(),
+            "finished_at": datetime.utcnow().isoformat(timespec="seconds"),
+            "databases": databases,
+            "uploads_since": previous["created_at"] if previous else None,
+            "uploads_changed": len(uploads),
+            "uploads_bytes": sum(f["size"] for f in uploads),
+        }
+        with open(os.path.join(partial, MANIFEST), "w", encoding="utf-8") as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        os.rename(partial, os.path.join(folder, name))
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+    manifest["rotated"] = rotate(folder)
+    return manifest
+
+
+## restoring
+
+def restore_database(folder, manifest, bind):
+    """Replace the live database of `bind` by its copy in snapshot `manifest`, verified before
+    and after; returns the integrity_check result of the restored database."""
+    entry = manifest["databases"].get(bind, {})
+    if "file" not in entry:
+        raise BackupError(f"Snapshot {manifest['name']} has no copy of {bind}.")
+    target_path = database_path(bind)
+    if target_path is None:
+        raise BackupError(f"{bind} is not a SQLite database.")
+
+    staged = f"{target_path}.restore"
+    try:
+        sha256 = _decompress(os.path.join(folder, manifest["name"], entry["file"]), staged)
+        if sha256 != entry["sha256"]:
+            raise BackupError(f"{bind}: checksum mismatch, the snapshot file is damaged.")
+        problems = integrity_problems(staged)
+        if problems:
+            raise BackupError(f"{bind}: snapshot failed integrity_check: {'; '.join(problems[:5])}")
+        with closing(sqlite3.connect(staged)) as source, closing(sqlite3.connect(target_path, timeout=60)) as target:
+            source.backup(target)
+    finally:
+        if os.path.exists(staged):
+            os.remove(staged)
+    problems = integrity_problems(target_path)
+    if problems:
+        raise BackupError(f"{bind}: restored database failed integrity_check: {'; '.join(problems[:5])}")
+    return "ok"
+
+
+backup_cli = AppGroup("backup", help="Online database snapshots.")
+
+
+def _size(num_bytes):
+    return f"{num_bytes / 1024 ** 2:.1f} MiB"
+
+
+@backup_cli.command("create")
+def create_command():
+    """Take a snapshot of the databases now."""
+    manifest = create_snapshot(backup_folder(), current_app.config['UPLOAD_FOLDER'])
+    click.echo(f"Snapshot {manifest['name']}:")
+    for bind, entry in manifest["databases"].items():
+        if "file" in entry:
+            click.echo(f"  {bind}: {_size(entry['size'])} -> {_size(entry['compressed_size'])}")
+        else:
+            click.echo(f"  {bind}: skipped ({entry['skipped']})")
+    click.echo(f"  {manifest['uploads_changed']} uploads changed ({_size(manifest['uploads_bytes'])}), see {UPLOADS}")
+    if manifest["rotated"]:
+        click.echo(f"  rotated out: {', '.join(manifest['rotated'])}")
+
+
+@backup_cli.command("list")
+def list_command():
+    """List the snapshots, newest first."""
+    for manifest in list_snapshots(backup_folder()):
+        sizes = sum(entry.get("compressed_size", 0) for entry in manifest["databases"].values())
+        click.echo(f"{manifest['name']}  {_size(sizes):>10}  {manifest['uploads_changed']} uploads changed")
+
+
+@backup_cli.command("restore")
+@click.argument("name", required=False)
+@click.option("--at", type=click.DateTime(), default=None, help="Newest snapshot taken at or before this time (UTC).")
+@click.option("--bind", "binds", multiple=True, type=click.Choice(BACKUP_BINDS),
+              help="Database to restore (repeatable; default: all in the snapshot).")
+@click.option("--yes", is_flag=True, help="Do not ask for confirmation.")
+def restore_command(name, at, binds, yes):
+    """Restore databases from a snapshot (the newest by default), verifying integrity."""
+    folder = backup_folder()
+    manifest = find_snapshot(folder, name=name, at=at)
+    if manifest is None:
+        raise click.ClickException("No matching snapshot.")
+    binds = binds or [bind for bind, entry in manifest["databases"].items() if "file" in entry]
+    if not yes:
+        click.confirm(f"Overwrite {', '.join(binds)} with snapshot {manifest['name']}? Stop the app first.", abort=True)
+    for bind in binds:
+        try:
+            result = restore_database(folder, manifest, bind)
+        except BackupError as err:
+            raise click.ClickException(str(err)) from err
+        click.echo(f"Restored {bind} from {manifest['name']} (integrity_check: {result}).")
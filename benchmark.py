@@ -0,0 +1,459 @@
+"""
+benchmark.py
+
+End-to-end route benchmark with a simulated technician workload.
+
+N technicians walk through every FormPage of /form, at random saving and resuming from
+the dashboard (/resume/<id>) or failing a page and restarting it from /failed_tests
+(/retest_failed/<id>). Meanwhile M pollers keep loading /history, /dashboard and
+/failed_tests, like the auto-refreshing pages in the lab.
+
+Two drivers:
+- In-process (default): threads with Flask test clients against a throwaway copy of the
+  app in a temporary directory (set through CM_DATABASE_URI / CM_USERS_DATABASE_URI before
+  the app is imported). Also counts SQL statements and "database is locked" errors per route.
+- HTTP (`--url http://host:port`): one process per simulated client against a running
+  gunicorn. SQL counts are not available; lock errors show up as 5xx responses.
+
+Usage:
+    python benchmark.py --technicians 4 --pollers 2 --duration 30 --seed-rows 20000
+    python benchmark.py --url http://localhost:5002 --technicians 8 --duration 60
+    python benchmark.py --compare bench_results/<earlier>.json
+
+Per route the report has p50/p95/p99/max latency, throughput, mean SQL statements per
+request, 5xx errors, lock-contention errors and optimistic-concurrency conflicts. The report
+is saved as JSON under `bench_results/` named after the date and git commit, so results of
+two commits can be compared with `--compare`.
+"""
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.cookiejar import CookieJar
+from datetime import datetime
+
+CONFLICT_MARKERS = (
+    "being edited by someone else",
+    "currently being edited by another user",
+    "changed by someone else",
+    "updated in another tab",
+    "already been resumed or cleared",
+)
+POLL_ROUTES = ["/history", "/dashboard", "/failed_tests"]
+FAIL_REASON = "Benchmark: simulated failure"
+
+
+# ---------------------------------------------------------------- clients
+
+class InProcessClient:
+    """Flask test client that also reports SQL statements and lock errors per request."""
+
+    def __init__(self, app, probe):
+        self.client = app.test_client()
+        self.probe = probe
+
+    def request(self, method, path, data=None, files=None):
+        self.probe.reset()
+        payload = dict(data or {})
+        for name, (filename, content) in (files or {}).items():
+            payload[name] = (io.BytesIO(content), filename)
+        response = self.client.open(path, method=method, data=payload,
+                                    content_type="multipart/form-data" if files else None)
+        return response.status_code, response.location, response.get_data(as_text=True), self.probe.snapshot()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):  # pylint: disable=too-many-positional-arguments
+        return None
+
+
+class HttpClient:
+    """Cookie-keeping urllib client for a live server; redirects are returned, not followed."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(CookieJar()), _NoRedirect)
+
+    @staticmethod
+    def _multipart(data, files):
+        boundary = uuid.uuid4().hex
+        body = io.BytesIO()
+        for name, value in data.items():
+            body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        for name, (filename, content) in files.items():
+            body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                       f'filename="{filename}"\r\nContent-Type: application/octet-stream\r\n\r\n'.encode())
+            body.write(content + b"\r\n")
+        body.write(f"--{boundary}--\r\n".encode())
+        return body.getvalue(), f"multipart/form-data; boundary={boundary}"
+
+    def request(self, method, path, data=None, files=None):
+        body, headers = None, {}
+        if method == "POST":
+            if files:
+                body, headers["Content-Type"] = self._multipart(data or {}, files)
+            else:
+                body = urllib.parse.urlencode(data or {}).encode()
+                headers["Content-Type"] = "application/x-www-form-urlencoded"
+        req = urllib.request.Request(self.base_url + path, data=body, headers=headers, method=method)
+        try:
+            with self.opener.open(req, timeout=120) as response:
+                return response.status, None, response.read().decode(errors="replace"), {}
+        except urllib.error.HTTPError as err:
+            location = err.headers.get("Location")
+            if location:
+                location = urllib.parse.urlsplit(location)._replace(scheme="", netloc="").geturl()
+            return err.code, location, err.read().decode(errors="replace"), {}
+
+
+class Probe:
+    """Thread-local SQL statement and lock-error counters fed by engine / Flask signals."""
+
+    def __init__(self):
+        self.local = threading.local()
+
+    def reset(self):
+        self.local.sql = 0
+        self.local.lock_errors = 0
+
+    def count_sql(self, *_args, **_kwargs):
+        self.local.sql = getattr(self.local, "sql", 0) + 1
+
+    def count_exception(self, _sender, exception, **_kwargs):
+        if "database is locked" in str(exception) or "database table is locked" in str(exception):
+            self.local.lock_errors = getattr(self.local, "lock_errors", 0) + 1
+
+    def snapshot(self):
+        return {"sql": getattr(self.local, "sql", 0), "lock_errors": getattr(self.local, "lock_errors", 0)}
+
+
+# ---------------------------------------------------------------- workload
+
+class Session:
+    """One simulated browser; records a sample for every request it makes."""
+
+    def __init__(self, client, rng):
+        self.client = client
+        self.rng = rng
+        self.samples = []
+
+    def call(self, label, method, path, data=None, files=None):
+        start = time.perf_counter()
+        status, location, text, probe = self.client.request(method, path, data, files)
+        self.samples.append({
+            "route": label,
+            "ms": (time.perf_counter() - start) * 1000.0,
+            "status": status,
+            "sql": probe.get("sql"),
+            "lock_errors": probe.get("lock_errors", 0) + (1 if status >= 500 and not probe else 0),
+            "conflict": any(marker in text for marker in CONFLICT_MARKERS),
+        })
+        return status, location, text
+
+    def login(self, username, password):
+        self.call("register POST", "POST", "/register", {"username": username, "password": password})
+        self.call("login POST", "POST", "/login", {"username": username, "password": password})
+
+
+def _step_from(location):
+    match = re.search(r"step=(\d+)", location or "")
+    return int(match.group(1)) if match else 0
+
+
+def _row_id(html, serial, action):
+    """Find the entry id behind the `action` button in the table row of CM `serial`."""
+    for row in html.split("<tr>")[1:]:
+        if re.search(rf"(CM)?{serial}\s*<", row):
+            match = re.search(rf"/{action}/(\d+)", row)
+            if match:
+                return int(match.group(1))
+    return None
+
+
+class Technician:
+    """Walks CMs through the form: finish, save+resume, or fail+retest."""
+
+    def __init__(self, session, pages, values, serial_range):
+        self.session = session
+        self.pages = pages
+        self.values = values
+        self.serial_range = serial_range
+
+    def _page_payload(self, step, serial):
+        data, files = {}, {}
+        for field in self.pages[step]:
+            if field.type_field == "file":
+                files[field.name] = (f"{field.name}.pdf", b"%PDF-1.4 benchmark upload\n")
+            else:
+                data[field.name] = self.values.field_value(field, serial, datetime.now())
+        return data, files
+
+    def _start(self):
+        """Start a new CM (or pick up the form the server says we still hold); returns (serial, step)."""
+        status, location, _ = self.session.call("form GET", "GET", "/form")
+        if status == 302 and _step_from(location) > 0:
+            return None, _step_from(location)
+        for _ in range(10):
+            serial = self.session.rng.randint(*self.serial_range)
+            status, location, _ = self.session.call("form POST (serial)", "POST", "/form?step=0",
+                                                     {"CM_serial": str(serial)})
+            if status == 302:
+                return serial, _step_from(location)
+        return None, None
+
+    def run_attempt(self):
+        serial, step = self._start()
+        if step is None:
+            return
+        scenario = self.session.rng.choices(["finish", "save", "fail"], weights=[70, 15, 15])[0]
+        stop_at = self.session.rng.randint(1, len(self.pages) - 1)
+
+        while step is not None and step < len(self.pages):
+            self.session.call("form GET", "GET", f"/form?step={step}")
+            data, files = self._page_payload(step, serial or 0)
+
+            if scenario == "save" and step == stop_at and serial:
+                data["save_exit"] = "true"
+                self.session.call("form POST (save)", "POST", f"/form?step={step}", data, files)
+                _, _, html = self.session.call("dashboard GET", "GET", "/dashboard")
+                entry_id = _row_id(html, serial, "resume")
+                if entry_id is None:
+                    return
+                status, location, _ = self.session.call("resume_entry POST", "POST", f"/resume/{entry_id}")
+                step, scenario = (_step_from(location), "finish") if status == 302 else (None, scenario)
+                continue
+
+            if scenario == "fail" and step == stop_at and serial:
+                data.update(fail_test="true", fail_reason=FAIL_REASON)
+                self.session.call("form POST (fail)", "POST", f"/form?step={step}", data, files)
+                _, _, html = self.session.call("failed_tests GET", "GET", "/failed_tests")
+                entry_id = _row_id(html, serial, "retest_failed")
+                if entry_id is None:
+                    return
+                status, location, _ = self.session.call("retest_failed POST", "POST", f"/retest_failed/{entry_id}")
+                step, scenario = (_step_from(location), "finish") if status == 302 else (None, scenario)
+                continue
+
+            status, location, _ = self.session.call("form POST", "POST", f"/form?step={step}", data, files)
+            # a redirect moves to the next page; anything else is the completion page,
+            # a conflict notice or re-rendered validation errors and ends this attempt
+            step = _step_from(location) if status == 302 and _step_from(location) > step else None
+
+
+def run_client(role, index, make_client, *, deadline, seed, pages, values, serial_range):
+    """Body of one simulated client; returns its samples."""
+    rng = random.Random(f"{seed}-{role}-{index}")
+    session = Session(make_client(), rng)
+    session.login(f"bench_{role}{index:02d}", "benchmark")
+
+    if role == "tech":
+        technician = Technician(session, pages, values, serial_range)
+        while time.monotonic() < deadline:
+            technician.run_attempt()
+    else:
+        while time.monotonic() < deadline:
+            route = rng.choice(POLL_ROUTES)
+            session.call(f"{route.strip('/')} GET", "GET", route)
+            time.sleep(rng.uniform(0.0, 0.2))
+    return session.samples
+
+
+def _http_process(args):
+    role, index, url, duration, seed, serial_range = args
+    from datagen import EntryGenerator  # pylint: disable=import-outside-toplevel
+    values = EntryGenerator(seed=seed, start=datetime.now(), failure_rate=0, retest_rate=0,
+                            saved_rate=0, locked_rate=0)
+    deadline = time.monotonic() + duration
+    return run_client(role, index, lambda: HttpClient(url), deadline=deadline, seed=seed,
+                      pages=values.pages, values=values, serial_range=serial_range)
+
+
+# ---------------------------------------------------------------- drivers
+
+def run_in_process(options):
+    workdir = tempfile.mkdtemp(prefix="cm_bench_")
+    os.environ["CM_DATABASE_URI"] = f"sqlite:///{os.path.join(workdir, 'test.db')}"
+    os.environ["CM_USERS_DATABASE_URI"] = f"sqlite:///{os.path.join(workdir, 'users.db')}"
+    os.environ["CM_METRICS_DATABASE_URI"] = f"sqlite:///{os.path.join(workdir, 'metrics.db')}"
+
+    # the app reads its database URIs at import time, so it is only imported here
+    # pylint: disable=import-outside-toplevel
+    from flask import got_request_exception
+    from sqlalchemy import event
+    from app import app
+    from models import db
+    from datagen import EntryGenerator, insert_entries
+    from constants import SERIAL_MIN, SERIAL_MAX
+
+    app.config["UPLOAD_FOLDER"] = os.path.join(workdir, "uploads")
+    app.config["PROPAGATE_EXCEPTIONS"] = False
+    os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
+
+    if options.seed_rows:
+        with app.app_context():
+            seeder = EntryGenerator(seed=options.seed, start=datetime(2025, 1, 1), failure_rate=0.15,
+                                    retest_rate=0.8, saved_rate=0.05, locked_rate=0.3)
+            insert_entries(seeder, options.seed_rows, SERIAL_MIN, SERIAL_MAX)
+
+    probe = Probe()
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if key is None or not key.startswith("metrics"):   # not the metrics flushes
+                event.listen(engine, "before_cursor_execute", probe.count_sql)
+    got_request_exception.connect(probe.count_exception, app)
+
+    values = EntryGenerator(seed=options.seed, start=datetime.now(), failure_rate=0, retest_rate=0,
+                            saved_rate=0, locked_rate=0)
+    deadline = time.monotonic() + options.duration
+    results = []
+    lock = threading.Lock()
+
+    def worker(role, index):
+        samples = run_client(role, index, lambda: InProcessClient(app, probe), deadline=deadline,
+                             seed=options.seed, pages=values.pages, values=values,
+                             serial_range=(SERIAL_MIN, SERIAL_MAX))
+        with lock:
+            results.extend(samples)
+
+    threads = [threading.Thread(target=worker, args=("tech", i)) for i in range(options.technicians)]
+    threads += [threading.Thread(target=worker, args=("poll", i)) for i in range(options.pollers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def run_http(options):
+    from constants import SERIAL_MIN, SERIAL_MAX  # pylint: disable=import-outside-toplevel
+    jobs = [("tech", i, options.url, options.duration, options.seed, (SERIAL_MIN, SERIAL_MAX))
+            for i in range(options.technicians)]
+    jobs += [("poll", i, options.url, options.duration, options.seed, (SERIAL_MIN, SERIAL_MAX))
+             for i in range(options.pollers)]
+    with multiprocessing.Pool(len(jobs)) as pool:
+        return [sample for samples in pool.map(_http_process, jobs) for sample in samples]
+
+
+# ---------------------------------------------------------------- report
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100.0 * len(sorted_values) + 0.5) - 1))
+    return sorted_values[rank]
+
+
+def summarize(samples, duration):
+    by_route = {}
+    for sample in samples:
+        by_route.setdefault(sample["route"], []).append(sample)
+
+    routes = {}
+    for route, route_samples in sorted(by_route.items()):
+        latencies = sorted(s["ms"] for s in route_samples)
+        sql = [s["sql"] for s in route_samples if s["sql"] is not None]
+        routes[route] = {
+            "requests": len(route_samples),
+            "throughput_rps": round(len(route_samples) / duration, 2),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "max_ms": round(latencies[-1], 2),
+            "sql_per_request": round(sum(sql) / len(sql), 2) if sql else None,
+            "errors_5xx": sum(1 for s in route_samples if s["status"] >= 500),
+            "lock_errors": sum(s["lock_errors"] for s in route_samples),
+            "conflicts": sum(1 for s in route_samples if s["conflict"]),
+        }
+    totals = {
+        "requests": len(samples),
+        "throughput_rps": round(len(samples) / duration, 2),
+        "errors_5xx": sum(r["errors_5xx"] for r in routes.values()),
+        "lock_errors": sum(r["lock_errors"] for r in routes.values()),
+        "conflicts": sum(r["conflicts"] for r in routes.values()),
+    }
+    return routes, totals
+
+
+def git_commit():
+    try:
+        sha = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True,
+                                      cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], text=True,
+                                             cwd=os.path.dirname(os.path.abspath(__file__))).strip())
+        return sha, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+
+
+def print_report(report, baseline=None):
+    header = f"{'route':28} {'n':>6} {'rps':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'sql':>6} {'5xx':>4} {'lock':>5} {'conf':>5}"
+    print(header)
+    print("-" * len(header))
+    for route, stats in report["routes"].items():
+        line = (f"{route:28} {stats['requests']:>6} {stats['throughput_rps']:>7} {stats['p50_ms']:>8} "
+                f"{stats['p95_ms']:>8} {stats['p99_ms']:>8} {str(stats['sql_per_request']):>6} "
+                f"{stats['errors_5xx']:>4} {stats['lock_errors']:>5} {stats['conflicts']:>5}")
+        before = (baseline or {}).get("routes", {}).get(route)
+        if before and before["p95_ms"]:
+            line += f"   p95 {100.0 * (stats['p95_ms'] - before['p95_ms']) / before['p95_ms']:+.0f}%"
+        print(line)
+    print(f"\ntotal: {report['totals']}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--technicians", type=int, default=4)
+    parser.add_argument("--pollers", type=int, default=2)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--seed-rows", type=int, default=0, help="pre-fill with generated entries (in-process only)")
+    parser.add_argument("--url", help="benchmark a running server over HTTP instead of in-process")
+    parser.add_argument("--output", default="bench_results", help="directory for the JSON report")
+    parser.add_argument("--compare", help="earlier JSON report to show p95 changes against")
+    options = parser.parse_args(argv)
+
+    started = time.monotonic()
+    samples = run_http(options) if options.url else run_in_process(options)
+    elapsed = time.monotonic() - started
+
+    routes, totals = summarize(samples, elapsed)
+    sha, dirty = git_commit()
+    report = {
+        "commit": sha,
+        "dirty": dirty,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "config": {k: v for k, v in vars(options).items() if k not in ("output", "compare")},
+        "duration_s": round(elapsed, 2),
+        "routes": routes,
+        "totals": totals,
+    }
+
+    baseline = None
+    if options.compare:
+        with open(options.compare, "r", encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+    print_report(report, baseline)
+
+    os.makedirs(options.output, exist_ok=True)
+    path = os.path.join(options.output, f"{datetime.now():%Y%m%d-%H%M%S}-{sha}{'-dirty' if dirty else ''}.json")
+    with open(path, "w", encoding="utf-8") as report_file:
+        json.dump(report, report_file, indent=2)
+    print(f"report written to {path}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""
+bulk_entries.py
+
+Set-based admin operations on many TestEntries at once, used by `POST /admin/bulk/<action>`.
+
+Actions:
+- delete: copy the entries into DeletedEntry and delete them (retests of a deleted entry are
+  detached, users holding one as their open form are released)
+- unlock: clear `lock_owner` / `lock_acquired_at`
+- clear_failed: mark stored failures as cleared, like `/clear_failed/<id>`
+- restore: move DeletedEntry rows back into test_entry (ids are DeletedEntry ids). A failed
+  entry comes back as a failure pending retest, anything else as a saved form, or finished if
+  its last_step is past the last page; the dummy (`test`) flag is kept. The original id is
+  reused when it is still free (else its uploads move to the new id). Entries whose CM serial already has a saved form or
+  pending failure are skipped.
+
+Targets are either explicit ids or a filter (`selection_from_filter`): serial range, status
+(saved / locked / failed / finished / inprogress), date range on the timestamp (deleted_at
+for restore) and dummy-only. At most BULK_MAX rows per request.
+
+Each action runs in one transaction on the main bind with UPDATE/DELETE ... RETURNING, so the
+rows reported as changed are exactly the rows that were changed, and returns {id: outcome}.
+Bulk writes bump `version`, so technicians with the form open get the usual conflict message,
+and are recorded in EntryHistory (`entry_history.record_bulk`) and, for clears, the daily
+rollups (`rollups.add_events`) in the same transaction.
+
+A delete also releases the users holding a deleted entry as their open form (`User.form_id`).
+The users bind is a separate database, so that UPDATE cannot share the main transaction: it
+runs before the single `commit()`, and any failure rolls back both. Only a crash between
+the two databases' commits can leave them out of step.
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, delete, insert
+
+from models import db, User, TestEntry, DeletedEntry, Upload, json_key
+from form_config import FORMS_NON_DICT
+from queries import serial_in_use
+from entry_history import record_bulk, delete_history
+from measurements import write_measurements
+from fleet import invalidate_fleet
+from search import index_entries, session_connection, available as search_available
+from rollups import add_events
+
+BULK_MAX = 5000
+ACTIONS = ("delete", "unlock", "clear_failed", "restore")
+STATUSES = ("saved", "locked", "failed", "finished", "inprogress")
+
+DONE = {"delete": "deleted", "unlock": "unlocked", "clear_failed": "cleared", "restore": "restored"}
+NOT_FOUND = "not found"
+
+
+def _parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d") if value else None
+
+
+def selection_from_filter(action, criteria):
+    """Ids (TestEntry ids, or DeletedEntry ids for restore) matching `criteria`, a dict with
+    optional serial_min, serial_max, status, since, until (YYYY-MM-DD) and test_only.
+    Raises ValueError on a malformed filter."""
+    model = DeletedEntry if action == "restore" else TestEntry
+    stamp = DeletedEntry.deleted_at if action == "restore" else TestEntry.timestamp
+    serial = json_key(model.data, "CM_serial", as_integer=True)
+    query = select(model.id).order_by(model.id).limit(BULK_MAX)
+
+    if criteria.get("serial_min"):
+        query = query.where(serial >= int(criteria["serial_min"]))
+    if criteria.get("serial_max"):
+        query = query.where(serial <= int(criteria["serial_max"]))
+    since, until = _parse_date(criteria.get("since")), _parse_date(criteria.get("until"))
+    if since:
+        query = query.where(stamp >= since)
+    if until:
+        query = query.where(stamp < until + timedelta(days=1))
+
+    status = criteria.get("status")
+    if status and action != "restore":
+        if status not in STATUSES:
+            raise ValueError(f"Unknown status {status!r}")
+        query = query.where({
+            "saved": TestEntry.is_saved.is_(True),
+            "locked": TestEntry.lock_owner.isnot(None),
+            "failed": db.and_(TestEntry.failure.is_(True), TestEntry.fail_stored.is_(True)),
+            "finished": TestEntry.is_finished.is_(True),
+            "inprogress": db.and_(TestEntry.is_finished.isnot(True), TestEntry.is_saved.isnot(True),
+                                  TestEntry.failure.isnot(True)),
+        }[status])
+    if criteria.get("test_only"):
+        query = query.where(model.test.is_(True))
+
+    if not any(criteria.get(k) for k in ("serial_min", "serial_max", "since", "until", "status", "test_only")):
+        raise ValueError("Empty filter; select entries or give at least one condition.")
+    return list(db.session.scalars(query))
+
+
+def _existing(model, ids):
+    return set(db.session.scalars(select(model.id).where(model.id.in_(ids))))
+
+
+def _outcomes(ids, changed, done, existing, otherwise):
+    return {i: done if i in changed else (otherwise if i in existing else NOT_FOUND) for i in ids}
+
+
+def _unlock(ids, _admin):
+    table = TestEntry.__table__
+    changed = set(db.session.scalars(
+        update(table)
+        .where(table.c.id.in_(ids), table.c.lock_owner.isnot(None))
+        .values(lock_owner=None, lock_acquired_at=None, version=table.c.version + 1)
+        .returning(table.c.id)
+    ))
+    return _outcomes(ids, changed, DONE["unlock"], _existing(TestEntry, ids), "not locked")
+
+
+def _clear_failed(ids, admin):
+    table = TestEntry.__table__
+    rows = db.session.execute(
+        update(table)
+        .where(table.c.id.in_(ids), table.c.failure.is_(True), table.c.fail_stored.is_(True))
+        .values(fail_stored=False, is_finished=True, version=table.c.version + 1)
+        .returning(*table.c)
+    ).mappings().all()
+    record_bulk(rows, admin, {"state": {"fail_stored": False, "is_finished": True}})
+    add_events(session_connection(db.session), [({**row, "fail_stored": True, "is_finished": False}, row) for row in rows])
+    changed = {row["id"] for row in rows}
+    return _outcomes(ids, changed, DONE["clear_failed"], _existing(TestEntry, ids), "no pending failure")
+
+
+def _delete(ids, admin):
+    table = TestEntry.__table__
+    # retests of deleted entries stay, without their parent (as the ORM delete in delete_form does)
+    db.session.execute(
+        update(table)
+        .where(table.c.parent_id.in_(ids), table.c.id.notin_(ids))
+        .values(parent_id=None, version=table.c.version + 1)
+    )
+    delete_history(ids)
+    rows = db.session.execute(delete(table).where(table.c.id.in_(ids)).returning(*table.c)).mappings().all()
+
+    now = datetime.utcnow()
+    if rows:
+        db.session.execute(insert(DeletedEntry), [
+            {"original_entry_id": row["id"], "deleted_by": admin, "deleted_at": now, "data": row["data"],
+             "contributors": row["contributors"], "fail_reason": row["fail_reason"],
+             "failure": row["failure"], "was_locked": row["lock_owner"], "test": row["test"]}
+            for row in rows
+        ])
+    return _outcomes(ids, {row["id"] for row in rows}, DONE["delete"], set(), NOT_FOUND)
+
+
+def _restored_flags(row):
+    if row["failure"]:
+        return {"failure": True, "fail_stored": True, "is_saved": False, "is_finished": False}
+    try:
+        finished = int((row["data"] or {}).get("last_step", 0)) >= len(FORMS_NON_DICT)
+    except (TypeError, ValueError):
+        finished = False
+    return {"failure": False, "fail_stored": False, "is_saved": not finished, "is_finished": finished}
+
+
+def _restore(ids, admin):
+    table = DeletedEntry.__table__
+    candidates = db.session.execute(select(table).where(table.c.id.in_(ids))).mappings().all()
+    outcomes = {i: NOT_FOUND for i in ids}
+    restorable, claimed = [], set()
+    for row in sorted(candidates, key=lambda r: r["deleted_at"] or datetime.min, reverse=True):
+        serial = (row["data"] or {}).get("CM_serial")
+        if serial and (serial in claimed or serial_in_use(serial).first() is not None):
+            outcomes[row["id"]] = f"CM{serial} already has a saved form or pending failure"
+        else:
+            restorable.append(row["id"])
+            claimed.add(serial)
+
+    # the DELETE decides: a row restored concurrently by someone else is not restored twice
+    rows = db.session.execute(delete(table).where(table.c.id.in_(restorable)).returning(*table.c)).mappings().all()
+    taken = _existing(TestEntry, [row["original_entry_id"] for row in rows if row["original_entry_id"]])
+    now = datetime.utcnow()
+    restored = []
+    for row in rows:
+        values = {"timestamp": now, "created_at": now, "data": row["data"], "fail_reason": row["fail_reason"],
+                  "contributors": list(row["contributors"] or []), "test": bool(row["test"]), **_restored_flags(row)}
+        if row["original_entry_id"] and row["original_entry_id"] not in taken:
+            values["id"] = row["original_entry_id"]
+        new_id = db.session.execute(insert(TestEntry.__table__).returning(TestEntry.id), values).scalar_one()
+        restored.append({**values, "id": new_id})
+        if row["original_entry_id"] and new_id != row["original_entry_id"]:
+            # keep the uploads attached, or the upload GC would see them as orphaned
+            Upload.query.filter_by(entry_id=row["original_entry_id"]).update(
+                {"entry_id": new_id}, synchronize_session=False)
+        outcomes[row["id"]] = DONE["restore"]
+    record_bulk(restored, admin)
+    write_measurements(db.session, [(values["id"], values["data"]) for values in restored])
+    if search_available(db.engines[TestEntry.__bind_key__]):
+        index_entries(session_connection(db.session), [(v["id"], v["data"], v["fail_reason"], v["contributors"]) for v in restored])
+    return outcomes
+
+
+def _release_users(outcomes):
+    """Users whose open form was deleted must not keep pointing at it."""
+    deleted = [i for i, outcome in outcomes.items() if outcome == DONE["delete"]]
+    if deleted:
+        User.query.filter(User.form_id.in_(deleted)).update({"form_id": None}, synchronize_session=False)
+
+
+def run_bulk(action, ids, admin):
+    """Apply `action` to `ids` in one transaction (per database); returns {id: outcome}."""
+    if action not in ACTIONS:
+        raise ValueError(f"Unknown bulk action {action!r}")
+    ids = sorted({int(i) for i in ids})[:BULK_MAX]
+    if not ids:
+        return {}
+
+    handler = {"delete": _delete, "unlock": _unlock, "clear_failed": _clear_failed, "restore": _restore}[action]
+    try:
+        outcomes = handler(ids, admin)
+        if action == "delete":
+            _release_users(outcomes)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    invalidate_fleet()
+    return outcomes
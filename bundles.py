@@ -0,0 +1,191 @@
+"""
+bundles.py
+
+Traveler bundles for shipping CMs: a ZIP with the complete test record of a CM and every
+file uploaded for it, built while it is sent.
+
+Per CM serial, under `CM<serial>/`:
+- traveler.html: every attempt (first test and all retests, archived ones included) with
+  status, contributors, fail reason and the answers of every form page
+- traveler.json: the same as JSON, plus the bundled and missing files
+- files/: every upload referenced by a file field of an attempt or recorded for one in the
+  upload manifest
+
+Streaming: the ZIP is written into a sink that is drained after every piece, and the sink is
+not seekable, so zipfile writes data descriptors instead of seeking back. Files are copied
+in CHUNK_SIZE pieces; memory stays at about one chunk (plus the ZIP's central directory)
+however large the bundle is, and nothing is written to disk.
+
+`/cm/<serial>/bundle` streams one CM, `/cm/bundle?serial_min=&serial_max=` up to
+BULK_MAX_SERIALS CMs (those with entries) in one ZIP.
+"""
+
+import io
+import os
+import json
+import zipfile
+from datetime import datetime
+
+from flask import render_template
+
+from models import db, Upload, ArchivedEntry
+from form_config import FORMS_NON_DICT
+from archive import as_entry, TEST_ENTRY
+from queries import lineage, cm_serial as cm_serial_column
+from uploads import upload_path
+from utils import entry_status
+
+CHUNK_SIZE = 256 * 1024
+BULK_MAX_SERIALS = 200
+
+
+class ZipSink(io.RawIOBase):
+    """Write-only, unseekable target for zipfile that hands out what was written so far."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        """Bytes written since the last drain."""
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+## collecting
+
+def cm_entries(cm_serial):
+    """Every attempt at a CM, from the main table (one recursive query) and the archive,
+    oldest first, with its retest depth."""
+    rows = [tuple(row) for row in lineage(cm_serial)]
+    seen = {entry.id for entry, _ in rows}
+    archived = [as_entry(a) for a in ArchivedEntry.query.filter_by(kind=TEST_ENTRY, cm_serial=cm_serial)]
+    archived = [entry for entry in archived if entry.id not in seen]
+    if archived:
+        parents = {entry.id: entry.parent_id for entry, _ in rows}
+        parents.update({entry.id: entry.parent_id for entry in archived})
+
+        def depth(entry_id):
+            steps = 0
+            while parents.get(entry_id) in parents and steps < len(parents):
+                entry_id, steps = parents[entry_id], steps + 1
+            return steps
+
+        rows = [(entry, depth(entry.id)) for entry, _ in rows] + [(entry, depth(entry.id)) for entry in archived]
+    return sorted(rows, key=lambda row: (row[0].timestamp or datetime.min, row[0].id))
+
+
+def serials_in_range(serial_min, serial_max):
+    """CM serials in [serial_min, serial_max] with entries (main table or archive), at most
+    BULK_MAX_SERIALS."""
+    column = cm_serial_column()
+    serials = {s for (s,) in db.session.query(column).filter(column.between(serial_min, serial_max)).distinct()}
+    serials.update(s for (s,) in db.session.query(ArchivedEntry.cm_serial).filter(
+        ArchivedEntry.kind == TEST_ENTRY, ArchivedEntry.cm_serial.between(serial_min, serial_max)).distinct())
+    return sorted(serials)[:BULK_MAX_SERIALS]
+
+
+def _file_fields():
+    return {field.name for page in FORMS_NON_DICT for field in page.fields if field.type_field == "file"}
+
+
+def traveler(cm_serial, rows):
+    """The traveler record of a CM: attempts with their answers grouped by form page."""
+    attempts = []
+    for entry, depth in rows:
+        data = entry.data or {}
+        pages = []
+        for index, page in enumerate(FORMS_NON_DICT):
+            answers = [
+                {"name": field.name, "label": field.label, "type": field.type_field, "value": data[field.name]}
+                for field in page.fields
+                if field.name and field.name in data and data[field.name] not in (None, "")
+            ]
+            if answers:
+                pages.append({"page": index, "label": page.label, "answers": answers})
+        attempts.append({
+            "entry_id": entry.id, "parent_id": entry.parent_id, "depth": depth,
+            "archived": bool(getattr(entry, "archived", False)), "status": entry_status(entry),
+            "created_at": entry.created_at.isoformat() if entry.created_at else None,
+            "timestamp": entry.timestamp.isoformat() if entry.timestamp else None,
+            "contributors": entry.contributors or [], "fail_reason": entry.fail_reason, "pages": pages,
+        })
+    return {"cm_serial": cm_serial, "attempts": attempts}
+
+
+def bundle_files(rows):
+    """Upload paths (relative to the upload folder) belonging to the attempts, sorted."""
+    file_fields = _file_fields()
+    paths = {
+        value for entry, _ in rows for name, value in (entry.data or {}).items()
+        if name in file_fields and isinstance(value, str) and value
+    }
+    ids = [entry.id for entry, _ in rows]
+    if ids:
+        paths.update(path for (path,) in Upload.query.with_entities(Upload.path).filter(Upload.entry_id.in_(ids)))
+    return sorted(paths)
+
+
+## streaming
+
+def _write_bytes(archive, sink, name, data):
+    archive.writestr(zipfile.ZipInfo(name, datetime.now().timetuple()[:6]), data, compress_type=zipfile.ZIP_DEFLATED)
+    yield sink.drain()
+
+
+def _write_file(archive, sink, name, full_path):
+    info = zipfile.ZipInfo.from_file(full_path, name)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    with open(full_path, "rb") as source, archive.open(info, "w") as target:
+        while True:
+            chunk = source.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            target.write(chunk)
+            yield sink.drain()
+    yield sink.drain()
+
+
+def _write_cm(archive, sink, cm_serial, upload_folder):
+    rows = cm_entries(cm_serial)
+    record = traveler(cm_serial, rows)
+    folder = f"CM{cm_serial}"
+
+    bundled, missing, names = [], [], set()
+    files = []
+    for path in bundle_files(rows):
+        full_path = upload_path(upload_folder, path)
+        if full_path is None or not os.path.isfile(full_path):
+            missing.append(path)
+            continue
+        name = os.path.basename(path)
+        while name in names:        # same file name in two folders
+            name = f"_{name}"
+        names.add(name)
+        files.append((f"{folder}/files/{name}", full_path))
+        bundled.append({"path": path, "name": f"files/{name}"})
+
+    record.update(files=bundled, missing_files=missing)
+    html = render_template("traveler.html", record=record, generated=datetime.now().isoformat(timespec="seconds"))
+    yield from _write_bytes(archive, sink, f"{folder}/traveler.html", html.encode())
+    yield from _write_bytes(archive, sink, f"{folder}/traveler.json", json.dumps(record, indent=2).encode())
+    for name, full_path in files:
+        yield from _write_file(archive, sink, name, full_path)
+
+
+def stream_bundle(cm_serials, upload_folder):
+    """Generator of the bytes of one ZIP holding the bundles of `cm_serials`; run it inside the
+    request (`stream_with_context`), it reads the database and renders templates."""
+    sink = ZipSink()
+    with zipfile.ZipFile(sink, "w") as archive:
+        for cm_serial in cm_serials:
+            yield from _write_cm(archive, sink, cm_serial, upload_folder)
+    yield sink.drain()      # central directory
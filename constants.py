@@ -9,6 +9,18 @@ Constants:
 - SERIAL_MAX: Maximum valid CM serial number.
 - LOCK_TIMEOUT: Duration after which a form lock is considered expired and can be reassigned.
 - EASTERN_TZ: Timezone object for Eastern Time, used for date and time handling.
+- USER_CACHE_TTL: How long a worker may reuse a cached User row without re-reading users.db.
+- USER_CACHE_SIZE: Maximum number of User rows cached per worker.
+- LOGIN_THROTTLE_WINDOW: Look-back period for counting failed logins.
+- LOGIN_MAX_FAILURES_PER_USER / LOGIN_MAX_FAILURES_PER_IP: Failed logins within the window
+  after which further attempts are refused before any password hashing is done.
+- ARCHIVE_AFTER: Default age after which finished or cleared entries move to the archive database.
+- UPLOAD_GC_GRACE: Minimum age of an unreferenced upload before the garbage collector deletes it.
+- FLEET_REFRESH: Maximum age of a worker's fleet status board before it is rebuilt from the database.
+- BACKUP_INTERVAL: How often a background job takes a database snapshot (see backup.py).
+- BACKUP_KEEP: Number of snapshots kept; older ones are deleted after each new snapshot.
+- HISTORY_CHECKPOINT_EVERY: An EntryHistory row with the full entry is written every this many changes,
+  so rebuilding any version replays fewer diffs than this.
 """
 
 from datetime import timedelta
@@ -22,3 +34,21 @@ SERIAL_MIN = SERIAL_OFFSET
 LOCK_TIMEOUT = timedelta(minutes=20)   # how long before a stale lock is considered free (not implemented)
 
 EASTERN_TZ = ZoneInfo("America/New_York")
+
+USER_CACHE_TTL = timedelta(minutes=5)
+USER_CACHE_SIZE = 256
+
+LOGIN_THROTTLE_WINDOW = timedelta(minutes=15)
+LOGIN_MAX_FAILURES_PER_USER = 10
+LOGIN_MAX_FAILURES_PER_IP = 50
+
+UPLOAD_GC_GRACE = timedelta(days=7)   # drafts can hold unsaved uploads this long
+
+ARCHIVE_AFTER = timedelta(days=180)
+
+BACKUP_INTERVAL = timedelta(hours=6)
+BACKUP_KEEP = 28    # a week of snapshots at the default interval
+
+HISTORY_CHECKPOINT_EVERY = 20
+
+FLEET_REFRESH = timedelta(minutes=1)
@@ -0,0 +1,218 @@
+"""
+datagen.py
+
+Synthetic TestEntry generator for load testing and benchmarks.
+
+Usage:
+    flask --app app generate-entries --count 1000000 --seed 42
+    flask --app app generate-entries --count 50000 --serial-min 3000 --serial-max 99999 --failure-rate 0.3
+
+Each CM serial gets a realistic chain of attempts: an attempt either finishes, fails on a
+random page (with a reason and a "no" on one of that page's checks) or is left saved
+mid-way, possibly locked by a technician. Failed attempts are retested with `--retest-rate`,
+producing `parent_id` chains exactly like `retest_failed` does. Values follow the field
+types in FORMS_NON_DICT: booleans are mostly "yes", integer/float readings are drawn around
+a per-field nominal value, file fields reference `CM<serial>/...` paths.
+
+Rows are inserted with `executemany` in batches of `--batch-size` and ids are assigned up
+front, so chains can reference their parents without a round trip. Everything is marked
+`test=True`, so /admin/clear_dummy_history removes it again. The same `--seed`, options and
+starting database always produce the same rows.
+
+Core inserts skip the ORM write hooks, so each batch also writes what those hooks would have
+in the same transaction: measurements, the search index, an EntryHistory checkpoint per entry
+and the daily rollups. Afterwards every worker's fleet board is invalidated.
+"""
+
+import random
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import func, select
+
+from models import db, TestEntry
+from form_config import FORMS_NON_DICT
+from constants import SERIAL_MIN, SERIAL_MAX
+from measurements import write_measurements
+from search import create_search_index, index_entries, available as search_available
+from entry_history import record_bulk, SYSTEM_USER
+from rollups import add_events
+from fleet import invalidate_fleet
+
+TECHNICIANS = [f"tech{i:02d}" for i in range(1, 13)]
+FAIL_REASONS = [
+    "IBERT eye diagram closed on FireFly link",
+    "FireFly transceiver not detected over I2C",
+    "3.3V management power did not come up",
+    "Current draw above limit during ramp",
+    "FPGA flash memory verification failed",
+    "DC-DC converter did not respond on I2C",
+    "Clock chip frequency out of tolerance",
+    "Overheating during heater test",
+]
+COMMENTS = ["", "Looks good", "Minor scratch on front panel", "Reseated FireFly", "Rechecked by second technician"]
+
+
+class EntryGenerator:
+    """Deterministic source of TestEntry rows; see the module docstring for the model."""
+
+    def __init__(self, *, seed, start, failure_rate, retest_rate, saved_rate, locked_rate):
+        self.rng = random.Random(seed)
+        self.clock = start
+        self.failure_rate = failure_rate
+        self.retest_rate = retest_rate
+        self.saved_rate = saved_rate
+        self.locked_rate = locked_rate
+        self.pages = [
+            [f for f in page.fields if f.name and f.type_field in ("boolean", "integer", "float", "text", "file")]
+            for page in FORMS_NON_DICT
+        ]
+        # stable per-field nominal readings, independent of the seed so runs are comparable
+        nominal_rng = random.Random("nominal")
+        self.nominal = {
+            f.name: nominal_rng.uniform(0.5, 250.0)
+            for page in self.pages for f in page if f.type_field in ("integer", "float")
+        }
+
+    def _tick(self):
+        self.clock += timedelta(seconds=self.rng.randint(30, 1800))
+        return self.clock
+
+    def field_value(self, field, serial, stamp):
+        """A plausible form value for `field` of CM `serial`, as the form would post it."""
+        rng = self.rng
+        if field.name == "CM_serial":
+            return str(serial)
+        if field.type_field == "boolean":
+            return "yes" if rng.random() < 0.97 else "no"
+        if field.type_field == "integer":
+            return str(max(0, int(rng.gauss(self.nominal[field.name], self.nominal[field.name] * 0.05))))
+        if field.type_field == "float":
+            return f"{rng.gauss(self.nominal[field.name], self.nominal[field.name] * 0.03):.3f}"
+        if field.type_field == "text":
+            return rng.choice(COMMENTS)
+        return f"CM{serial}/{stamp:%Y-%m-%d-%H-%M-%S-%f}_{field.name}.pdf"
+
+    def _data(self, serial, upto_page, stamp, previous=None):
+        data = dict(previous or {})
+        for page in self.pages[:upto_page]:
+            for field in page:
+                data[field.name] = self.field_value(field, serial, stamp)
+        data["last_step"] = upto_page
+        return data
+
+    def chain(self, serial, next_id):
+        """Yield the rows of all attempts for one serial, starting at id `next_id`."""
+        parent = None
+        parent_data = None
+        while True:
+            stamp = self._tick()
+            contributors = self.rng.sample(TECHNICIANS, self.rng.randint(1, 2))
+            row = {
+                "id": next_id, "timestamp": stamp, "created_at": stamp, "test": True,
+                "parent_id": parent, "contributors": contributors, "file_name": None, "version": 1,
+                "failure": False, "fail_reason": None, "fail_stored": False,
+                "is_saved": False, "is_finished": False, "lock_owner": None, "lock_acquired_at": None,
+            }
+            roll = self.rng.random()
+
+            if roll < self.failure_rate:
+                fail_page = self.rng.randint(1, len(self.pages) - 1)
+                data = self._data(serial, fail_page + 1, stamp, parent_data)
+                checks = [f for f in self.pages[fail_page] if f.type_field == "boolean"]
+                if checks:
+                    data[self.rng.choice(checks).name] = "no"
+                data["last_step"] = fail_page
+                retest = self.rng.random() < self.retest_rate
+                cleared = not retest and self.rng.random() < 0.5   # as clear_failed leaves it
+                row.update(data=data, failure=True, fail_reason=self.rng.choice(FAIL_REASONS),
+                           fail_stored=not retest and not cleared, is_finished=cleared)
+                yield row
+                if not retest:
+                    return
+                parent, parent_data, next_id = next_id, data, next_id + 1
+                continue
+
+            if roll < self.failure_rate + self.saved_rate:
+                data = self._data(serial, self.rng.randint(1, len(self.pages) - 1), stamp, parent_data)
+                row.update(data=data, is_saved=True)
+                if self.rng.random() < self.locked_rate:
+                    row.update(lock_owner=contributors[0], lock_acquired_at=stamp)
+                yield row
+                return
+
+            data = self._data(serial, len(self.pages), stamp, parent_data)
+            row.update(data=data, is_finished=True)
+            yield row
+            return
+
+
+def insert_entries(generator, count, serial_min, serial_max, *, batch_size=10000, progress=None, engine=None):
+    """Insert `count` rows from `generator`, cycling through the serial range, into the main
+    bind (or `engine`), with their measurements, search index, history and rollups. Returns
+    the last id inserted; `progress(inserted)` is called after every batch."""
+    table = TestEntry.__table__
+    main = engine is None
+    engine = engine or db.engines[TestEntry.__bind_key__]
+    search = search_available(engine)
+    if search:
+        create_search_index(engine)
+
+    with engine.connect() as conn:
+        next_id = (conn.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+
+    inserted = 0
+    serial = serial_min
+    batch = []
+    while inserted < count:
+        for row in generator.chain(serial, next_id):
+            batch.append(row)
+            next_id += 1
+            inserted += 1
+            if inserted == count:
+                break
+        serial = serial + 1 if serial < serial_max else serial_min
+
+        if len(batch) >= batch_size or inserted == count:
+            # one transaction per batch keeps the WAL (and the write lock) short
+            with engine.begin() as conn:
+                conn.execute(table.insert(), batch)
+                write_measurements(conn, [(row["id"], row["data"]) for row in batch])
+                if search:
+                    index_entries(conn, [(row["id"], row["data"], row["fail_reason"], row["contributors"])
+                                         for row in batch])
+                record_bulk(batch, SYSTEM_USER, conn=conn)
+                add_events(conn, [(None, row) for row in batch])
+            batch = []
+            if progress:
+                progress(inserted)
+
+    if main:
+        invalidate_fleet()
+    return next_id - 1
+
+
+@click.command("generate-entries")
+@click.option("--count", default=1000, show_default=True, help="Number of TestEntry rows to insert.")
+@click.option("--seed", default=0, show_default=True, help="Random seed; same seed, same rows.")
+@click.option("--serial-min", default=SERIAL_MIN, show_default=True)
+@click.option("--serial-max", default=SERIAL_MAX, show_default=True, help="May exceed SERIAL_MAX for load tests.")
+@click.option("--failure-rate", default=0.15, show_default=True, help="Chance an attempt fails.")
+@click.option("--retest-rate", default=0.8, show_default=True, help="Chance a failed attempt is retested.")
+@click.option("--saved-rate", default=0.05, show_default=True, help="Chance an attempt is left saved mid-way.")
+@click.option("--locked-rate", default=0.3, show_default=True, help="Chance a saved attempt is locked.")
+@click.option("--start", default="2025-01-01", show_default=True, help="Timestamp of the first generated entry.")
+@click.option("--batch-size", default=10000, show_default=True, help="Rows per executemany batch.")
+@with_appcontext
+def generate_entries_command(*, count, seed, serial_min, serial_max, failure_rate, retest_rate,
+                             saved_rate, locked_rate, start, batch_size):
+    """Bulk-insert COUNT realistic dummy TestEntry rows."""
+    if serial_max < serial_min:
+        raise click.BadParameter("--serial-max must not be below --serial-min")
+
+    generator = EntryGenerator(seed=seed, start=datetime.fromisoformat(start), failure_rate=failure_rate,
+                               retest_rate=retest_rate, saved_rate=saved_rate, locked_rate=locked_rate)
+    last_id = insert_entries(generator, count, serial_min, serial_max, batch_size=batch_size,
+                             progress=lambda inserted: click.echo(f"\r{inserted}/{count} rows", nl=False))
+    click.echo(f"\nInserted {count} dummy entries (ids up to {last_id}).")
@@ -0,0 +1,343 @@
+"""
+db_engine.py
+
+SQLite engine profile and connection policy for the Apollo CM Test Entry application.
+
+Both `test.db` and `users.db` are shared by every gunicorn worker, so each new DBAPI
+connection is tuned through a SQLAlchemy "connect" event instead of relying on SQLite's
+rollback-journal defaults.
+
+Provides:
+- `SQLITE_PROFILE_DEFAULTS`: Pragmas applied to every connection (WAL, busy_timeout, ...).
+  Override any of them with the `SQLITE_ENGINE_PROFILE` dict in `app.config`.
+- `read_only_binds()`: Builds `<bind>_ro` binds that open the same files with `mode=ro`.
+- `init_engine_profile()`: Installs the pragma hooks on every SQLite engine and disposes
+  inherited connection pools in forked workers (gunicorn `--preload`).
+- `read_only_route`: Decorator for GET views; their queries go through the `_ro` binds.
+- `read_snapshot_binds()` / `read_snapshot_route`: Optional read snapshot (`SQLITE_READ_SNAPSHOT`)
+  for heavy read-only views, see below.
+- `RoutingSession`: `db.session` class that routes reads to the `_ro` (or `_snap`) binds.
+- `online_copy()`: Consistent copy of a live SQLite file with the online backup API.
+- `upsert_insert()`: The dialect's `insert()` (with `on_conflict_do_*`) for a bind.
+
+Read snapshot:
+- `<bind>_snap` opens `<file>.snapshot.db` (e.g. data/test.snapshot.db) with `mode=ro`; the
+  snapshot is a copy of the primary taken with `online_copy`, written to a temporary file and
+  swapped in with an atomic rename, so long readers keep their old copy and never block
+  writers or the next refresh.
+- Views decorated with `read_snapshot_route` (history, export, analytics, ...) read from it
+  while it is at most `SQLITE_READ_SNAPSHOT_MAX_AGE` seconds old, and from the primary's `_ro`
+  bind otherwise; a request that has written (flushed) reads the primary from then on.
+- Such a request also starts a refresh in a background thread once the snapshot is older than
+  half the maximum age; a lock file lets only one worker copy at a time. A worker drops its
+  pooled snapshot connections when it sees a new snapshot file.
+
+Notes:
+- WAL needs shared memory between processes, which network filesystems do not provide.
+  Databases on NFS/CIFS (our `/nfs` deploy) keep `journal_mode=DELETE` and a warning is emitted.
+- Pragmas are only applied to SQLite engines; other backends are left untouched.
+"""
+
+import os
+import time
+import fcntl
+import sqlite3
+import warnings
+import threading
+from contextlib import closing
+from functools import wraps
+from flask import g, has_app_context, request, current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.dialects import postgresql, sqlite
+
+SQLITE_PROFILE_DEFAULTS = {
+    "journal_mode": "WAL",
+    "busy_timeout": 5000,           # ms a connection waits on a lock before "database is locked"
+    "synchronous": "NORMAL",        # safe with WAL, only the last commits can be lost on power cut
+    "cache_size": -16000,           # negative = KiB, i.e. 16 MB page cache per connection
+    "mmap_size": 64 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "foreign_keys": True,
+}
+
+READ_ONLY_SUFFIX = "_ro"
+SNAPSHOT_SUFFIX = "_snap"
+SNAPSHOT_BINDS = ("main",)
+SNAPSHOT_PAGES = 1024       # pages per backup step of a snapshot refresh
+SNAPSHOT_PAUSE = 0.005      # seconds between steps
+
+_snapshot_lock = threading.Lock()
+_snapshot_state = {"refreshing": set(), "seen": {}}     # per worker: paths being refreshed, mtime in use
+
+NETWORK_FILESYSTEMS = {
+    "nfs", "nfs4", "cifs", "smb3", "smbfs", "afs", "ceph", "glusterfs", "lustre", "9p", "fuse.sshfs",
+}
+
+
+def filesystem_type(path):
+    """Return the filesystem type of the mount holding `path` (Linux only, else None)."""
+    path = os.path.realpath(path)
+    best_mount, best_type = "", None
+    try:
+        with open("/proc/mounts", "r", encoding="utf-8") as mounts:
+            for line in mounts:
+                parts = line.split()
+                if len(parts) < 3:
+                    continue
+                mount_point, fs_type = parts[1], parts[2]
+                inside = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+                if inside and len(mount_point) >= len(best_mount):
+                    best_mount, best_type = mount_point, fs_type
+    except OSError:
+        return None
+    return best_type
+
+
+def on_network_filesystem(path):
+    """True if the database at `path` lives on a network filesystem."""
+    fs_type = filesystem_type(os.path.dirname(os.path.abspath(path)))
+    if fs_type is not None:
+        return fs_type in NETWORK_FILESYSTEMS
+    return os.path.abspath(path).startswith("/nfs/")
+
+
+def sqlite_path(url):
+    """Filesystem path of a SQLite URL, or None for in-memory / non-SQLite databases."""
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return None
+    database = url.database
+    if url.query.get("uri"):
+        database = database[len("file:"):] if database.startswith("file:") else database
+    return database
+
+
+def upsert_insert(bind):
+    """`insert()` of the dialect of `bind` (an engine or connection), for INSERT ... ON CONFLICT."""
+    return postgresql.insert if bind.dialect.name == "postgresql" else sqlite.insert
+
+
+def read_only_binds(binds):
+    """Return a `<key>_ro` bind for every SQLite file bind, opened with `mode=ro`."""
+    ro_binds = {}
+    for key, uri in binds.items():
+        path = sqlite_path(make_url(uri))
+        if path:
+            ro_binds[f"{key}{READ_ONLY_SUFFIX}"] = f"sqlite:///file:{path}?mode=ro&uri=true"
+    return ro_binds
+
+
+def snapshot_path(path):
+    """File of the read snapshot of the SQLite database at `path`."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.snapshot{ext or '.db'}"
+
+
+def read_snapshot_binds(binds, keys=SNAPSHOT_BINDS):
+    """Return a `<key>_snap` bind, opened with `mode=ro`, for every SQLite file bind in `keys`.
+    A missing snapshot is created as an empty, expired file, so the bind can always be opened."""
+    snapshot_binds = {}
+    for key in keys:
+        path = sqlite_path(make_url(binds[key])) if key in binds else None
+        if path:
+            if not os.path.exists(snapshot_path(path)):
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+                with open(snapshot_path(path), "ab"):
+                    pass
+                os.utime(snapshot_path(path), (0, 0))
+            snapshot_binds[f"{key}{SNAPSHOT_SUFFIX}"] = f"sqlite:///file:{snapshot_path(path)}?mode=ro&uri=true"
+    return snapshot_binds
+
+
+def _pragma_hook(pragmas, read_only):
+    def apply_pragmas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            if read_only and name == "journal_mode":
+                continue  # can't be changed on a read-only connection
+            if isinstance(value, bool):
+                value = "ON" if value else "OFF"
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    return apply_pragmas
+
+
+def init_engine_profile(app, db):
+    """Attach the configured pragmas to every SQLite engine of `db`."""
+    profile = {**SQLITE_PROFILE_DEFAULTS, **app.config.get("SQLITE_ENGINE_PROFILE", {})}
+
+    with app.app_context():
+        engines = dict(db.engines)
+
+    for key, engine in engines.items():
+        path = sqlite_path(engine.url)
+        if path is None:
+            continue
+
+        pragmas = dict(profile)
+        if str(pragmas.get("journal_mode", "")).upper() == "WAL" and on_network_filesystem(path):
+            warnings.warn(f"{path} is on a network filesystem; refusing WAL and using journal_mode=DELETE",
+                          RuntimeWarning)
+            pragmas["journal_mode"] = "DELETE"
+
+        read_only = (key or "").endswith((READ_ONLY_SUFFIX, SNAPSHOT_SUFFIX))
+        event.listen(engine, "connect", _pragma_hook(pragmas, read_only))
+
+    # a worker forked after the app was imported must not reuse the parent's sqlite handles
+    def dispose_inherited_pools():
+        for engine in engines.values():
+            engine.dispose(close=False)
+
+    os.register_at_fork(after_in_child=dispose_inherited_pools)
+
+
+def read_only_route(view):
+    """Serve the GET/HEAD requests of `view` through the read-only `_ro` binds."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method in ("GET", "HEAD"):
+            g.read_only_db = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+## read snapshot
+
+def online_copy(source_path, target_path, *, pages=-1, pause=0.0, max_restarts=20, progress=None):
+    """Copy the live SQLite database `source_path` to a new file `target_path` with the online
+    backup API, `pages` pages per step and `pause` seconds after each; returns the page count.
+    A copy that writers restarted more than `max_restarts` times is finished in one step. The
+    copy uses journal_mode=DELETE, so it is one self-contained file."""
+    seen = {"remaining": None, "restarts": 0, "total": 0}
+
+    def step(_status, remaining, total):
+        if seen["remaining"] is not None and remaining >= seen["remaining"]:
+            seen["restarts"] += 1       # the source was written to: the copy started over
+            if seen["restarts"] > max_restarts:
+                raise _TooManyRestarts()
+        seen.update(remaining=remaining, total=total)
+        if progress:
+            progress(total - remaining, total)
+        time.sleep(pause)
+
+    with closing(sqlite3.connect(source_path, timeout=30)) as source:
+        try:
+            with closing(sqlite3.connect(target_path)) as target:
+                source.backup(target, pages=pages, progress=step)
+                target.execute("PRAGMA journal_mode=DELETE")
+        except _TooManyRestarts:
+            os.remove(target_path)
+            with closing(sqlite3.connect(target_path)) as target:
+                source.backup(target)
+                target.execute("PRAGMA journal_mode=DELETE")
+    return seen["total"]
+
+
+class _TooManyRestarts(Exception):
+    pass
+
+
+def snapshot_age(path):
+    """Seconds since the snapshot at `path` was taken, None if there is none."""
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def refresh_snapshot(source_path, target_path, max_age=0.0):
+    """Replace the snapshot `target_path` by a fresh copy of `source_path` unless it is at most
+    `max_age` seconds old or another process is refreshing it; True if it was replaced."""
+    with open(f"{target_path}.lock", "a", encoding="utf-8") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        age = snapshot_age(target_path)
+        if age is not None and age <= max_age:
+            return False
+        started = time.time()
+        staged = f"{target_path}.{os.getpid()}.tmp"
+        try:
+            online_copy(source_path, staged, pages=SNAPSHOT_PAGES, pause=SNAPSHOT_PAUSE)
+            os.utime(staged, (started, started))     # its age counts from the start of the copy
+            os.replace(staged, target_path)
+        finally:
+            if os.path.exists(staged):
+                os.remove(staged)
+    return True
+
+
+def _refresh_in_background(source_path, target_path, max_age):
+    try:
+        refresh_snapshot(source_path, target_path, max_age)
+    except (OSError, sqlite3.Error) as err:
+        warnings.warn(f"read snapshot refresh of {source_path} failed: {err}", RuntimeWarning)
+    finally:
+        with _snapshot_lock:
+            _snapshot_state["refreshing"].discard(target_path)
+
+
+def fresh_snapshot_binds():
+    """Keys of the `_snap` binds whose snapshot is fresh enough to read; starts a background
+    refresh of those older than half of SQLITE_READ_SNAPSHOT_MAX_AGE."""
+    if not current_app.config.get("SQLITE_READ_SNAPSHOT"):
+        return set()
+    max_age = current_app.config.get("SQLITE_READ_SNAPSHOT_MAX_AGE", 60)
+    engines = current_app.extensions["sqlalchemy"].engines
+    fresh = set()
+    for key, engine in engines.items():
+        if not (key or "").endswith(SNAPSHOT_SUFFIX):
+            continue
+        path = sqlite_path(engine.url)
+        age = snapshot_age(path)
+        if age is None or age > max_age / 2:
+            with _snapshot_lock:
+                start = path not in _snapshot_state["refreshing"]
+                _snapshot_state["refreshing"].add(path)
+            if start:
+                source = sqlite_path(engines[key[:-len(SNAPSHOT_SUFFIX)]].url)
+                threading.Thread(target=_refresh_in_background, args=(source, path, max_age / 2), daemon=True).start()
+        if age is None or age > max_age:
+            continue
+        mtime = os.path.getmtime(path)
+        with _snapshot_lock:
+            if _snapshot_state["seen"].get(path) != mtime:
+                engine.dispose(close=False)     # pooled connections still read the replaced file
+                _snapshot_state["seen"][path] = mtime
+        fresh.add(key)
+    return fresh
+
+
+def read_snapshot_route(view):
+    """A `read_only_route` whose reads go to the read snapshot binds while they are fresh."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method in ("GET", "HEAD"):
+            g.read_only_db = True
+            g.read_snapshot = fresh_snapshot_binds()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+class RoutingSession(Session):
+    """Flask-SQLAlchemy session that sends reads of a `read_only_route` to the `_ro` binds
+    (of a `read_snapshot_route` to fresh `_snap` binds). Flushes always go to the primary
+    bind, and once a request has flushed its reads do too."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        engine = super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+        if self._flushing:
+            self.info["flushed"] = True
+        if bind is not None or self._flushing or not has_app_context() or not g.get("read_only_db"):
+            return engine
+
+        engines = self._db.engines
+        for key, candidate in engines.items():
+            if candidate is engine:
+                snapshot = f"{key}{SNAPSHOT_SUFFIX}"
+                if snapshot in g.get("read_snapshot", ()) and not self.info.get("flushed"):
+                    return engines[snapshot]
+                return engines.get(f"{key}{READ_ONLY_SUFFIX}", engine)
+        return engine
@@ -0,0 +1,188 @@
+"""
+entry_diff.py
+
+Field-by-field comparison of two TestEntries, typically a retest and the failed attempt it
+retests (`parent`), for reviewers.
+
+The form configuration is compiled once per diff (or batch) into a list of `FieldSpec`s
+with one comparison function per field type:
+- float: equal within FLOAT_ABS_TOL or FLOAT_REL_TOL (relative to the larger magnitude);
+  a difference inside the tolerance is reported as "within_tolerance"
+- integer: numeric equality ("05" == "5")
+- boolean: case-insensitive yes/no
+- text, file: exact string equality (file names carry an upload timestamp, so a re-uploaded
+  report always shows as changed)
+Every field gets a status: same, within_tolerance, changed, added (only in the newer entry)
+or removed (only in the older one).
+
+Diffs between two immutable entries (finished, or failed and retested / cleared) are cached
+per worker, keyed by both ids and row versions, the tolerance and the form configuration
+version (`form_config.forms_version`), so an edited form doesn't serve diffs of the old fields;
+DIFF_CACHE_SIZE bounds it.
+
+`retest_diffs(serial_min, serial_max)` diffs every retest in a serial range against its
+parent, with the parents loaded in the same query (`queries.retest_pairs`).
+"""
+
+import math
+import threading
+from collections import OrderedDict, namedtuple
+
+from models import TestEntry
+from form_config import FORMS_NON_DICT, forms_version
+from queries import retest_pairs
+
+FLOAT_ABS_TOL = 1e-9
+FLOAT_REL_TOL = 1e-3
+DIFF_CACHE_SIZE = 1024
+BATCH_MAX = 500
+COMPARED_TYPES = ("boolean", "integer", "float", "text", "file")
+STATUSES = ("same", "within_tolerance", "changed", "added", "removed")
+
+FieldSpec = namedtuple("FieldSpec", "page label name field_label type_field compare")
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+## comparison
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(number) else number
+
+
+def _compare_float(old, new, rel_tol):
+    a, b = _number(old), _number(new)
+    if a is None or b is None:
+        return "same" if str(old).strip() == str(new).strip() else "changed"
+    if a == b:
+        return "same"
+    return "within_tolerance" if math.isclose(a, b, rel_tol=rel_tol, abs_tol=FLOAT_ABS_TOL) else "changed"
+
+
+def _compare_integer(old, new, _rel_tol):
+    a, b = _number(old), _number(new)
+    if a is None or b is None:
+        return "same" if str(old).strip() == str(new).strip() else "changed"
+    return "same" if a == b else "changed"
+
+
+def _compare_boolean(old, new, _rel_tol):
+    return "same" if str(old).strip().lower() == str(new).strip().lower() else "changed"
+
+
+def _compare_text(old, new, _rel_tol):
+    return "same" if str(old) == str(new) else "changed"
+
+
+COMPARATORS = {
+    "float": _compare_float,
+    "integer": _compare_integer,
+    "boolean": _compare_boolean,
+    "text": _compare_text,
+    "file": _compare_text,
+}
+
+
+def compile_schema():
+    """FieldSpecs of every compared field of the current form configuration, in form order."""
+    return [
+        FieldSpec(index, page.label, field.name, field.label, field.type_field, COMPARATORS[field.type_field])
+        for index, page in enumerate(FORMS_NON_DICT)
+        for field in page.fields
+        if field.name and field.type_field in COMPARED_TYPES
+    ]
+
+
+def _missing(value):
+    return value is None or value == ""
+
+
+def diff_data(old, new, schema, rel_tol=FLOAT_REL_TOL):
+    """[{page, label, name, field_label, type, old, new, status}] for every field of `schema`
+    present in either data dict."""
+    fields = []
+    for spec in schema:
+        a, b = old.get(spec.name), new.get(spec.name)
+        if _missing(a) and _missing(b):
+            continue
+        if _missing(a):
+            status = "added"
+        elif _missing(b):
+            status = "removed"
+        else:
+            status = spec.compare(a, b, rel_tol)
+        fields.append({
+            "page": spec.page, "label": spec.label, "name": spec.name, "field_label": spec.field_label,
+            "type": spec.type_field, "old": a, "new": b, "status": status,
+        })
+    return fields
+
+
+## entries
+
+def immutable(entry):
+    """True if the workflow never writes `entry` again: finished, or a failure that was
+    retested or cleared."""
+    return bool(entry.is_finished) or (bool(entry.failure) and not entry.fail_stored)
+
+
+def _summary(entry):
+    return {
+        "entry_id": entry.id, "version": entry.version, "cm_serial": (entry.data or {}).get("CM_serial"),
+        "timestamp": entry.timestamp.isoformat() if entry.timestamp else None,
+        "failure": bool(entry.failure), "fail_reason": entry.fail_reason, "is_finished": bool(entry.is_finished),
+    }
+
+
+def _compute(old, new, schema, rel_tol):
+    fields = diff_data(old.data or {}, new.data or {}, schema, rel_tol)
+    return {
+        "old": _summary(old), "new": _summary(new), "rel_tol": rel_tol,
+        "counts": {status: sum(1 for f in fields if f["status"] == status) for status in STATUSES},
+        "fields": fields,
+    }
+
+
+def diff_entries(old, new, rel_tol=FLOAT_REL_TOL, schema=None):
+    """Diff of TestEntry `old` (e.g. the parent) against `new`; cached when both are immutable."""
+    schema = schema if schema is not None else compile_schema()
+    if not (immutable(old) and immutable(new)):
+        return _compute(old, new, schema, rel_tol)
+
+    key = (old.id, old.version, new.id, new.version, rel_tol, forms_version())
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+    result = _compute(old, new, schema, rel_tol)
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > DIFF_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+
+def parent_diff(entry_id, rel_tol=FLOAT_REL_TOL):
+    """Diff of an entry against the attempt it retests; None if it is missing or not a retest."""
+    entry = TestEntry.query.get(entry_id)
+    if entry is None or entry.parent is None:
+        return None
+    return diff_entries(entry.parent, entry, rel_tol)
+
+
+def retest_diffs(serial_min, serial_max, rel_tol=FLOAT_REL_TOL, changed_only=True):
+    """Diffs of every retest with a CM serial in [serial_min, serial_max] against its parent,
+    at most BATCH_MAX, oldest first; with `changed_only` the fields list keeps only changes."""
+    schema = compile_schema()
+    diffs = []
+    for entry in retest_pairs(serial_min, serial_max).limit(BATCH_MAX):
+        result = diff_entries(entry.parent, entry, rel_tol, schema)
+        if changed_only:
+            result = {**result, "fields": [f for f in result["fields"] if f["status"] not in ("same", "within_tolerance")]}
+        diffs.append(result)
+    return diffs
@@ -0,0 +1,258 @@
+"""
+entry_history.py
+
+Append-only change log of TestEntries (`EntryHistory`): who changed which fields of an
+entry, on which form page, and when.
+
+Recording:
+- ORM writes (form save / fail / next, resume, retest, clear_failed, admin routes) are picked
+  up by a `before_flush` hook, so the history rows are inserted in the same flush and
+  transaction as the entry itself. The previous version is the one the entry was loaded with
+  (kept as a shallow copy at load, since the form changes `data` in place and flag_modified
+  leaves the ORM no committed value) and the next seq is kept on the entry (`history_seq`),
+  so recording adds no query; entries loaded another way, or written before `history_seq`
+  existed, are read back once (one indexed SELECT).
+- Set-based writes (bulk_entries.py, datagen.py) call `record_bulk` with the rows their statements
+  returned; it moves `history_seq` of those entries along.
+
+Row format (`changes`):
+- the first row of an entry (`seq` 0) and every HISTORY_CHECKPOINT_EVERY-th row is a
+  checkpoint: {"data": full data, "state": status fields}
+- the rows between are key-level diffs: {"set": {key: new value}, "unset": [keys],
+  "state": {changed status fields}}, with empty parts left out
+- writes that change neither data nor status (timestamp, locks, contributors) add no row
+
+`version_at(entry_id, seq)` rebuilds any version by replaying at most
+HISTORY_CHECKPOINT_EVERY - 1 diffs onto the nearest checkpoint. History is deleted together
+with its entry (`delete_history`) and moved along when archive.py archives the entry.
+"""
+
+import copy
+from datetime import datetime
+
+from flask import has_request_context, request
+from sqlalchemy import event, select, insert, update, delete, func, inspect, bindparam
+
+from models import db, TestEntry, EntryHistory, ArchivedEntry
+from db_engine import RoutingSession
+from constants import HISTORY_CHECKPOINT_EVERY
+from utils import current_user
+from archive import unpack, ENTRY_HISTORY
+
+STATE_FIELDS = ("is_saved", "is_finished", "failure", "fail_stored", "fail_reason")
+SYSTEM_USER = "system"      # writes outside a request (CLI commands)
+
+
+## versions and diffs
+
+def snapshot(values):
+    """{"data", "state"} of an entry; `values` is a TestEntry or a mapping of its columns."""
+    if isinstance(values, TestEntry):
+        values = {field: getattr(values, field) for field in ("data",) + STATE_FIELDS}
+    return {
+        "data": copy.deepcopy(dict(values["data"] or {})),
+        "state": {field: values[field] for field in STATE_FIELDS},
+    }
+
+
+def diff(old, new):
+    """Key-level changes turning version `old` into `new`; empty if they are equal."""
+    changes = {}
+    changed = {k: v for k, v in new["data"].items() if k not in old["data"] or old["data"][k] != v}
+    removed = sorted(k for k in old["data"] if k not in new["data"])
+    state = {k: v for k, v in new["state"].items() if old["state"].get(k) != v}
+    if changed:
+        changes["set"] = changed
+    if removed:
+        changes["unset"] = removed
+    if state:
+        changes["state"] = state
+    return changes
+
+
+def apply_changes(version, changes):
+    """The version after applying one diff row's `changes` to `version` (not modified)."""
+    version = copy.deepcopy(version)
+    version["data"].update(changes.get("set", {}))
+    for key in changes.get("unset", []):
+        version["data"].pop(key, None)
+    version["state"].update(changes.get("state", {}))
+    return version
+
+
+def _replay(records):
+    """Version after the last of `records` (dicts ordered by seq), starting at the last checkpoint."""
+    start = max((i for i, r in enumerate(records) if r["checkpoint"]), default=None)
+    if start is None:
+        return None
+    version = copy.deepcopy(records[start]["changes"])
+    for record in records[start + 1:]:
+        version = apply_changes(version, record["changes"])
+    return version
+
+
+def _history_row(*, seq, old, new, username, form_index, creation_time):
+    """Column values of the next EntryHistory row, or None if nothing changed."""
+    changes = diff(old, new) if old is not None else new
+    if not changes:
+        return None
+    checkpoint = old is None or seq % HISTORY_CHECKPOINT_EVERY == 0
+    return {
+        "seq": seq, "checkpoint": checkpoint, "changes": new if checkpoint else changes,
+        "username": username, "form_index": form_index,
+        "timestamp": datetime.utcnow(), "creation_time": creation_time,
+    }
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+## recording
+
+def _actor():
+    """(username, form page) of the current request; the page is the `step` of /form."""
+    if not has_request_context():
+        return SYSTEM_USER, None
+    user = current_user()
+    return (user.get_username() if user else SYSTEM_USER), request.args.get("step", type=int)
+
+
+def _stored_version(session, entry_id):
+    """(version as currently in the database or None, next seq) of an entry, in one query."""
+    table = TestEntry.__table__
+    last_seq = select(func.max(EntryHistory.seq)).where(EntryHistory.entry_id == entry_id).scalar_subquery()
+    row = session.execute(
+        select(table.c.data, *(table.c[f] for f in STATE_FIELDS), last_seq.label("last_seq"))
+        .where(table.c.id == entry_id)
+    ).mappings().first()
+    if row is None:
+        return None, 0
+    next_seq = 0 if row["last_seq"] is None else row["last_seq"] + 1
+    return (snapshot(row) if next_seq else None), next_seq
+
+
+@event.listens_for(TestEntry, "load")
+@event.listens_for(TestEntry, "refresh")
+def _remember_version(entry, _context, _attrs=None):
+    """Keep the version the entry was loaded with, for the diff of its next write."""
+    state = inspect(entry)
+    values = {}
+    for field in ("data",) + STATE_FIELDS:
+        history = state.attrs[field].history
+        loaded = history.unchanged or history.deleted
+        if not loaded:                          # not loaded, or changed before it was
+            state.info.pop("history_base", None)
+            return
+        values[field] = loaded[0]
+    state.info["history_base"] = {
+        "data": dict(values["data"] or {}),     # values are replaced, never mutated in place
+        "state": {field: values[field] for field in STATE_FIELDS},
+    }
+
+
+def _previous_version(session, entry):
+    """(version before this write or None, seq of its history row) of a TestEntry."""
+    if entry.id is None:
+        return None, 0
+    base = inspect(entry).info.get("history_base")
+    if base is None or entry.history_seq is None:
+        return _stored_version(session, entry.id)
+    return (base if entry.history_seq else None), entry.history_seq
+
+
+@event.listens_for(RoutingSession, "before_flush")
+def _record_entry_changes(session, _flush_context, _instances):
+    entries = [e for e in list(session.new) + list(session.dirty)
+               if isinstance(e, TestEntry) and session.is_modified(e)]
+    if not entries:
+        return
+
+    username, step = _actor()
+    for entry in entries:
+        old, seq = _previous_version(session, entry)
+        new = snapshot(entry)
+        form_index = step if step is not None else _as_int(new["data"].get("last_step"))
+        row = _history_row(seq=seq, old=old, new=new, username=username, form_index=form_index,
+                           creation_time=entry.created_at)
+        if row is not None:
+            session.add(EntryHistory(entry=entry, **row))
+            entry.history_seq = seq + 1
+            inspect(entry).info["history_base"] = new
+
+
+def record_bulk(rows, username, changes=None, conn=None):
+    """History for entries written by one set-based statement. `rows` are mappings with the
+    new column values (id, created_at, data and STATE_FIELDS); entries that already have
+    history get `changes` as their diff, the others (or all, without `changes`) a checkpoint.
+    Runs in the caller's transaction (`conn`, default `db.session`)."""
+    conn = conn or db.session
+    ids = [row["id"] for row in rows]
+    if not ids:
+        return
+    last = dict(conn.execute(
+        select(EntryHistory.entry_id, func.max(EntryHistory.seq))
+        .where(EntryHistory.entry_id.in_(ids))
+        .group_by(EntryHistory.entry_id)
+    ).all())
+
+    now = datetime.utcnow()
+    records = []
+    for row in rows:
+        seq = last[row["id"]] + 1 if row["id"] in last else 0
+        checkpoint = changes is None or seq % HISTORY_CHECKPOINT_EVERY == 0
+        records.append({
+            "entry_id": row["id"], "seq": seq, "checkpoint": checkpoint,
+            "changes": snapshot(row) if checkpoint else changes,
+            "username": username, "form_index": None, "timestamp": now, "creation_time": row["created_at"],
+        })
+    conn.execute(insert(EntryHistory), records)
+    table = TestEntry.__table__
+    conn.execute(
+        update(table).where(table.c.id == bindparam("entry")).values(history_seq=bindparam("next_seq")),
+        [{"entry": r["entry_id"], "next_seq": r["seq"] + 1} for r in records],
+    )
+
+
+def delete_history(entry_ids):
+    """Delete the history of entries about to be deleted (entry_id is a foreign key).
+    Runs in the caller's transaction."""
+    entry_ids = list(entry_ids)
+    for start in range(0, len(entry_ids), 500):
+        db.session.execute(delete(EntryHistory).where(EntryHistory.entry_id.in_(entry_ids[start:start + 500])))
+
+
+## reading
+
+def _archived_records(entry_id):
+    archived = ArchivedEntry.query.filter_by(kind=ENTRY_HISTORY, entry_id=entry_id)
+    return sorted((unpack(a) for a in archived), key=lambda r: r["seq"])
+
+
+def timeline(entry_id):
+    """All history rows of an entry as dicts, oldest first (from the archive if it was archived)."""
+    rows = EntryHistory.query.filter_by(entry_id=entry_id).order_by(EntryHistory.seq).all()
+    if not rows:
+        return _archived_records(entry_id)
+    return [{c.key: getattr(row, c.key) for c in EntryHistory.__table__.columns} for row in rows]
+
+
+def version_at(entry_id, seq):
+    """The entry as of history row `seq`: {"data", "state"}, or None if there is no such row."""
+    start = db.session.scalar(
+        select(func.max(EntryHistory.seq))
+        .where(EntryHistory.entry_id == entry_id, EntryHistory.checkpoint.is_(True), EntryHistory.seq <= seq)
+    )
+    if start is None:
+        records = [r for r in _archived_records(entry_id) if r["seq"] <= seq]
+    else:
+        records = [
+            {"checkpoint": row.checkpoint, "changes": row.changes}
+            for row in EntryHistory.query
+            .filter(EntryHistory.entry_id == entry_id, EntryHistory.seq.between(start, seq))
+            .order_by(EntryHistory.seq)
+        ]
+    return _replay(records)
@@ -0,0 +1,316 @@
+"""
+fleet.py
+
+Per-worker, array-backed status board of every CM serial in SERIAL_MIN..SERIAL_MAX.
+
+One fixed-width `array` per column, indexed by `serial - SERIAL_OFFSET`:
+- status: code into STATUSES of the serial's newest entry
+- step: `last_step` of that entry
+- holder: lock owner, as an index into a small table of interned usernames (0 = free)
+- retests: number of retest entries (entries with a parent) of the serial
+- entry: id of the newest entry (0 = never tested)
+so a lookup is O(1) and the whole board is a few hundred bytes.
+
+Entries moved to the archive database (archive.py) still count: the newest entry of a serial
+is the newest across `test_entry` and `archived_entry`, and retests are counted in both, so
+archiving never changes the board.
+
+Keeping it current:
+- built from the database at startup and whenever it is stale: older than FLEET_REFRESH, or
+  another worker published a change (shared token file, as in user_cache.py)
+- committed ORM writes of a TestEntry (form steps, save, fail, resume, retest, admin routes)
+  refresh exactly the touched serials (the serial the entry was loaded with too, when step 0
+  changed it), a few indexed queries each, and publish a new token
+- set-based writes (bulk_entries.py) call `invalidate_fleet()`; CLI jobs writing the main
+  database (generate-entries) are picked up by FLEET_REFRESH
+
+Served by `/fleet` (grid) and `/fleet?format=json`, `/fleet/<serial>` (JSON).
+"""
+
+import os
+import time
+import uuid
+import threading
+from array import array
+from datetime import datetime
+from itertools import chain
+
+from sqlalchemy import event, select, func, inspect
+
+from models import db, TestEntry, ArchivedEntry, json_key
+from db_engine import RoutingSession
+from archive import as_entry, TEST_ENTRY
+from constants import SERIAL_MIN, SERIAL_MAX, SERIAL_OFFSET, FLEET_REFRESH
+
+TOKEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "fleet.cache-token")
+
+STATUSES = ("untested", "in_progress", "saved", "failed", "cleared", "finished")
+SIZE = SERIAL_MAX - SERIAL_OFFSET + 1
+
+_lock = threading.Lock()
+_board = {
+    "status": array("B", bytes(SIZE)),
+    "step": array("h", [0] * SIZE),
+    "holder": array("H", [0] * SIZE),
+    "retests": array("H", [0] * SIZE),
+    "entry": array("i", [0] * SIZE),
+}
+_holders = [None]           # holder index -> username; 0 is "not locked"
+_holder_index_of = {}       # username -> holder index
+_state = {"built_at": None, "token": None}
+
+
+## shared token
+
+def _read_token():
+    try:
+        with open(TOKEN_PATH, "r", encoding="utf-8") as token_file:
+            return token_file.read()
+    except OSError:
+        return ""
+
+
+def _write_token():
+    """Publish a new random token and return it ("" if it can't be written)."""
+    token = uuid.uuid4().hex
+    tmp_path = f"{TOKEN_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as token_file:
+            token_file.write(token)
+        os.replace(tmp_path, TOKEN_PATH)
+    except OSError:
+        return ""   # no shared token: other workers fall back to FLEET_REFRESH
+    return token
+
+
+## building
+
+def _serial_column():
+    return json_key(TestEntry.__table__.c.data, "CM_serial", as_integer=True)
+
+
+def status_code(failure, fail_stored, is_finished, is_saved):
+    """Index into STATUSES for the newest entry of a serial."""
+    if failure:
+        return STATUSES.index("failed" if fail_stored else "cleared")
+    if is_finished:
+        return STATUSES.index("finished")
+    if is_saved:
+        return STATUSES.index("saved")
+    return STATUSES.index("in_progress")
+
+
+def _holder_index(username):
+    if not username:
+        return 0
+    if username not in _holder_index_of:
+        _holder_index_of[username] = len(_holders)
+        _holders.append(username)
+    return _holder_index_of[username]
+
+
+def _entry_columns():
+    table = TestEntry.__table__
+    return (table.c.id, table.c.timestamp, table.c.data, table.c.failure, table.c.fail_stored,
+            table.c.is_finished, table.c.is_saved, table.c.lock_owner)
+
+
+def _age(entry):
+    return (entry.timestamp or datetime.min, entry.id)
+
+
+def _newest(row, archived):
+    """The newer of a serial's newest live entry and newest archived entry (either may be None),
+    equal timestamps: the higher id wins. Only a winning archive record is unpacked."""
+    if archived is None or (row is not None and _age(row) >= _age(archived)):
+        return row
+    return as_entry(archived)
+
+
+def _archived_columns():
+    table = ArchivedEntry.__table__
+    return (table.c.cm_serial, table.c.timestamp, table.c.source_id.label("id"), table.c.kind, table.c.record)
+
+
+def _set(serial, row, retests):
+    """Write one serial's slots from its newest entry `row` (None: never tested). Hold `_lock`."""
+    i = serial - SERIAL_OFFSET
+    if not 0 <= i < SIZE:
+        return
+    if row is None:
+        _board["status"][i] = _board["step"][i] = _board["holder"][i] = _board["entry"][i] = 0
+    else:
+        step = (row.data or {}).get("last_step", 0)
+        _board["status"][i] = status_code(row.failure, row.fail_stored, row.is_finished, row.is_saved)
+        _board["step"][i] = int(step) if str(step).lstrip("-").isdigit() else 0
+        _board["holder"][i] = _holder_index(row.lock_owner)
+        _board["entry"][i] = row.id
+    _board["retests"][i] = min(retests, 0xFFFF)
+
+
+def rebuild_fleet():
+    """Rebuild the whole board: one query for the newest entry per serial, one for retest counts."""
+    table = TestEntry.__table__
+    serial = _serial_column()
+    latest = (
+        select(serial.label("cm_serial"), func.max(table.c.timestamp).label("latest"))
+        .where(serial.between(SERIAL_MIN, SERIAL_MAX))
+        .group_by(serial)
+        .subquery()
+    )
+    newest = (
+        select(serial.label("cm_serial"), *_entry_columns())
+        .join(latest, (serial == latest.c.cm_serial) & (table.c.timestamp == latest.c.latest))
+        .order_by(table.c.id)       # equal timestamps: the higher id wins
+    )
+    retests = select(serial, func.count()).where(table.c.parent_id.isnot(None)).group_by(serial)
+
+    archive = ArchivedEntry.__table__
+    archived_latest = (
+        select(archive.c.cm_serial, func.max(archive.c.timestamp).label("latest"))
+        .where(archive.c.kind == TEST_ENTRY, archive.c.cm_serial.between(SERIAL_MIN, SERIAL_MAX))
+        .group_by(archive.c.cm_serial)
+        .subquery()
+    )
+    archived_newest = (
+        select(*_archived_columns())
+        .join(archived_latest, (archive.c.cm_serial == archived_latest.c.cm_serial)
+              & (archive.c.timestamp == archived_latest.c.latest))
+        .where(archive.c.kind == TEST_ENTRY)
+    )
+    archived_retests = (
+        select(archive.c.cm_serial, func.count())
+        .where(archive.c.kind == TEST_ENTRY, archive.c.parent_id.isnot(None))
+        .group_by(archive.c.cm_serial)
+    )
+
+    token = _read_token()
+    with db.engines[TestEntry.__bind_key__].connect() as conn:
+        rows = {row.cm_serial: row for row in conn.execute(newest)}
+        counts = dict(conn.execute(retests).all())
+    with db.engines[ArchivedEntry.__bind_key__].connect() as conn:
+        for archived in conn.execute(archived_newest):
+            rows[archived.cm_serial] = _newest(rows.get(archived.cm_serial), archived)
+        for value, count in conn.execute(archived_retests):
+            counts[value] = counts.get(value, 0) + count
+
+    with _lock:
+        for value in range(SERIAL_MIN, SERIAL_MAX + 1):
+            _set(value, rows.get(value), counts.get(value, 0))
+        _state.update(built_at=time.monotonic(), token=token)
+
+
+def _refresh_serials(serials):
+    """Re-read the given serials only (newest entry via ix_test_entry_cm_serial_latest and
+    ix_archived_entry_serial_latest)."""
+    table = TestEntry.__table__
+    archive = ArchivedEntry.__table__
+    serial = _serial_column()
+    with db.engines[TestEntry.__bind_key__].connect() as conn, \
+            db.engines[ArchivedEntry.__bind_key__].connect() as archive_conn:
+        for value in serials:
+            row = conn.execute(
+                select(*_entry_columns()).where(serial == value)
+                .order_by(table.c.timestamp.desc(), table.c.id.desc()).limit(1)
+            ).first()
+            count = conn.execute(
+                select(func.count()).where(serial == value, table.c.parent_id.isnot(None))
+            ).scalar()
+            archived = archive_conn.execute(
+                select(*_archived_columns()).where(archive.c.kind == TEST_ENTRY, archive.c.cm_serial == value)
+                .order_by(archive.c.timestamp.desc(), archive.c.source_id.desc()).limit(1)
+            ).first()
+            count += archive_conn.execute(
+                select(func.count()).where(archive.c.kind == TEST_ENTRY, archive.c.cm_serial == value,
+                                           archive.c.parent_id.isnot(None))
+            ).scalar()
+            with _lock:
+                _set(value, _newest(row, archived), count)
+
+
+def _ensure_fresh():
+    built_at = _state["built_at"]
+    if (built_at is None or _state["token"] != _read_token()
+            or time.monotonic() - built_at > FLEET_REFRESH.total_seconds()):
+        rebuild_fleet()
+
+
+def invalidate_fleet():
+    """Mark the board stale in every worker (after set-based writes)."""
+    _write_token()
+    _state["built_at"] = None
+
+
+## reading
+
+def _slot(i):
+    entry_id = _board["entry"][i]
+    return {
+        "cm_serial": SERIAL_OFFSET + i,
+        "status": STATUSES[_board["status"][i]],
+        "step": _board["step"][i],
+        "lock_owner": _holders[_board["holder"][i]],
+        "retests": _board["retests"][i],
+        "entry_id": entry_id or None,
+    }
+
+
+def serial_status(serial):
+    """Board slot of one serial, or None outside SERIAL_MIN..SERIAL_MAX."""
+    if not SERIAL_MIN <= serial <= SERIAL_MAX:
+        return None
+    _ensure_fresh()
+    with _lock:
+        return _slot(serial - SERIAL_OFFSET)
+
+
+def fleet_status():
+    """All slots, in serial order."""
+    _ensure_fresh()
+    with _lock:
+        return [_slot(serial - SERIAL_OFFSET) for serial in range(SERIAL_MIN, SERIAL_MAX + 1)]
+
+
+## write hooks
+
+def _serial_of(entry):
+    value = (entry.data or {}).get("CM_serial")
+    return int(value) if str(value).isdigit() else None
+
+
+@event.listens_for(TestEntry, "load")
+@event.listens_for(TestEntry, "refresh")
+def _remember_serial(entry, _context, attrs=None):
+    """Keep the serial an entry was loaded with: the form changes `data` in place, so its
+    attribute history can't tell which slot an entry with a new serial has to leave."""
+    state = inspect(entry)
+    if attrs is None or "data" in attrs:
+        state.info["fleet_serial"] = _serial_of(entry) if "data" in state.dict else None
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _note_fleet_changes(session, _flush_context):
+    serials = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, TestEntry):
+            serials.update((_serial_of(obj), inspect(obj).info.get("fleet_serial")))
+    serials.discard(None)
+    if serials:
+        session.info.setdefault("fleet_serials", set()).update(serials)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _publish_fleet_changes(session):
+    serials = session.info.pop("fleet_serials", None)
+    if not serials:
+        return
+    stale = _state["token"] != _read_token()
+    _refresh_serials(sorted(serials))
+    token = _write_token()
+    if not stale:
+        _state["token"] = token     # this worker is current; the others rebuild on their next read
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _discard_fleet_changes(session):
+    session.info.pop("fleet_serials", None)
@@ -14,6 +14,7 @@ Key Features:
 - `save_forms_to_file(forms, filepath)`: Serializes the current form configuration to a JSON file.
 - `load_forms_from_file(filepath)`: Loads and reconstructs form pages and fields from a saved JSON file.
 - `reset_forms()`: Restores the form configuration to its default state.
+- `forms_version()`: Changes whenever the form configuration is saved; part of cache keys.
 - `FORMS_NON_DICT`: The active in-memory form configuration, loaded from disk or defaulted if missing.
 
 File Structure:
@@ -325,6 +326,15 @@ def load_forms_from_file(filepath=forms_config_path):
 
 FORMS_NON_DICT = load_forms_from_file()
 
+def forms_version():
+    """Signature of the saved form configuration (mtime and size of the JSON file). Every edit
+    is saved, so caches of results that depend on the form put it in their keys."""
+    try:
+        stat = os.stat(forms_config_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
 def reset_forms():
     """Restores the form configuration to its default state.
     Should probably only be used in development or testing environments.
@@ -0,0 +1,469 @@
+"""
+jobs.py
+
+Background jobs for the long admin and export operations, so they no longer run inside one
+request (and hit GUNICORN_TIMEOUT or block a worker):
+- export_csv: the /export_csv CSV (`unique`, `all_time`) written to data/exports, downloadable
+  from /admin/jobs/<id>/download for EXPORT_KEEP
+- clear_history: delete the dummy (test=True) entries, their history and uploads, in batches
+- add_dummy_entries: /add_dummy_entry for a large `count`, committed in batches
+- rebuild_measurements: rewrite the typed measurement table, e.g. after a field's type was
+  changed in the form editor (form-config data migration)
+- rebuild_search: re-index all entries for full-text search
+- backfill_rollups: recompute the daily rollups
+- backup: an online snapshot of the databases (backup.py), also queued every BACKUP_INTERVAL
+
+Queue: one row per job in the `job` table (main database), so every gunicorn worker sees the
+same queue and a job survives a restart. /admin/jobs enqueues jobs and polls them.
+
+Running: each worker process has a pool of at most JOB_THREADS threads, started on demand
+(`kick`: when a job is enqueued, when the jobs page is polled, on the first request of a
+worker). A thread claims the oldest queued job with one `UPDATE ... RETURNING` (FOR UPDATE
+SKIP LOCKED on PostgreSQL), so two workers never run the same job, runs it inside an app
+context and claims the next until none is left. `flask jobs run` does the same in the
+foreground.
+
+Schedule: `SCHEDULED` kinds are queued when their last job is older than their interval;
+workers check at most every SCHEDULE_CHECK seconds, on a request, with one
+`INSERT ... SELECT ... WHERE NOT EXISTS`, so only one of them queues it.
+
+Progress and cancellation: handlers report progress through their `JobContext`, which also
+writes the heartbeat and raises JobCancelled once /admin/jobs/<id>/cancel was requested.
+Handlers commit in batches, so a cancelled job keeps the batches it finished.
+
+Restart: a running job whose heartbeat is older than JOB_STALE (its worker was killed or
+restarted) is claimed again, at most MAX_ATTEMPTS times; the handlers pick up where the
+recorded progress left off or are idempotent. A worker that lost its claim this way stops
+at its next progress report without writing anything.
+
+Usage:
+    flask --app app jobs run                      # run queued jobs in this process
+"""
+
+import os
+import csv
+import time
+import uuid
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import select, update, insert, exists, literal, func, or_, and_
+
+from models import db, Job, TestEntry
+from archive import with_archive
+from queries import latest_per_serial
+from entry_history import delete_history
+from uploads import delete_entry_uploads
+from utils import export_fields, export_header, export_row, dummy_test_data
+from measurements import backfill as backfill_measurements
+from rollups import backfill as backfill_rollups
+from search import rebuild as rebuild_search, available as search_available
+from backup import create_snapshot, backup_folder
+from constants import BACKUP_INTERVAL
+
+EXPORT_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "exports")
+
+JOB_THREADS = 2                     # per worker process
+HEARTBEAT_INTERVAL = 5.0            # seconds between progress writes
+JOB_STALE = timedelta(minutes=5)    # no heartbeat for this long: the worker is gone
+MAX_ATTEMPTS = 3
+EXPORT_KEEP = timedelta(days=7)
+JOB_BATCH = 1000
+JOB_LIST_LIMIT = 100
+SCHEDULE_CHECK = 60.0               # seconds between a worker's schedule checks
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+ACTIVE = (QUEUED, RUNNING)
+
+_lock = threading.Lock()
+_state = {"app": None, "pid": None, "executor": None, "busy": 0, "kicked_pid": None, "schedule_checked": 0.0}
+
+
+class JobCancelled(Exception):
+    """Raised into a handler when its job was cancelled."""
+
+
+class JobLost(JobCancelled):
+    """Raised into a handler when another worker claimed its job (this one looked dead)."""
+
+
+class JobContext:
+    """What a handler gets: the job's id and params, its progress from an earlier attempt
+    (`resume_from`), and `progress()` to report progress and notice cancellation."""
+
+    def __init__(self, job_id, claim, params, resume_from=0):
+        self.job_id = job_id
+        self.claim = claim
+        self.params = params or {}
+        self.resume_from = resume_from or 0
+        self._last_beat = 0.0
+
+    def progress(self, done, total=None, force=False):
+        """Record `done` (of `total`) and the heartbeat, at most every HEARTBEAT_INTERVAL
+        seconds unless `force`; raises JobCancelled / JobLost."""
+        now = time.monotonic()
+        if not force and now - self._last_beat < HEARTBEAT_INTERVAL:
+            return
+        self._last_beat = now
+        values = {"progress": done, "heartbeat_at": datetime.utcnow()}
+        if total is not None:
+            values["total"] = total
+        table = Job.__table__
+        with _engine().begin() as conn:
+            row = conn.execute(
+                update(table).where(table.c.id == self.job_id, table.c.claimed_by == self.claim,
+                                    table.c.status == RUNNING)
+                .values(**values).returning(table.c.cancel_requested)
+            ).first()
+        if row is None:
+            raise JobLost(self.job_id)
+        if row.cancel_requested:
+            raise JobCancelled(self.job_id)
+
+
+def _engine():
+    return db.engines[Job.__bind_key__]
+
+
+## handlers
+
+def export_path(job_id):
+    """Where the CSV of export job `job_id` is written."""
+    return os.path.join(EXPORT_FOLDER, f"job-{job_id}.csv")
+
+
+def _export_pages(unique):
+    query = latest_per_serial() if unique else TestEntry.query.order_by(TestEntry.timestamp.desc())
+    query = query.order_by(TestEntry.id.desc())     # stable pages
+    offset = 0
+    while True:
+        page = query.limit(JOB_BATCH).offset(offset).all()
+        if not page:
+            return
+        yield from page
+        offset += len(page)
+        db.session.expunge_all()    # keep one page in memory
+
+
+def _export_csv(job):
+    unique, all_time = bool(job.params.get("unique")), bool(job.params.get("all_time"))
+    if all_time:
+        entries = with_archive(list(_export_pages(unique)), unique=unique)
+        total = len(entries)
+    else:
+        entries = _export_pages(unique)
+        total = (latest_per_serial() if unique else TestEntry.query).count()
+    job.progress(0, total, force=True)
+
+    fields = export_fields()
+    os.makedirs(EXPORT_FOLDER, exist_ok=True)
+    path = export_path(job.job_id)
+    partial = f"{path}.part"
+    done = 0
+    try:
+        with open(partial, "w", newline="", encoding="utf-8") as out:
+            writer = csv.writer(out)
+            writer.writerow(export_header(fields))
+            for entry in entries:
+                writer.writerow(export_row(entry, fields))
+                done += 1
+                job.progress(done, total)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    prune_exports()
+    return {"rows": done, "download_name": "test_results.csv"}
+
+
+def _clear_history(job):
+    """Delete dummy entries newest first (a retest before its parent), one batch per transaction."""
+    ids = [entry_id for (entry_id,) in
+           db.session.query(TestEntry.id).filter_by(test=True).order_by(TestEntry.id.desc())]
+    job.progress(0, len(ids), force=True)
+    for start in range(0, len(ids), JOB_BATCH):
+        batch = ids[start:start + JOB_BATCH]
+        delete_history(batch)
+        db.session.query(TestEntry).filter(TestEntry.id.in_(batch)).delete(synchronize_session=False)
+        db.session.commit()
+        delete_entry_uploads(batch, current_app.config['UPLOAD_FOLDER'])
+        job.progress(start + len(batch), len(ids), force=True)
+    return {"deleted": len(ids)}
+
+
+def _add_dummy_entries(job):
+    count = int(job.params.get("count", 1))
+    username = job.params.get("username")
+    done = min(job.resume_from, count)     # batches committed by an earlier attempt
+    job.progress(done, count, force=True)
+    while done < count:
+        size = min(JOB_BATCH, count - done)
+        for _ in range(size):
+            db.session.add(TestEntry(contributors=[username], data=dummy_test_data(),
+                                     timestamp=datetime.utcnow(), test=True))
+        db.session.commit()
+        done += size
+        job.progress(done, count, force=True)
+    return {"added": count}
+
+
+def _entry_total():
+    return db.session.query(func.count(TestEntry.id)).scalar()
+
+
+def _rebuild_measurements(job):
+    total = _entry_total()
+    written = backfill_measurements(batch_size=JOB_BATCH, rebuild=True, progress=lambda n: job.progress(n, total))
+    return {"entries": written}
+
+
+def _rebuild_search(job):
+    if not search_available(_engine()):
+        raise RuntimeError("Full-text search needs a SQLite main database.")
+    total = _entry_total()
+    return {"entries": rebuild_search(batch_size=JOB_BATCH, progress=lambda n: job.progress(n, total))}
+
+
+def _backfill_rollups(job):
+    total = _entry_total()
+    return {"entries": backfill_rollups(batch_size=JOB_BATCH, progress=lambda n: job.progress(n, total))}
+
+
+def _backup(job):
+    manifest = create_snapshot(backup_folder(), current_app.config['UPLOAD_FOLDER'], progress=job.progress)
+    return {"snapshot": manifest["name"], "uploads_changed": manifest["uploads_changed"],
+            "rotated": manifest["rotated"]}
+
+
+# kind -> (handler, label)
+JOB_KINDS = {
+    "export_csv": (_export_csv, "CSV export"),
+    "clear_history": (_clear_history, "Delete dummy history"),
+    "add_dummy_entries": (_add_dummy_entries, "Add dummy entries"),
+    "rebuild_measurements": (_rebuild_measurements, "Rebuild measurement table"),
+    "rebuild_search": (_rebuild_search, "Rebuild search index"),
+    "backfill_rollups": (_backfill_rollups, "Recompute daily rollups"),
+    "backup": (_backup, "Database backup"),
+}
+
+# kind -> how often it is queued by itself
+SCHEDULED = {
+    "backup": BACKUP_INTERVAL,
+}
+
+
+## queue
+
+def enqueue(kind, params=None, username=None):
+    """Queue a job (committed) and start a runner thread; returns the Job."""
+    if kind not in JOB_KINDS:
+        raise ValueError(f"Unknown job kind {kind!r}")
+    job = Job(kind=kind, params=params or {}, created_by=username)
+    db.session.add(job)
+    db.session.commit()
+    kick()
+    return job
+
+
+def cancel(job_id):
+    """Cancel a queued job, or ask a running one to stop; False if it is not active."""
+    table = Job.__table__
+    bind = {"mapper": Job}
+    queued = db.session.execute(
+        update(table).where(table.c.id == job_id, table.c.status == QUEUED)
+        .values(status=CANCELLED, cancel_requested=True, finished_at=datetime.utcnow()),
+        bind_arguments=bind,
+    ).rowcount
+    running = db.session.execute(
+        update(table).where(table.c.id == job_id, table.c.status == RUNNING).values(cancel_requested=True),
+        bind_arguments=bind,
+    ).rowcount
+    db.session.commit()
+    return bool(queued or running)
+
+
+def enqueue_due():
+    """Queue every SCHEDULED kind that has no active job and none queued within its
+    interval; returns how many were queued."""
+    table = Job.__table__
+    now = datetime.utcnow()
+    queued = 0
+    with _engine().begin() as conn:
+        for kind, every in SCHEDULED.items():
+            recent = select(table.c.id).where(
+                table.c.kind == kind, or_(table.c.status.in_(ACTIVE), table.c.created_at > now - every))
+            queued += conn.execute(
+                insert(table).from_select(
+                    ["kind", "status", "created_by", "created_at", "attempts", "progress", "cancel_requested"],
+                    select(literal(kind), literal(QUEUED), literal("schedule"), literal(now), literal(0), literal(0),
+                           literal(False)).where(~exists(recent)),
+                )
+            ).rowcount
+    return queued
+
+
+def _expire_abandoned(conn, stale_before):
+    """Finish abandoned running jobs that must not be claimed again."""
+    table = Job.__table__
+    abandoned = and_(table.c.status == RUNNING, table.c.heartbeat_at < stale_before)
+    now = datetime.utcnow()
+    conn.execute(update(table).where(abandoned, table.c.cancel_requested.is_(True))
+                 .values(status=CANCELLED, finished_at=now))
+    conn.execute(update(table).where(abandoned, table.c.attempts >= MAX_ATTEMPTS)
+                 .values(status=FAILED, finished_at=now, error=f"Worker stopped {MAX_ATTEMPTS} times while running it."))
+
+
+def claim_next(claim):
+    """Atomically claim the oldest queued (or abandoned) job for `claim`; the claimed row
+    (id, kind, params, progress), or None."""
+    table = Job.__table__
+    now = datetime.utcnow()
+    stale_before = now - JOB_STALE
+    claimable = or_(table.c.status == QUEUED, and_(table.c.status == RUNNING, table.c.heartbeat_at < stale_before))
+    candidate = (
+        select(table.c.id).where(claimable).order_by(table.c.id).limit(1)
+        .with_for_update(skip_locked=True).scalar_subquery()
+    )
+    with _engine().begin() as conn:
+        _expire_abandoned(conn, stale_before)
+        return conn.execute(
+            update(table).where(table.c.id == candidate, claimable)
+            .values(status=RUNNING, claimed_by=claim, heartbeat_at=now, attempts=table.c.attempts + 1,
+                    started_at=func.coalesce(table.c.started_at, now))
+            .returning(table.c.id, table.c.kind, table.c.params, table.c.progress)
+        ).first()
+
+
+def _finish(job_id, claim, status, **values):
+    table = Job.__table__
+    with _engine().begin() as conn:
+        conn.execute(update(table).where(table.c.id == job_id, table.c.claimed_by == claim, table.c.status == RUNNING)
+                     .values(status=status, finished_at=datetime.utcnow(), **values))
+
+
+def run_next():
+    """Claim and run one job in this thread (inside an app context); False if none was waiting."""
+    claim = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    row = claim_next(claim)
+    if row is None:
+        return False
+    job = JobContext(row.id, claim, row.params, row.progress)
+    try:
+        if row.kind not in JOB_KINDS:
+            raise ValueError(f"Unknown job kind {row.kind!r}")
+        result = JOB_KINDS[row.kind][0](job)
+    except JobLost:
+        db.session.rollback()
+    except JobCancelled:
+        db.session.rollback()
+        _finish(row.id, claim, CANCELLED)
+    except Exception:  # pylint: disable=broad-exception-caught
+        db.session.rollback()
+        _finish(row.id, claim, FAILED, error=traceback.format_exc(limit=5))
+    else:
+        _finish(row.id, claim, DONE, result=result, progress=func.coalesce(Job.__table__.c.total, Job.__table__.c.progress))
+    finally:
+        db.session.remove()
+    return True
+
+
+## runner threads
+
+def _run_queue(app):
+    try:
+        with app.app_context():
+            while run_next():
+                pass
+    finally:
+        with _lock:
+            _state["busy"] -= 1
+
+
+def kick():
+    """Start a runner thread in this process unless JOB_THREADS are busy already; it runs
+    queued (and abandoned) jobs until there are none."""
+    with _lock:
+        if _state["app"] is None:
+            return
+        if _state["pid"] != os.getpid():     # first use in this (forked) worker
+            _state.update(pid=os.getpid(), busy=0,
+                          executor=ThreadPoolExecutor(max_workers=JOB_THREADS, thread_name_prefix="job"))
+        if _state["busy"] >= JOB_THREADS:
+            return
+        _state["busy"] += 1
+        _state["executor"].submit(_run_queue, _state["app"])
+
+
+def _before_request():
+    if _state["kicked_pid"] != os.getpid():
+        _state["kicked_pid"] = os.getpid()
+        kick()      # jobs left queued or abandoned by a worker that restarted
+    if time.monotonic() - _state["schedule_checked"] >= SCHEDULE_CHECK:
+        _state["schedule_checked"] = time.monotonic()
+        if enqueue_due():
+            kick()
+
+
+def init_jobs(app):
+    """Run jobs in the threads of this app's worker processes (not in CLI commands)."""
+    _state["app"] = app
+    app.before_request(_before_request)
+
+
+## reading
+
+def recent_jobs(limit=JOB_LIST_LIMIT):
+    """The newest `limit` jobs, newest first."""
+    return Job.query.order_by(Job.id.desc()).limit(limit).all()
+
+
+def has_export(job):
+    """True if `job` is a finished export whose file is still kept."""
+    return job.kind == "export_csv" and job.status == DONE and os.path.isfile(export_path(job.id))
+
+
+def job_dict(job):
+    """JSON-ready view of a Job for polling."""
+    def stamp(value):
+        return value.isoformat(timespec="seconds") + "Z" if value else None
+
+    return {
+        "id": job.id, "kind": job.kind, "label": JOB_KINDS.get(job.kind, (None, job.kind))[1],
+        "params": job.params, "status": job.status, "created_by": job.created_by,
+        "created_at": stamp(job.created_at), "started_at": stamp(job.started_at),
+        "finished_at": stamp(job.finished_at), "heartbeat_at": stamp(job.heartbeat_at),
+        "attempts": job.attempts, "progress": job.progress, "total": job.total,
+        "percent": round(100 * job.progress / job.total) if job.total else None,
+        "cancel_requested": job.cancel_requested, "result": job.result, "error": job.error,
+        "download": has_export(job),
+    }
+
+
+def prune_exports(keep=EXPORT_KEEP):
+    """Delete export files older than `keep`; returns how many."""
+    cutoff = time.time() - keep.total_seconds()
+    removed = 0
+    for name in os.listdir(EXPORT_FOLDER) if os.path.isdir(EXPORT_FOLDER) else []:
+        path = os.path.join(EXPORT_FOLDER, name)
+        if name.endswith(".csv") and os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+jobs_cli = AppGroup("jobs", help="Background job queue.")
+
+
+@jobs_cli.command("run")
+def run_command():
+    """Run queued jobs in this process until none is left."""
+    ran = 0
+    while run_next():
+        ran += 1
+    click.echo(f"Ran {ran} jobs.")
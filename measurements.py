@@ -0,0 +1,135 @@
+"""
+measurements.py
+
+Typed copy of the form values in `TestEntry.data` (which stores everything as strings), in
+the `measurement` table: one row per entry and form field with the raw `text_value` and,
+for integer / float fields, the parsed `num_value`. Indexed on (field_name, num_value) and
+(field_name, text_value), so range and top-K questions about one field ("which CMs read
+more than 1.2 A") are index range scans instead of a JSON cast over every entry; see
+`queries.measurement_range` / `queries.measurement_top` and `/measurements/<field>`.
+
+Keeping it in step:
+- an `after_flush` hook rewrites the rows of every TestEntry whose data was written, in the
+  same transaction (ORM writes: /form, retest, admin routes)
+- bulk restore (bulk_entries.py) calls `write_measurements` itself
+- deleting an entry deletes its rows (ON DELETE CASCADE)
+- `flask measurements backfill` fills in entries written before this table existed or by
+  core inserts (`flask generate-entries`); `--rebuild` rewrites all, e.g. after a field's
+  type was changed in the form editor
+
+Field types come from the current form configuration; values that don't parse as numbers
+keep only their text. File fields (upload paths) are not copied.
+
+Usage:
+    flask --app app measurements backfill
+    flask --app app measurements backfill --rebuild --batch-size 2000
+"""
+
+import math
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, select, insert, delete, exists, inspect
+
+from models import db, TestEntry, Measurement
+from form_config import FORMS_NON_DICT
+from db_engine import RoutingSession
+
+NUMERIC_TYPES = ("integer", "float")
+
+
+def field_types():
+    """{field name: type_field} of all form fields except file uploads."""
+    return {
+        field.name: field.type_field
+        for page in FORMS_NON_DICT for field in page.fields
+        if field.type_field != "file"
+    }
+
+
+def numeric_fields():
+    """Names of the integer and float form fields, in form order."""
+    return [name for name, kind in field_types().items() if kind in NUMERIC_TYPES]
+
+
+def _number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(number) else number      # NaN never matches a range
+
+
+def measurement_rows(entry_id, data, types):
+    """Measurement column values for one entry's `data`."""
+    rows = []
+    for name, value in (data or {}).items():
+        if name not in types or value is None or value == "":
+            continue
+        rows.append({
+            "entry_id": entry_id, "field_name": name, "text_value": str(value),
+            "num_value": _number(value) if types[name] in NUMERIC_TYPES else None,
+        })
+    return rows
+
+
+def write_measurements(conn, entries):
+    """Replace the measurement rows of `entries` ((id, data) pairs). `conn` is a Connection
+    or Session; runs in its transaction."""
+    entries = list(entries)
+    if not entries:
+        return
+    types = field_types()
+    conn.execute(
+        delete(Measurement)
+        .where(Measurement.entry_id.in_([entry_id for entry_id, _ in entries]))
+        .execution_options(synchronize_session=False)
+    )
+    rows = [row for entry_id, data in entries for row in measurement_rows(entry_id, data, types)]
+    if rows:
+        conn.execute(insert(Measurement), rows)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _sync_measurements(session, _flush_context):
+    written = [
+        (entry.id, entry.data)
+        for entry in list(session.new) + list(session.dirty)
+        if isinstance(entry, TestEntry) and entry.id is not None and inspect(entry).attrs.data.history.has_changes()
+    ]
+    write_measurements(session, written)
+
+
+def backfill(*, batch_size=1000, rebuild=False, progress=None):
+    """Write measurements for entries that have none (all entries with `rebuild`), one
+    transaction per batch. Returns the number of entries written."""
+    engine = db.engines[TestEntry.__bind_key__]
+    table = TestEntry.__table__
+    done, last_id = 0, 0
+    while True:
+        query = select(table.c.id, table.c.data).where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+        if not rebuild:
+            query = query.where(~exists().where(Measurement.entry_id == table.c.id))
+        with engine.begin() as conn:
+            entries = conn.execute(query).all()
+            if not entries:
+                break
+            write_measurements(conn, [tuple(entry) for entry in entries])
+        done += len(entries)
+        last_id = entries[-1][0]
+        if progress:
+            progress(done)
+    return done
+
+
+measurements_cli = AppGroup("measurements", help="Typed measurement table maintenance.")
+
+
+@measurements_cli.command("backfill")
+@click.option("--batch-size", default=1000, show_default=True, help="Entries per transaction.")
+@click.option("--rebuild", is_flag=True, help="Rewrite the measurements of all entries, not only missing ones.")
+def backfill_command(batch_size, rebuild):
+    """Copy form values of existing entries into the measurement table."""
+    written = backfill(batch_size=batch_size, rebuild=rebuild,
+                      progress=lambda n: click.echo(f"  {n} entries", err=True))
+    click.echo(f"Wrote measurements for {written} entries.")
@@ -0,0 +1,263 @@
+"""
+metrics.py
+
+Per-request instrumentation, aggregated across gunicorn workers and exported as Prometheus
+text at /admin/metrics.
+
+Recorded for every request, per endpoint:
+- request_seconds: wall time from before_request to teardown
+- sql_queries / sql_seconds: statements run and time spent in them (cursor execute events
+  on every engine except the metrics bind itself)
+- template_seconds: time spent rendering templates
+- upload_bytes: body size of multipart (file upload) requests
+- responses: count per status code
+
+Each measure is a histogram with fixed buckets (see `BUCKETS`). Observations are buffered per
+worker and added to the `request_metric` table of the `metrics` bind (data/metrics.db) with one
+batched upsert at most every `FLUSH_INTERVAL` seconds, the same way security_events.py does,
+so all workers share one set of totals.
+
+Statements slower than `SLOW_QUERY_SECONDS` go to the `slow_query` table with their endpoint
+(statement text only, never the parameters); the newest `SLOW_QUERY_KEEP` are kept and shown
+at /admin/slow_queries.
+"""
+
+import time
+import threading
+from datetime import datetime
+from flask import g, request, has_request_context, before_render_template, template_rendered
+from sqlalchemy import event, select, delete, func
+
+from models import db, RequestMetric, SlowQuery
+from db_engine import upsert_insert
+
+METRICS_BIND = RequestMetric.__bind_key__
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BUCKETS = {
+    "request_seconds": TIME_BUCKETS,
+    "sql_seconds": TIME_BUCKETS,
+    "template_seconds": TIME_BUCKETS,
+    "sql_queries": (1, 2, 5, 10, 20, 50, 100, 250, 1000),
+    "upload_bytes": (10 * 1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2, 50 * 1024 ** 2, 200 * 1024 ** 2),
+}
+DESCRIPTIONS = {
+    "request_seconds": "Wall time of a request.",
+    "sql_seconds": "Time spent executing SQL statements during a request.",
+    "template_seconds": "Time spent rendering templates during a request.",
+    "sql_queries": "SQL statements executed during a request.",
+    "upload_bytes": "Body size of multipart upload requests.",
+}
+
+FLUSH_INTERVAL = 2.0                # seconds
+SLOW_QUERY_SECONDS = 0.25
+SLOW_QUERY_KEEP = 1000
+STATEMENT_MAX_CHARS = 2000
+
+_pending = {}                       # (endpoint, metric, bucket) -> value to add
+_pending_slow = []                  # SlowQuery rows not yet written
+_state = {"pending_since": None}
+_lock = threading.Lock()
+
+
+def _bucket(metric, value):
+    for upper in BUCKETS[metric]:
+        if value <= upper:
+            return repr(upper)
+    return "+Inf"
+
+
+def _add(endpoint, metric, bucket, value):
+    key = (endpoint, metric, bucket)
+    _pending[key] = _pending.get(key, 0) + value
+
+
+def observe(endpoint, metric, value):
+    """Add one observation of `metric` for `endpoint` to this worker's buffer."""
+    with _lock:
+        _add(endpoint, metric, _bucket(metric, value), 1)
+        _add(endpoint, metric, "sum", value)
+        if _state["pending_since"] is None:
+            _state["pending_since"] = time.time()
+
+
+def _upsert(rows):
+    engine = db.engines[METRICS_BIND]
+    table = RequestMetric.__table__
+
+    stmt = upsert_insert(engine)(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["endpoint", "metric", "bucket"],
+        set_={"value": table.c.value + stmt.excluded.value},
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt, rows)
+
+
+def flush(force=False):
+    """Write buffered observations once they are `FLUSH_INTERVAL` seconds old (or always with `force`)."""
+    with _lock:
+        if not _pending and not _pending_slow:
+            return
+        since = _state["pending_since"] or time.time()
+        if not force and time.time() - since < FLUSH_INTERVAL:
+            return
+        rows = [
+            {"endpoint": endpoint, "metric": metric, "bucket": bucket, "value": value}
+            for (endpoint, metric, bucket), value in _pending.items()
+        ]
+        slow = list(_pending_slow)
+        _pending.clear()
+        _pending_slow.clear()
+        _state["pending_since"] = None
+
+    if rows:
+        _upsert(rows)
+    if slow:
+        with db.engines[METRICS_BIND].begin() as conn:
+            conn.execute(SlowQuery.__table__.insert(), slow)
+            newest = conn.execute(select(func.max(SlowQuery.id))).scalar()
+            conn.execute(delete(SlowQuery).where(SlowQuery.id <= newest - SLOW_QUERY_KEEP))
+
+
+def _endpoint():
+    return request.endpoint or "unmatched"
+
+
+## hooks
+
+def _before_cursor_execute(conn, _cursor, _statement, _parameters, _context, _executemany):
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, _cursor, statement, _parameters, _context, _executemany):
+    started = conn.info.get("metrics_query_start")
+    if not started:
+        return
+    elapsed = time.perf_counter() - started.pop()
+    if not has_request_context() or "request_metrics" not in g:
+        return
+
+    stats = g.request_metrics
+    stats["sql_queries"] += 1
+    stats["sql_seconds"] += elapsed
+    if elapsed >= SLOW_QUERY_SECONDS:
+        with _lock:
+            _pending_slow.append({
+                "recorded_at": datetime.utcnow(), "endpoint": _endpoint(),
+                "seconds": elapsed, "statement": statement[:STATEMENT_MAX_CHARS],
+            })
+            _add(_endpoint(), "slow_queries", "", 1)
+            if _state["pending_since"] is None:
+                _state["pending_since"] = time.time()
+
+
+def _before_render(_sender, **_kwargs):
+    if "request_metrics" in g:
+        g.request_metrics["render_started"].append(time.perf_counter())
+
+
+def _after_render(_sender, **_kwargs):
+    if "request_metrics" in g and g.request_metrics["render_started"]:
+        g.request_metrics["template_seconds"] += time.perf_counter() - g.request_metrics["render_started"].pop()
+
+
+def _start_request():
+    g.request_metrics = {
+        "started": time.perf_counter(), "sql_queries": 0, "sql_seconds": 0.0,
+        "template_seconds": 0.0, "render_started": [], "status": 500,
+    }
+
+
+def _note_status(response):
+    if "request_metrics" in g:
+        g.request_metrics["status"] = response.status_code
+    return response
+
+
+def _finish_request(_exc):
+    stats = g.pop("request_metrics", None)
+    if stats is not None:
+        endpoint = _endpoint()
+        observe(endpoint, "request_seconds", time.perf_counter() - stats["started"])
+        observe(endpoint, "sql_queries", stats["sql_queries"])
+        observe(endpoint, "sql_seconds", stats["sql_seconds"])
+        observe(endpoint, "template_seconds", stats["template_seconds"])
+        if request.mimetype == "multipart/form-data" and request.content_length:
+            observe(endpoint, "upload_bytes", request.content_length)
+        with _lock:
+            _add(endpoint, "responses", str(stats["status"]), 1)
+    flush()
+
+
+def init_metrics(app):
+    """Register the request hooks, template signals and cursor events on `app`."""
+    app.before_request(_start_request)
+    app.after_request(_note_status)
+    app.teardown_request(_finish_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    with app.app_context():
+        for key, engine in db.engines.items():
+            if key is not None and key.startswith(METRICS_BIND):
+                continue
+            event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+## export
+
+def _labels(**labels):
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def prometheus_text():
+    """All shared metrics in the Prometheus text exposition format (version 0.0.4)."""
+    flush(force=True)
+    with db.engines[METRICS_BIND].connect() as conn:
+        rows = conn.execute(select(RequestMetric.endpoint, RequestMetric.metric,
+                                   RequestMetric.bucket, RequestMetric.value)).all()
+
+    table = {}
+    for endpoint, metric, bucket, value in rows:
+        table.setdefault(metric, {}).setdefault(endpoint, {})[bucket] = value
+
+    lines = []
+    for metric, buckets in BUCKETS.items():
+        lines += [f"# HELP cm_{metric} {DESCRIPTIONS[metric]}", f"# TYPE cm_{metric} histogram"]
+        for endpoint, values in sorted(table.get(metric, {}).items()):
+            cumulative = 0
+            for upper in [repr(b) for b in buckets] + ["+Inf"]:
+                cumulative += values.get(upper, 0)
+                lines.append(f"cm_{metric}_bucket{_labels(endpoint=endpoint, le=upper)} {cumulative:g}")
+            lines.append(f"cm_{metric}_sum{_labels(endpoint=endpoint)} {values.get('sum', 0):g}")
+            lines.append(f"cm_{metric}_count{_labels(endpoint=endpoint)} {cumulative:g}")
+
+    lines += ["# HELP cm_responses_total Responses by status code.", "# TYPE cm_responses_total counter"]
+    for endpoint, values in sorted(table.get("responses", {}).items()):
+        for status, count in sorted(values.items()):
+            lines.append(f"cm_responses_total{_labels(endpoint=endpoint, status=status)} {count:g}")
+
+    lines += [f"# HELP cm_slow_queries_total Statements slower than {SLOW_QUERY_SECONDS}s.",
+              "# TYPE cm_slow_queries_total counter"]
+    for endpoint, values in sorted(table.get("slow_queries", {}).items()):
+        lines.append(f"cm_slow_queries_total{_labels(endpoint=endpoint)} {values.get('', 0):g}")
+
+    return "\n".join(lines) + "\n"
+
+
+def recent_slow_queries(limit=100):
+    """Newest slow statements first, as dicts."""
+    flush(force=True)
+    with db.engines[METRICS_BIND].connect() as conn:
+        rows = conn.execute(select(SlowQuery).order_by(SlowQuery.id.desc()).limit(limit)).mappings().all()
+    return [
+        {"recorded_at": row["recorded_at"].isoformat(timespec="seconds"), "endpoint": row["endpoint"],
+         "seconds": round(row["seconds"], 4), "statement": row["statement"]}
+        for row in rows
+    ]
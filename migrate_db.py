@@ -0,0 +1,82 @@
+"""
+migrate_db.py
+
+Bulk copy of the application databases to another backend, typically from the two SQLite
+files in `data/` to PostgreSQL.
+
+Usage:
+    flask --app app copy-db --main postgresql://cm:pw@localhost/cm_testing
+    flask --app app copy-db --main postgresql://... --users postgresql://.../cm_users
+
+`--users` defaults to the `--main` target, so both binds can share one PostgreSQL database.
+The target schema is created with `create_all()`, rows are copied table by table in
+`executemany` batches (parents before children), and PostgreSQL id sequences are moved past
+the copied ids. Afterwards start the app with `CM_DATABASE_URI` / `CM_USERS_DATABASE_URI`
+set to the new URIs.
+
+The command refuses to copy into tables that already contain rows.
+"""
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine, func, select, text
+
+from models import db
+
+BATCH_SIZE = 5000
+
+
+def copy_table(table, source, target, batch_size=BATCH_SIZE):
+    """Copy all rows of `table` from the `source` engine to the `target` engine; returns the row count."""
+    copied = 0
+    order = list(table.primary_key.columns)
+    with source.connect() as src, target.begin() as dst:
+        result = src.execution_options(stream_results=True).execute(select(table).order_by(*order))
+        for rows in result.mappings().partitions(batch_size):
+            dst.execute(table.insert(), [dict(row) for row in rows])
+            copied += len(rows)
+    return copied
+
+
+def reset_sequences(table, target):
+    """Move a PostgreSQL SERIAL sequence past the ids that were copied in explicitly."""
+    if target.dialect.name != "postgresql" or "id" not in table.c:
+        return
+    with target.begin() as conn:
+        max_id = conn.execute(select(func.max(table.c.id))).scalar()
+        if max_id is not None:
+            conn.execute(
+                text("SELECT setval(pg_get_serial_sequence(:table, 'id'), :max_id)"),
+                {"table": table.name, "max_id": max_id},
+            )
+
+
+@click.command("copy-db")
+@click.option("--main", "main_uri", required=True, help="Target URI for the test entry tables.")
+@click.option("--users", "users_uri", default=None, help="Target URI for the users table (defaults to --main).")
+@click.option("--batch-size", default=BATCH_SIZE, show_default=True, help="Rows per executemany batch.")
+@with_appcontext
+def copy_db_command(main_uri, users_uri, batch_size):
+    """Copy every table of the configured databases into MAIN/USERS targets."""
+    targets = {"main": main_uri, "users": users_uri or main_uri}
+    target_engines = {}
+
+    for bind_key, metadata in db.metadatas.items():
+        if bind_key not in targets or not metadata.tables:
+            continue
+
+        uri = targets[bind_key]
+        target = target_engines.setdefault(uri, create_engine(uri))
+        metadata.create_all(target)
+
+        for table in metadata.sorted_tables:
+            with target.connect() as conn:
+                if conn.execute(select(func.count()).select_from(table)).scalar():
+                    raise click.ClickException(f"Target table {table.name} is not empty; refusing to copy.")
+
+            copied = copy_table(table, db.engines[bind_key], target, batch_size)
+            reset_sequences(table, target)
+            click.echo(f"{bind_key}.{table.name}: {copied} rows")
+
+    for engine in target_engines.values():
+        engine.dispose()
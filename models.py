@@ -9,23 +9,79 @@ Models:
 - TestEntry: Stores all test data, file uploads, form status flags, contributor tracking, and locking info.
 - EntryHistory: (Not Implemented) Tracks incremental form submissions and contributor changes.
 - DeletedEntry: Archives entries deleted by administrators for recovery.
+- SecurityEvent: Per-window counters of failed logins / admin checks, shared by all workers.
+- RequestMetric / SlowQuery: Request histograms and slow statements collected by metrics.py.
+- ArchivedEntry: Compressed cold-storage copy of an old TestEntry or DeletedEntry (see archive.py).
+- Upload: Manifest of every uploaded file and the entry it was uploaded for (see uploads.py).
+- StepTiming: When a form page was entered and submitted, one row per submission (see step_timing.py).
+- DailyRollup: Per-day counters of finished / failed / cleared tests and technician work (see rollups.py).
+- MaintenanceState: Named JSON values that maintenance jobs keep between runs (`load_state` / `save_state`).
+- Job: A queued, running or finished background job with its progress and result (see jobs.py).
 
 Classes:
 - FormField: Represents an individual form field, with metadata, validation logic, and type support.
 - FormPage: Groups multiple FormFields into a logical page for multi-step form rendering.
 
 Notes:
-- Uses SQLite JSON columns for flexible field storage.
-- All models are bound to separate database engines using `__bind_key__`.
+- Uses dialect-neutral JSON columns for flexible field storage (JSONB on PostgreSQL).
+- All models are bound to separate database engines using `__bind_key__`; each bind can be a
+  SQLite file or a PostgreSQL database, chosen by URI.
+- `json_key(column, key)` reads one key of a JSON column with the key inlined in the SQL, so
+  the CM_serial expression indexes match the queries on SQLite as well as on PostgreSQL.
+- TestEntry rows carry a `version` counter (SQLAlchemy `version_id_col`); a write based on an
+  outdated copy of the row raises `StaleDataError` instead of silently overwriting it.
+- `add_missing_columns()` / `add_missing_indexes()` bring tables created by older versions of the app up to date.
 - FormField and FormPage are used for dynamic form rendering and validation logic.
 """
 
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
-from sqlalchemy.dialects.sqlite import JSON
+from sqlalchemy import inspect, text
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateColumn, CreateIndex
+from sqlalchemy.sql.functions import FunctionElement
+from sqlalchemy.sql.visitors import InternalTraversal
+from db_engine import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
+
+# plain JSON (SQLite JSON1) everywhere, JSONB on PostgreSQL so it can be indexed
+JSON = db.JSON().with_variant(JSONB(), "postgresql")
+
+
+class json_key(FunctionElement):  # pylint: disable=invalid-name,too-many-ancestors
+    """`column[key]` as text, or as an integer with `as_integer=True`.
+
+    Same SQL as `column[key].as_string()` / `.as_integer()`, except that on SQLite the JSON
+    path is written into the statement instead of being a bound parameter: SQLite only uses
+    an expression index when the query contains the very same expression."""
+
+    inherit_cache = True
+    _traverse_internals = FunctionElement._traverse_internals + [
+        ("key", InternalTraversal.dp_string),
+        ("as_integer", InternalTraversal.dp_boolean),
+    ]
+
+    def __init__(self, column, key, as_integer=False):
+        self.key = key
+        self.as_integer = as_integer
+        self.type = db.Integer() if as_integer else db.String()
+        super().__init__(column)
+
+
+@compiles(json_key)
+def _compile_json_key(element, compiler, **kw):
+    column = element.clauses.clauses[0][element.key]
+    return compiler.process(column.as_integer() if element.as_integer else column.as_string(), **kw)
+
+
+@compiles(json_key, "sqlite")
+def _compile_json_key_sqlite(element, compiler, **kw):
+    path = "$." + '"' + element.key.replace('"', '""').replace("'", "''") + '"'
+    extract = f"json_extract({compiler.process(element.clauses.clauses[0], **kw)}, '{path}')"
+    return f"CAST({extract} AS INTEGER)" if element.as_integer else extract
 
 class User(db.Model):
     """User model for authentication."""
@@ -77,20 +133,45 @@ class TestEntry(db.Model):
     lock_owner = db.Column(db.String(80), nullable=True)
     lock_acquired_at = db.Column(db.DateTime, nullable=True)
 
+    # optimistic concurrency: bumped on every UPDATE, checked in its WHERE clause
+    version = db.Column(db.Integer, nullable=False, server_default="1")
+    # seq of the next EntryHistory row (entry_history.py); NULL until known, then looked up
+    history_seq = db.Column(db.Integer, nullable=True)
+
+    __mapper_args__ = {"version_id_col": version}
+
+
+# indexes for the hot queries in queries.py; `flask check-query-plans` verifies they are used
+db.Index("ix_test_entry_cm_serial_text", json_key(TestEntry.data, "CM_serial"))
+db.Index("ix_test_entry_cm_serial_latest", json_key(TestEntry.data, "CM_serial", as_integer=True), TestEntry.timestamp)
+db.Index(
+    "ix_test_entry_failed_latest", TestEntry.failure, TestEntry.fail_stored,
+    json_key(TestEntry.data, "CM_serial", as_integer=True), TestEntry.timestamp,
+)
+db.Index("ix_test_entry_saved", TestEntry.is_saved, TestEntry.timestamp)
+db.Index("ix_test_entry_finished", TestEntry.is_finished, TestEntry.timestamp)
+db.Index("ix_test_entry_parent", TestEntry.parent_id)
+
 
 class EntryHistory(db.Model):
-    """Model to keep track of who added / changed what in a test entry.
-    Currently unimplemented, but can be used to track changes"""
+    """Append-only change log of a TestEntry, written by entry_history.py.
+    Row `seq` 0 and every HISTORY_CHECKPOINT_EVERY-th row is a checkpoint holding the full
+    data and status, the rows between hold only the keys that changed."""
 
     __bind_key__ = 'main'
-    #TODO need to implement in save and exit logic
+    __table_args__ = (db.UniqueConstraint('entry_id', 'seq'),)
+
     id = db.Column(db.Integer, primary_key=True)
     entry_id = db.Column(db.Integer, db.ForeignKey('test_entry.id'), nullable=False)
+    seq = db.Column(db.Integer, nullable=False, default=0)      # 0, 1, 2, ... per entry
+    checkpoint = db.Column(db.Boolean, default=False)
     username = db.Column(db.String(80), nullable=False)
     form_index = db.Column(db.Integer)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
-    creation_time = db.Column(db.DateTime, nullable=True)
-    changes = db.Column(JSON)  # Optional: record diff or snapshot of fields
+    creation_time = db.Column(db.DateTime, nullable=True)       # created_at of the entry
+    changes = db.Column(JSON)   # checkpoint: {"data", "state"}; else any of {"set", "unset", "state"}
+
+    entry = db.relationship('TestEntry')
 
 class DeletedEntry(db.Model):
     """Model for admin deleted entries that are stored in the admin deleted entries table """
@@ -106,6 +187,213 @@ class DeletedEntry(db.Model):
     fail_reason = db.Column(db.Text)
     failure = db.Column(db.Boolean)
     was_locked = db.Column(db.String(80))       # lock owner at deletion, if any
+    test = db.Column(db.Boolean, default=False) # was a dummy (test) entry
+
+def add_missing_columns():
+    """Add columns declared on the models but missing from existing tables.
+    `db.create_all()` only creates missing tables, so older data/*.db files need this."""
+    for bind_key, metadata in db.metadatas.items():
+        engine = db.engines[bind_key]
+        inspector = inspect(engine)
+        for table in metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                with engine.begin() as conn:
+                    conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}"))
+
+def add_missing_indexes():
+    """Create indexes declared on the models but missing from existing tables (`db.create_all()`
+    only creates indexes together with a new table)."""
+    for bind_key, metadata in db.metadatas.items():
+        with db.engines[bind_key].begin() as conn:
+            for table in metadata.sorted_tables:
+                for index in table.indexes:
+                    # IF NOT EXISTS: reflection can't see expression indexes, so checkfirst won't do
+                    conn.execute(CreateIndex(index, if_not_exists=True))
+
+class SecurityEvent(db.Model):
+    """Count of one kind of security event (failed login, denied admin check) for one subject
+    in one fixed time window. Each subject owns a ring of slots that are reused once their
+    window has passed, see security_events.py."""
+
+    __bind_key__ = 'users'
+    __tablename__ = 'security_event'
+    __table_args__ = (db.UniqueConstraint('kind', 'subject', 'slot'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    subject = db.Column(db.String(120), nullable=False)  # username, "user:<name>" or "ip:<address>"
+    slot = db.Column(db.Integer, nullable=False)          # window index modulo the ring size
+    window_start = db.Column(db.Integer, nullable=False, index=True)  # epoch seconds
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+class ArchivedEntry(db.Model):
+    """One finished TestEntry (or one of its EntryHistory rows) or old DeletedEntry moved out of
+    the main database by archive.py.
+    `record` holds all columns of the source row as zlib-compressed JSON; the plain columns
+    are only what listing and read-through need."""
+
+    __bind_key__ = 'archive'
+    __tablename__ = 'archived_entry'
+    __table_args__ = (
+        db.UniqueConstraint('kind', 'source_id'),
+        db.Index('ix_archived_entry_serial_latest', 'kind', 'cm_serial', 'timestamp'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(16), nullable=False)      # "test_entry", "entry_history" or "deleted_entry"
+    source_id = db.Column(db.Integer, nullable=False)    # id in the source table
+    entry_id = db.Column(db.Integer, index=True)         # TestEntry id (original_entry_id for deleted entries)
+    parent_id = db.Column(db.Integer, index=True)
+    cm_serial = db.Column(db.Integer)
+    timestamp = db.Column(db.DateTime, index=True)       # entry timestamp, or deleted_at
+    archived_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    record = db.Column(db.LargeBinary, nullable=False)
+
+class Upload(db.Model):
+    """One file written by `utils.process_file_fields`. `entry_id` is the first TestEntry that
+    referenced the file; it stays NULL for uploads of drafts that were never saved."""
+
+    __bind_key__ = 'main'
+    __tablename__ = 'upload'
+
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(255), nullable=False, unique=True)   # relative to UPLOAD_FOLDER
+    size = db.Column(db.Integer, nullable=False)
+    field_name = db.Column(db.String(120))
+    entry_id = db.Column(db.Integer, index=True)   # no foreign key: kept after the entry is deleted
+    uploaded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+class Measurement(db.Model):
+    """One form field value of a TestEntry, typed: `num_value` is set for integer / float
+    fields. Rewritten from `TestEntry.data` whenever it changes (measurements.py) and deleted
+    with the entry by the database (ON DELETE CASCADE)."""
+
+    __bind_key__ = 'main'
+    __tablename__ = 'measurement'
+    __table_args__ = (
+        db.UniqueConstraint('entry_id', 'field_name'),
+        db.Index('ix_measurement_field_num', 'field_name', 'num_value'),
+        db.Index('ix_measurement_field_text', 'field_name', 'text_value'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    entry_id = db.Column(db.Integer, db.ForeignKey('test_entry.id', ondelete='CASCADE'), nullable=False)
+    field_name = db.Column(db.String(120), nullable=False)
+    num_value = db.Column(db.Float)
+    text_value = db.Column(db.Text)
+
+class StepTiming(db.Model):
+    """One submission of one form page: when the technician opened the page and when it was
+    submitted (epoch seconds), and how (`action`). Append-only, written by step_timing.py."""
+
+    __bind_key__ = 'main'
+    __tablename__ = 'step_timing'
+    __table_args__ = (db.Index('ix_step_timing_step_submitted', 'step', 'submitted_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    entry_id = db.Column(db.Integer, index=True)     # no foreign key: timings outlive archived / deleted entries
+    step = db.Column(db.Integer, nullable=False)
+    username = db.Column(db.String(80), nullable=False)
+    action = db.Column(db.String(8), nullable=False)  # "next", "save" or "fail"
+    entered_at = db.Column(db.Integer, nullable=False)
+    submitted_at = db.Column(db.Integer, nullable=False)
+
+class DailyRollup(db.Model):
+    """One per-day counter kept by rollups.py: `metric` is e.g. "finished" or "failed_by",
+    `key` what it is counted by (a page index, a username, "" for totals). `seconds` sums the
+    test durations of "finished"."""
+
+    __bind_key__ = 'main'
+    __tablename__ = 'daily_rollup'
+    __table_args__ = (db.UniqueConstraint('day', 'metric', 'key'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    metric = db.Column(db.String(32), nullable=False)
+    key = db.Column(db.String(120), nullable=False, default="")
+    count = db.Column(db.Integer, nullable=False, default=0)
+    seconds = db.Column(db.Float, nullable=False, default=0)
+
+class MaintenanceState(db.Model):
+    """Progress of a resumable maintenance job (e.g. the upload GC cursor), by job name."""
+
+    __bind_key__ = 'main'
+    __tablename__ = 'maintenance_state'
+
+    name = db.Column(db.String(64), primary_key=True)
+    value = db.Column(JSON)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+def load_state(name, default=None):
+    """Value last saved under `name` by `save_state`, or `default`."""
+    state = db.session.get(MaintenanceState, name)
+    return default if state is None else state.value
+
+def save_state(name, value):
+    """Store `value` under `name`; committed with the caller's session."""
+    state = db.session.get(MaintenanceState, name)
+    if state is None:
+        db.session.add(MaintenanceState(name=name, value=value))
+    else:
+        state.value = value
+
+class Job(db.Model):
+    """One background job run by jobs.py: what to run (`kind`, `params`), who asked, and how
+    far it got. `claimed_by` / `heartbeat_at` tell which worker runs it and whether that
+    worker is still alive; `result` holds e.g. the export file name."""
+
+    __bind_key__ = 'main'
+    __tablename__ = 'job'
+    __table_args__ = (db.Index('ix_job_status_id', 'status', 'id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    params = db.Column(JSON)
+    status = db.Column(db.String(16), nullable=False, default="queued")  # queued, running, done, failed, cancelled
+    created_by = db.Column(db.String(80))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    claimed_by = db.Column(db.String(120))
+    heartbeat_at = db.Column(db.DateTime)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    result = db.Column(JSON)
+    error = db.Column(db.Text)
+
+class RequestMetric(db.Model):
+    """One histogram bucket (or `sum`, or a status code of the response counter) of one
+    per-endpoint request metric, summed over all workers; see metrics.py."""
+
+    __bind_key__ = 'metrics'
+    __tablename__ = 'request_metric'
+    __table_args__ = (db.UniqueConstraint('endpoint', 'metric', 'bucket'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    endpoint = db.Column(db.String(120), nullable=False)
+    metric = db.Column(db.String(32), nullable=False)
+    bucket = db.Column(db.String(16), nullable=False)   # upper bound, "+Inf", "sum" or status code
+    value = db.Column(db.Float, nullable=False, default=0)
+
+class SlowQuery(db.Model):
+    """A SQL statement that took longer than metrics.SLOW_QUERY_SECONDS, with the route that ran it."""
+
+    __bind_key__ = 'metrics'
+    __tablename__ = 'slow_query'
+
+    id = db.Column(db.Integer, primary_key=True)
+    recorded_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    endpoint = db.Column(db.String(120), nullable=False)
+    seconds = db.Column(db.Float, nullable=False)
+    statement = db.Column(db.Text, nullable=False)
 
 class FormField:
     def __init__(
@@ -0,0 +1,266 @@
+"""
+queries.py
+
+Registry of the hot TestEntry queries. The routes build their queries here, and
+`flask check-query-plans` runs EXPLAIN QUERY PLAN on exactly the same statements.
+
+Queries:
+- latest_per_serial(*criteria): newest entry per CM serial (history / export "unique" view)
+- failed_pending_retest(): newest stored failure per CM serial (/failed_tests)
+- serial_in_use(cm_serial): saved or pending-retest entry blocking a new form (step 0 of /form)
+- saved_entries(): saved forms (/dashboard)
+- unfinished_entries(): all unfinished forms (/admin/admin_dashboard)
+- lineage(cm_serial=..., entry_id=...): every attempt of a CM's retest tree(s) with its depth,
+  in one recursive CTE (/lineage)
+- retest_pairs(serial_min, serial_max): retests in a serial range with their parents joined in
+  (/diff/retests)
+- with_parents(query): eager-loads `TestEntry.parent` for list pages that show "retest of"
+- measurement_range(field, low, high) / measurement_top(field, k): entries by the numeric
+  value of one form field (/measurements/<field>), on the typed measurement table
+
+`HOT_QUERIES` maps a name to a builder with sample arguments and the indexes its plan must
+use; see the index definitions under TestEntry in models.py. `ALLOWED_SCANS` lists the few
+plan lines that scan test_entry / measurement on purpose.
+
+Usage:
+    flask --app app check-query-plans                  # fresh SQLite database, seeded
+    flask --app app check-query-plans --seed-rows 50000
+    flask --app app check-query-plans --configured     # the app's own (SQLite) database
+
+The command fails (non-zero exit) when an expected index is missing from a plan or a plan
+scans test_entry or measurement (`SCAN test_entry ...`, also through an index) other than with
+a covering index or as allowed in `ALLOWED_SCANS`, so it can run in CI. The scratch database
+is seeded with `datagen.insert_entries`, which also fills the measurement table.
+"""
+
+import os
+import re
+import tempfile
+from datetime import datetime
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import create_engine, text, select, literal
+from sqlalchemy.orm import selectinload, joinedload
+
+from models import db, TestEntry, Measurement, json_key
+from constants import SERIAL_MIN, SERIAL_MAX
+
+
+def cm_serial(as_integer=True):
+    """The CM_serial of an entry, in the form the expression indexes are built on."""
+    return json_key(TestEntry.data, "CM_serial", as_integer=as_integer)
+
+
+def latest_per_serial(*criteria):
+    """Newest TestEntry (by timestamp) for each CM serial among the rows matching `criteria`."""
+    subquery = (
+        db.session.query(
+            cm_serial().label("cm_serial"),
+            db.func.max(TestEntry.timestamp).label("latest")
+        )
+        .filter(*criteria)
+        .group_by(cm_serial())
+        .subquery()
+    )
+
+    return (
+        db.session.query(TestEntry)
+        .join(subquery, db.and_(
+            cm_serial() == subquery.c.cm_serial,
+            TestEntry.timestamp == subquery.c.latest
+        ))
+        .order_by(TestEntry.timestamp.desc())
+    )
+
+
+def failed_pending_retest():
+    """Newest failed entry per CM serial that is still waiting for a retest or clear."""
+    return latest_per_serial(TestEntry.failure.is_(True), TestEntry.fail_stored.is_(True))
+
+
+def serial_in_use(cm_serial_value):
+    """Entries that block starting a new form for `cm_serial_value`: saved, or failed and pending retest."""
+    return TestEntry.query.filter(
+        cm_serial(as_integer=False) == str(cm_serial_value),
+        db.or_(
+            TestEntry.is_saved.is_(True),
+            db.and_(
+                TestEntry.failure.is_(True),
+                TestEntry.fail_stored.is_(True),
+                TestEntry.is_finished.is_(False)
+            )
+        )
+    )
+
+
+def saved_entries():
+    """Saved (in-progress, not locked open) forms, newest first."""
+    return TestEntry.query.filter_by(is_saved=True).order_by(TestEntry.timestamp.desc())
+
+
+def unfinished_entries():
+    """Every form that is not finished yet, newest first."""
+    return TestEntry.query.filter(TestEntry.is_finished.is_(False)).order_by(TestEntry.timestamp.desc())
+
+
+def lineage(cm_serial_value=None, entry_id=None):
+    """(TestEntry, depth) for every attempt in the retest trees of CM `cm_serial_value`, or in
+    the tree that contains `entry_id`, oldest first; depth 0 is a first attempt, a retest is
+    one deeper than the attempt it retests. One statement: recursive CTEs walk up from
+    `entry_id` to its first attempt and down `parent_id` from the first attempts."""
+    if entry_id is not None:
+        ancestors = select(TestEntry.id, TestEntry.parent_id).where(TestEntry.id == entry_id).cte("ancestors", recursive=True)
+        ancestors = ancestors.union_all(
+            select(TestEntry.id, TestEntry.parent_id).join(ancestors, TestEntry.id == ancestors.c.parent_id))
+        roots = select(ancestors.c.id, literal(0).label("depth")).where(ancestors.c.parent_id.is_(None))
+    else:
+        roots = select(TestEntry.id, literal(0).label("depth")).where(
+            cm_serial() == int(cm_serial_value), TestEntry.parent_id.is_(None))
+
+    tree = roots.cte("lineage", recursive=True)
+    tree = tree.union_all(
+        select(TestEntry.id, tree.c.depth + 1).join(tree, TestEntry.parent_id == tree.c.id))
+    return (
+        db.session.query(TestEntry, tree.c.depth)
+        .join(tree, TestEntry.id == tree.c.id)
+        .order_by(TestEntry.timestamp, TestEntry.id)
+    )
+
+
+def retest_pairs(serial_min, serial_max):
+    """Retests (entries with a parent) of CM serials in [serial_min, serial_max], each with its
+    parent loaded by the same statement, by serial and then oldest first."""
+    return (
+        TestEntry.query
+        .filter(cm_serial().between(serial_min, serial_max), TestEntry.parent_id.isnot(None))
+        .options(joinedload(TestEntry.parent))
+        .order_by(cm_serial(), TestEntry.timestamp)
+    )
+
+
+def with_parents(query):
+    """`query` with the parent of every entry loaded in one extra SELECT ... IN (no per-row lazy load)."""
+    return query.options(selectinload(TestEntry.parent))
+
+
+def _measured(field_name):
+    return (
+        db.session.query(TestEntry, Measurement.num_value)
+        .join(Measurement, Measurement.entry_id == TestEntry.id)
+        .filter(Measurement.field_name == field_name, Measurement.num_value.isnot(None))
+    )
+
+
+def measurement_range(field_name, low=None, high=None):
+    """(TestEntry, value) for entries whose numeric `field_name` is within [low, high], lowest first."""
+    query = _measured(field_name)
+    if low is not None:
+        query = query.filter(Measurement.num_value >= low)
+    if high is not None:
+        query = query.filter(Measurement.num_value <= high)
+    return query.order_by(Measurement.num_value, TestEntry.id)
+
+
+def measurement_top(field_name, k, largest=True):
+    """(TestEntry, value) for the `k` entries with the largest (or smallest) `field_name`."""
+    order = Measurement.num_value.desc() if largest else Measurement.num_value
+    return _measured(field_name).order_by(order).limit(k)
+
+
+# name -> (builder with sample arguments, indexes the plan has to use)
+HOT_QUERIES = {
+    "history_unique": (latest_per_serial, {"ix_test_entry_cm_serial_latest"}),
+    "failed_tests": (failed_pending_retest, {"ix_test_entry_failed_latest", "ix_test_entry_cm_serial_latest"}),
+    "form_serial_in_use": (lambda: serial_in_use(SERIAL_MIN), {"ix_test_entry_cm_serial_text"}),
+    "dashboard_saved": (saved_entries, {"ix_test_entry_saved"}),
+    "admin_dashboard_unfinished": (unfinished_entries, {"ix_test_entry_finished"}),
+    "lineage_serial": (lambda: lineage(SERIAL_MIN), {"ix_test_entry_cm_serial_latest", "ix_test_entry_parent"}),
+    "lineage_entry": (lambda: lineage(entry_id=1), {"ix_test_entry_parent"}),
+    "retest_pairs": (lambda: retest_pairs(SERIAL_MIN, SERIAL_MAX), {"ix_test_entry_cm_serial_latest"}),
+    "measurement_range": (lambda: measurement_range("current_draw", 100.0, 200.0), {"ix_measurement_field_num"}),
+    "measurement_top": (lambda: measurement_top("current_draw", 10), {"ix_measurement_field_num"}),
+}
+
+# name -> plan lines that may scan: the unique view needs every serial, so one pass over the
+# serial index is the least it can read (SQLite never reports expression indexes as covering)
+ALLOWED_SCANS = {
+    "history_unique": {"SCAN test_entry USING INDEX ix_test_entry_cm_serial_latest"},
+}
+
+FULL_SCAN = re.compile(r"^SCAN (test_entry|measurement)(_\d+)?\b")
+COVERING_SCAN = re.compile(r"\bUSING COVERING INDEX\b")
+
+
+def query_plan(conn, query):
+    """EXPLAIN QUERY PLAN detail lines of a Query, on the SQLite connection `conn`."""
+    sql = query.statement.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+    return [row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {sql}"))]
+
+
+def plan_problems(plan, expected_indexes, allowed_scans=()):
+    """Reasons the plan is not acceptable; empty if it is."""
+    problems = [
+        f"full scan: {line}" for line in (line.strip() for line in plan)
+        if FULL_SCAN.match(line) and not COVERING_SCAN.search(line) and line not in allowed_scans
+    ]
+    for index in sorted(expected_indexes):
+        if not any(re.search(rf"\bINDEX {index}\b", line) for line in plan):
+            problems.append(f"index {index} not used")
+    return problems
+
+
+def check_plans(conn):
+    """Run every HOT_QUERIES plan on `conn`; returns {name: (plan, problems)}."""
+    results = {}
+    for name, (build, expected_indexes) in HOT_QUERIES.items():
+        plan = query_plan(conn, build())
+        results[name] = (plan, plan_problems(plan, expected_indexes, ALLOWED_SCANS.get(name, ())))
+    return results
+
+
+@click.command("check-query-plans")
+@click.option("--seed-rows", default=5000, show_default=True, help="Generated entries in the scratch database.")
+@click.option("--configured", is_flag=True, help="Check the app's configured database instead of a scratch copy.")
+@with_appcontext
+def check_query_plans_command(seed_rows, configured):
+    """Check that the hot queries use their indexes and never scan test_entry."""
+    # imported here: datagen is only needed for the scratch database
+    from datagen import EntryGenerator, insert_entries  # pylint: disable=import-outside-toplevel
+
+    if configured:
+        engine = db.engines[TestEntry.__bind_key__]
+        if engine.dialect.name != "sqlite":
+            raise click.ClickException("EXPLAIN QUERY PLAN checks need a SQLite database.")
+        scratch_dir = None
+    else:
+        scratch_dir = tempfile.TemporaryDirectory(prefix="cm_plans_")  # pylint: disable=consider-using-with
+        engine = create_engine(f"sqlite:///{os.path.join(scratch_dir.name, 'plans.db')}")
+        db.metadatas[TestEntry.__bind_key__].create_all(engine)
+        generator = EntryGenerator(seed=0, start=datetime(2025, 1, 1), failure_rate=0.15,
+                                   retest_rate=0.8, saved_rate=0.05, locked_rate=0.3)
+        insert_entries(generator, seed_rows, SERIAL_MIN, SERIAL_MAX, engine=engine)
+
+    failed = 0
+    try:
+        with engine.connect() as conn:
+            if conn.execute(select(Measurement.id).limit(1)).first() is None:
+                if scratch_dir is not None:
+                    raise click.ClickException("The scratch database has no measurements to plan against.")
+                click.echo("warning: the measurement table is empty; run `flask measurements backfill` "
+                           "first, or the measurement plans are not representative")
+            for name, (plan, problems) in check_plans(conn).items():
+                click.echo(f"{'FAIL' if problems else 'ok  '} {name}")
+                for line in plan:
+                    click.echo(f"       {line}")
+                for problem in problems:
+                    click.echo(f"     ! {problem}")
+                failed += bool(problems)
+    finally:
+        if scratch_dir is not None:
+            engine.dispose()
+            scratch_dir.cleanup()
+
+    if failed:
+        raise click.ClickException(f"{failed} of {len(HOT_QUERIES)} hot queries have a bad plan.")
+    click.echo(f"All {len(HOT_QUERIES)} hot queries use their indexes.")
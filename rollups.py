@@ -0,0 +1,321 @@
+"""
+rollups.py
+
+Daily rollups of test throughput and technician productivity, in the `daily_rollup` table
+(main database), so trend pages over months or years read a few hundred counter rows
+instead of every entry's JSON.
+
+Counters per day (`metric` / `key`):
+- finished / "": tests finished; `seconds` sums their duration (created_at to finish), so
+  seconds / count is the mean time per CM
+- failed / "": tests failed
+- cleared / "": failures cleared without a retest
+- page_failed / page index: failures by the form page they failed on
+- finished_by, failed_by / username: finished and failed tests by contributing technician
+
+The day is the entry's timestamp (Eastern time), i.e. when it finished or failed; a clear is
+counted on the day of its failure.
+
+Keeping them current:
+- an `after_flush` hook compares the old and new status of every written TestEntry and adds
+  the finish / fail / clear events to the counters, in the same transaction (ORM writes:
+  /form, /clear_failed, admin routes)
+- bulk clear (bulk_entries.py) calls `add_events` with the rows it updated
+- deleting or archiving an entry keeps its counts (the test did happen)
+- `flask rollups backfill` recomputes the counters from the current status of all entries,
+  archived ones included (`--since` limits it to recent days), e.g. for entries written
+  before this table existed or by `flask generate-entries`
+
+Read by `trends()` for `/trends`.
+
+Usage:
+    flask --app app rollups backfill
+    flask --app app rollups backfill --since 2025-01-01
+"""
+
+from collections import defaultdict
+from datetime import date, datetime, timedelta, timezone
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, select, delete, inspect
+
+from models import db, TestEntry, DailyRollup, ArchivedEntry, json_key
+from db_engine import RoutingSession, upsert_insert
+from constants import EASTERN_TZ
+from archive import unpack, TEST_ENTRY
+from search import session_connection
+
+EVENTS = ("finished", "failed", "cleared")
+BUCKETS = ("day", "week", "month")
+TOTAL = ""
+
+
+## events
+
+def _finished(status):
+    return bool(status.get("is_finished")) and not status.get("failure")
+
+
+def _cleared(status):
+    return bool(status.get("failure")) and bool(status.get("is_finished"))
+
+
+def entry_events(old, new):
+    """Status events from status `old` (None for a new entry) to `new`; both are mappings
+    with failure, fail_stored and is_finished."""
+    old = old or {}
+    events = []
+    if _finished(new) and not _finished(old):
+        events.append("finished")
+    if new.get("failure") and not old.get("failure"):
+        events.append("failed")
+    if _cleared(new) and not _cleared(old):
+        events.append("cleared")
+    return events
+
+
+def _as_utc(value, zone):
+    """Aware UTC datetime; naive values are wall time in `zone`."""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=zone)
+    return value.astimezone(timezone.utc)
+
+
+def event_day(timestamp):
+    """Eastern calendar day of an entry timestamp (stored naive in Eastern time)."""
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(EASTERN_TZ)
+    return timestamp.date()
+
+
+def _page(data):
+    try:
+        return str(int((data or {}).get("last_step", 0)))
+    except (TypeError, ValueError):
+        return "0"
+
+
+def count_events(counts, entry, events):
+    """Add the counters of `events` of one entry to `counts` ({(day, metric, key): [count,
+    seconds]}). `entry` is a mapping with timestamp, created_at, data and contributors."""
+    if not events or entry["timestamp"] is None:
+        return
+    day = event_day(entry["timestamp"])
+    for name in events:
+        counts[(day, name, TOTAL)][0] += 1
+        if name == "cleared":
+            continue
+        for username in entry["contributors"] or []:
+            counts[(day, f"{name}_by", username)][0] += 1
+        if name == "failed":
+            counts[(day, "page_failed", _page(entry["data"]))][0] += 1
+        elif entry["created_at"] is not None:
+            seconds = (_as_utc(entry["timestamp"], EASTERN_TZ) - _as_utc(entry["created_at"], timezone.utc)).total_seconds()
+            counts[(day, name, TOTAL)][1] += max(seconds, 0.0)
+
+
+def _upsert(conn, counts, replace=False):
+    """Add `counts` to the stored counters (overwrite them with `replace`)."""
+    if not counts:
+        return
+    table = DailyRollup.__table__
+    stmt = upsert_insert(conn)(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["day", "metric", "key"],
+        set_={"count": stmt.excluded.count, "seconds": stmt.excluded.seconds} if replace else
+             {"count": table.c.count + stmt.excluded.count, "seconds": table.c.seconds + stmt.excluded.seconds},
+    )
+    conn.execute(stmt, [
+        {"day": day, "metric": metric, "key": key, "count": count, "seconds": seconds}
+        for (day, metric, key), (count, seconds) in counts.items()
+    ])
+
+
+def add_events(conn, entries):
+    """Count the events of (old status, new entry values) pairs; `conn` is a Connection to the
+    main database, runs in its transaction."""
+    counts = defaultdict(lambda: [0, 0.0])
+    for old, new in entries:
+        count_events(counts, new, entry_events(old, new))
+    _upsert(conn, counts)
+
+
+## write hook
+
+STATUS_FIELDS = ("failure", "fail_stored", "is_finished")
+ENTRY_FIELDS = STATUS_FIELDS + ("timestamp", "created_at", "data", "contributors")
+
+
+def _old_status(session, entry):
+    """Status of a written entry before this flush (None for a new one), from the attribute
+    history, or read from the database when the old values were never loaded."""
+    state = inspect(entry)
+    if not state.has_identity:
+        return None
+    status = {}
+    for field in STATUS_FIELDS:
+        history = state.attrs[field].history
+        if history.deleted:
+            status[field] = history.deleted[0]
+        elif not history.added and field not in state.unloaded:
+            status[field] = getattr(entry, field)
+        else:
+            table = TestEntry.__table__
+            row = session.execute(
+                select(*(table.c[f] for f in STATUS_FIELDS)).where(table.c.id == entry.id)
+            ).mappings().first()
+            return dict(row) if row else None
+    return status
+
+
+def _status_written(entry):
+    state = inspect(entry)
+    return not state.has_identity or any(state.attrs[f].history.has_changes() for f in STATUS_FIELDS)
+
+
+@event.listens_for(RoutingSession, "before_flush")
+def _note_old_status(session, _flush_context, _instances):
+    # the old status is gone once the UPDATE ran, so it is taken before the flush
+    session.info["rollup_old_status"] = {
+        id(entry): (entry, _old_status(session, entry))
+        for entry in list(session.new) + list(session.dirty)
+        if isinstance(entry, TestEntry) and _status_written(entry)
+    }
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _count_entry_events(session, _flush_context):
+    noted = session.info.pop("rollup_old_status", {})
+    written = [(old, {field: getattr(entry, field) for field in ENTRY_FIELDS}) for entry, old in noted.values()]
+    if any(entry_events(old, new) for old, new in written):
+        add_events(session_connection(session), written)
+
+
+## backfill
+
+def _entry_values(row):
+    return {key: row[key] for key in ENTRY_FIELDS}
+
+
+def backfill(*, since=None, batch_size=1000, progress=None):
+    """Recompute the counters of all days (from `since` on) from the current status of the
+    entries and archived entries; returns the number of entries read."""
+    engine = db.engines[TestEntry.__bind_key__]
+    table = TestEntry.__table__
+    counts = defaultdict(lambda: [0, 0.0])
+    done, last_id = 0, 0
+
+    columns = [table.c.id, *(table.c[f] for f in STATUS_FIELDS), table.c.timestamp, table.c.created_at,
+               table.c.contributors, json_key(table.c.data, "last_step").label("last_step")]
+    while True:
+        query = select(*columns).where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+        if since is not None:
+            query = query.where(table.c.timestamp >= since)
+        with engine.connect() as conn:
+            rows = conn.execute(query).mappings().all()
+        if not rows:
+            break
+        for row in rows:
+            values = {**row, "data": {"last_step": row["last_step"]}}
+            count_events(counts, values, entry_events(None, values))
+        done += len(rows)
+        last_id = rows[-1]["id"]
+        if progress:
+            progress(done)
+
+    archived = db.session.query(ArchivedEntry).filter(ArchivedEntry.kind == TEST_ENTRY)
+    if since is not None:
+        archived = archived.filter(ArchivedEntry.timestamp >= since)
+    for record in archived.yield_per(batch_size):
+        values = _entry_values(unpack(record))
+        count_events(counts, values, entry_events(None, values))
+        done += 1
+
+    with engine.begin() as conn:
+        stale = delete(DailyRollup)
+        if since is not None:
+            stale = stale.where(DailyRollup.day >= since.date())
+        conn.execute(stale)
+        _upsert(conn, counts, replace=True)
+    return done
+
+
+rollups_cli = AppGroup("rollups", help="Daily throughput rollup maintenance.")
+
+
+@rollups_cli.command("backfill")
+@click.option("--since", type=click.DateTime(formats=["%Y-%m-%d"]), default=None,
+              help="Only recompute days from this date on (default: all).")
+@click.option("--batch-size", default=1000, show_default=True, help="Entries read per query.")
+def backfill_command(since, batch_size):
+    """Recompute the daily rollups from the stored entries."""
+    read = backfill(since=since, batch_size=batch_size, progress=lambda n: click.echo(f"  {n} entries", err=True))
+    click.echo(f"Recomputed daily rollups from {read} entries.")
+
+
+## reading
+
+def bucket_start(day, by):
+    """First day of the day / week (Monday) / month bucket containing `day`."""
+    if by == "week":
+        return day - timedelta(days=day.weekday())
+    if by == "month":
+        return day.replace(day=1)
+    return day
+
+
+def trends(start, end=None, by="day"):
+    """Rollups from `start` to `end` (dates, inclusive) summed per `by` bucket:
+    {"series": [{start, finished, failed, cleared, mean_minutes}], "pages": {page: failures},
+    "technicians": {username: {"finished", "failed"}}}."""
+    if by not in BUCKETS:
+        raise ValueError(f"Unknown bucket {by!r}")
+    end = end or datetime.now(EASTERN_TZ).date()
+    rows = db.session.execute(
+        select(DailyRollup.day, DailyRollup.metric, DailyRollup.key, DailyRollup.count, DailyRollup.seconds)
+        .where(DailyRollup.day.between(start, end))
+    ).all()
+
+    series = defaultdict(lambda: {"finished": 0, "failed": 0, "cleared": 0, "seconds": 0.0})
+    pages = defaultdict(int)
+    technicians = defaultdict(lambda: {"finished": 0, "failed": 0})
+    for day, metric, key, count, seconds in rows:
+        if metric in EVENTS:
+            bucket = series[bucket_start(day, by)]
+            bucket[metric] += count
+            bucket["seconds"] += seconds
+        elif metric == "page_failed":
+            pages[int(key)] += count
+        elif metric in ("finished_by", "failed_by"):
+            technicians[key][metric[:-3]] += count
+
+    points = []
+    day = bucket_start(start, by)
+    while day <= end:       # every bucket, so gaps show as zero
+        values = series.get(day, {"finished": 0, "failed": 0, "cleared": 0, "seconds": 0.0})
+        points.append({
+            "start": day.isoformat(), "finished": values["finished"], "failed": values["failed"],
+            "cleared": values["cleared"],
+            "mean_minutes": round(values["seconds"] / values["finished"] / 60, 1) if values["finished"] else None,
+        })
+        day = bucket_start(day + timedelta(days={"day": 1, "week": 7, "month": 32}[by]), by)
+    return {
+        "start": start.isoformat(), "end": end.isoformat(), "by": by, "series": points,
+        "pages": dict(sorted(pages.items())),
+        "technicians": dict(sorted(technicians.items(), key=lambda item: -sum(item[1].values()))),
+    }
+
+
+def default_start(by):
+    """Start of the default range shown for a bucket size."""
+    today = datetime.now(EASTERN_TZ).date()
+    return today - {"day": timedelta(days=30), "week": timedelta(weeks=26), "month": timedelta(days=3 * 365)}[by]
+
+
+def parse_day(value):
+    """A YYYY-MM-DD query argument as a date, None if missing or malformed."""
+    try:
+        return date.fromisoformat(value) if value else None
+    except ValueError:
+        return None
@@ -0,0 +1,213 @@
+"""
+search.py
+
+Full-text search over entries with SQLite FTS5.
+
+The `entry_search` virtual table (main database) holds, per TestEntry (rowid = entry id):
+- fail_reason
+- answers: the values of all text-type form fields
+- contributors: usernames
+
+Keeping it in step:
+- an `after_flush` hook re-indexes every TestEntry whose data, fail reason or contributors
+  were written, in the same transaction (ORM writes); bulk restore calls `index_entries`
+- an AFTER DELETE trigger on test_entry removes the row for every kind of delete (ORM,
+  bulk, archive, dummy clearing)
+- `flask rebuild-search-index` indexes all existing entries, e.g. after the table was
+  first created or a field was made a text field in the form editor
+
+`/search?q=...&page=N` ranks matches with bm25 (fail reasons weigh most), highlights the
+matched terms in a snippet and pages through the results; `format=json` returns the same
+as JSON. Words are matched as typed (porter stemming, so "diagrams" finds "diagram"),
+"quoted phrases" as phrases, and a trailing * as a prefix. All terms must match.
+
+FTS5 is SQLite only; with the main database on PostgreSQL the table is not created and
+the search page says so.
+
+Usage:
+    flask --app app rebuild-search-index
+"""
+
+import re
+
+import click
+from flask.cli import with_appcontext
+from markupsafe import Markup, escape
+from sqlalchemy import event, inspect, text
+
+from models import db, TestEntry
+from form_config import FORMS_NON_DICT
+from db_engine import RoutingSession
+
+SEARCH_TABLE = "entry_search"
+PAGE_SIZE = 20
+WEIGHTS = (0.0, 5.0, 1.0, 0.5)      # bm25 weight per column: cm_serial (unindexed), fail_reason, answers, contributors
+MARK_START, MARK_END = "\x02", "\x03"   # snippet markers, replaced by <mark> after escaping
+
+SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5(
+        cm_serial UNINDEXED, fail_reason, answers, contributors, tokenize = 'porter unicode61')""",
+    f"""CREATE TRIGGER IF NOT EXISTS {SEARCH_TABLE}_delete AFTER DELETE ON test_entry BEGIN
+        DELETE FROM {SEARCH_TABLE} WHERE rowid = old.id;
+    END""",
+]
+
+TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def available(engine):
+    """True if full-text search works on `engine` (the main database is SQLite)."""
+    return engine.dialect.name == "sqlite"
+
+
+def create_search_index(engine=None):
+    """Create the FTS table and its delete trigger if missing (at startup), in the main
+    database or `engine`."""
+    engine = engine or db.engines[TestEntry.__bind_key__]
+    if not available(engine):
+        return
+    with engine.begin() as conn:
+        for statement in SCHEMA:
+            conn.execute(text(statement))
+
+
+## indexing
+
+def _text_fields():
+    return [field.name for page in FORMS_NON_DICT for field in page.fields if field.type_field == "text"]
+
+
+def search_row(entry_id, data, fail_reason, contributors, text_fields):
+    """Column values of the search row of one entry."""
+    data = data or {}
+    return {
+        "rowid": entry_id,
+        "cm_serial": str(data.get("CM_serial") or ""),
+        "fail_reason": fail_reason or "",
+        "answers": "\n".join(str(data[name]) for name in text_fields if data.get(name)),
+        "contributors": " ".join(contributors or []),
+    }
+
+
+def index_entries(conn, entries):
+    """(Re-)index `entries`: (id, data, fail_reason, contributors) tuples. `conn` is a
+    Connection to the main database (`session_connection(session)` inside a Session
+    transaction); runs in its transaction."""
+    entries = list(entries)
+    if not entries:
+        return
+    text_fields = _text_fields()
+    ids = [entry[0] for entry in entries]
+    conn.execute(text(f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({','.join(str(int(i)) for i in ids)})"))
+    conn.execute(
+        text(f"INSERT INTO {SEARCH_TABLE} (rowid, cm_serial, fail_reason, answers, contributors) "
+             "VALUES (:rowid, :cm_serial, :fail_reason, :answers, :contributors)"),
+        [search_row(*entry, text_fields) for entry in entries],
+    )
+
+
+def session_connection(session):
+    """The main-database Connection of `session`'s transaction (plain text statements would
+    otherwise go to the default engine)."""
+    return session.connection(bind_arguments={"mapper": TestEntry})
+
+
+def _changed(entry):
+    attrs = inspect(entry).attrs
+    return any(attrs[name].history.has_changes() for name in ("data", "fail_reason", "contributors"))
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _sync_search_index(session, _flush_context):
+    written = [
+        (entry.id, entry.data, entry.fail_reason, entry.contributors)
+        for entry in list(session.new) + list(session.dirty)
+        if isinstance(entry, TestEntry) and entry.id is not None and _changed(entry)
+    ]
+    if written and available(session.get_bind(mapper=TestEntry)):
+        index_entries(session_connection(session), written)
+
+
+def rebuild(*, batch_size=1000, progress=None):
+    """Drop and re-index all entries, one transaction per batch; returns the number indexed."""
+    engine = db.engines[TestEntry.__bind_key__]
+    create_search_index()
+    table = TestEntry.__table__
+    with engine.begin() as conn:
+        conn.execute(text(f"DELETE FROM {SEARCH_TABLE}"))
+
+    done, last_id = 0, 0
+    while True:
+        with engine.begin() as conn:
+            entries = conn.execute(
+                table.select().with_only_columns(table.c.id, table.c.data, table.c.fail_reason, table.c.contributors)
+                .where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+            ).all()
+            if not entries:
+                break
+            index_entries(conn, [tuple(entry) for entry in entries])
+        done += len(entries)
+        last_id = entries[-1][0]
+        if progress:
+            progress(done)
+    return done
+
+
+## searching
+
+def match_expression(query):
+    """FTS5 MATCH expression for a user query: every word or "phrase" quoted (so user input is
+    never parsed as FTS syntax), a trailing * kept as prefix search. None if there is nothing to search."""
+    terms = []
+    for phrase, word in TERM.findall(query or ""):
+        term = phrase if phrase else word
+        prefix = not phrase and term.endswith("*")
+        term = term.rstrip("*").replace('"', '""').strip()
+        if term:
+            terms.append(f'"{term}"' + ("*" if prefix else ""))
+    return " ".join(terms) or None
+
+
+def highlight(snippet):
+    """Escaped snippet with the matched terms wrapped in <mark>."""
+    return Markup(str(escape(snippet)).replace(MARK_START, "<mark>").replace(MARK_END, "</mark>"))
+
+
+def search_entries(query, page=1, page_size=PAGE_SIZE):
+    """(total matches, hits on `page`) for a user query; hits are dicts with the entry,
+    its rank and a highlighted snippet, best match first."""
+    expression = match_expression(query)
+    if expression is None:
+        return 0, []
+    bind = {"mapper": TestEntry}      # main database, or its read-only twin in read-only routes
+    total = db.session.execute(
+        text(f"SELECT count(*) FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :q"),
+        {"q": expression}, bind_arguments=bind,
+    ).scalar()
+    rows = db.session.execute(
+        text(f"""SELECT rowid, snippet({SEARCH_TABLE}, -1, :start, :end, '…', 16) AS snippet,
+                        bm25({SEARCH_TABLE}, {', '.join(str(w) for w in WEIGHTS)}) AS rank
+                 FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :q
+                 ORDER BY rank LIMIT :limit OFFSET :offset"""),
+        {"q": expression, "start": MARK_START, "end": MARK_END,
+         "limit": page_size, "offset": (max(page, 1) - 1) * page_size},
+        bind_arguments=bind,
+    ).all()
+
+    entries = {e.id: e for e in TestEntry.query.filter(TestEntry.id.in_([row.rowid for row in rows]))}
+    hits = [
+        {"entry": entries[row.rowid], "rank": row.rank, "snippet": highlight(row.snippet)}
+        for row in rows if row.rowid in entries
+    ]
+    return total, hits
+
+
+@click.command("rebuild-search-index")
+@click.option("--batch-size", default=1000, show_default=True, help="Entries per transaction.")
+@with_appcontext
+def rebuild_search_index_command(batch_size):
+    """Re-index all entries for full-text search."""
+    if not available(db.engines[TestEntry.__bind_key__]):
+        raise click.ClickException("Full-text search needs a SQLite main database.")
+    indexed = rebuild(batch_size=batch_size, progress=lambda n: click.echo(f"  {n} entries", err=True))
+    click.echo(f"Indexed {indexed} entries.")
@@ -0,0 +1,152 @@
+"""
+security_events.py
+
+Cross-process tracker for security events: failed logins and denied admin checks.
+
+Replaces the per-process `fishy_users` dicts. Counts live in the `security_event` table of
+users.db, so every gunicorn worker sees the same numbers and they survive restarts.
+
+Storage:
+- Events are counted per (kind, subject) in fixed windows of `WINDOW_SECONDS`.
+- Each subject has a ring of `RING_SLOTS` rows; a slot is overwritten once its window is
+  older than the ring, so one subject never owns more than `RING_SLOTS` rows. Rows of
+  subjects that went quiet are pruned after `RETENTION_SECONDS`.
+- Increments are buffered in memory and written as one batched upsert when the buffer
+  reaches `FLUSH_BATCH` events or is `FLUSH_INTERVAL` seconds old, so a burst of failures
+  costs one write, not one per event.
+
+Used by:
+- `utils.authenticate_admin()` -> `record_event(ADMIN_DENIED, username)`
+- `app.login` -> `login_throttled()` before any password hashing, `record_login_failure()` after
+- `admin.list_fishy_users` -> `event_counts(ADMIN_DENIED)`
+"""
+
+import time
+import threading
+from sqlalchemy import case, func, select, delete
+
+from models import db, SecurityEvent
+from db_engine import upsert_insert
+from constants import LOGIN_THROTTLE_WINDOW, LOGIN_MAX_FAILURES_PER_USER, LOGIN_MAX_FAILURES_PER_IP
+
+ADMIN_DENIED = "admin_denied"
+LOGIN_FAILED = "login_failed"
+
+WINDOW_SECONDS = 60
+RING_SLOTS = 24 * 60                # one day of one-minute windows per subject
+RETENTION_SECONDS = WINDOW_SECONDS * RING_SLOTS
+FLUSH_BATCH = 20
+FLUSH_INTERVAL = 2.0                # seconds
+PRUNE_INTERVAL = 10 * 60            # seconds between deletes of expired rows
+
+_pending = {}                       # (kind, subject, window_start) -> count
+_state = {"pending_since": None, "last_prune": 0.0}
+_lock = threading.Lock()
+
+
+def _window_start(now):
+    return int(now) // WINDOW_SECONDS * WINDOW_SECONDS
+
+
+def _upsert(rows):
+    """INSERT ... ON CONFLICT that adds to a slot in the same window and resets a reused slot."""
+    engine = db.engines[SecurityEvent.__bind_key__]
+    table = SecurityEvent.__table__
+
+    stmt = upsert_insert(engine)(table)
+    newer = table.c.window_start < stmt.excluded.window_start
+    same = table.c.window_start == stmt.excluded.window_start
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["kind", "subject", "slot"],
+        set_={
+            "count": case(
+                (same, table.c.count + stmt.excluded.count),
+                (newer, stmt.excluded.count),
+                else_=table.c.count,
+            ),
+            "window_start": case((newer, stmt.excluded.window_start), else_=table.c.window_start),
+        },
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt, rows)
+
+
+def flush(force=False):
+    """Write buffered events if the batch is full or old enough (or always with `force`).
+    Also called from a teardown_request hook so a lone event doesn't sit in the buffer."""
+    now = time.time()
+    with _lock:
+        if not _pending:
+            return
+        age = now - _state["pending_since"]
+        if not (force or sum(_pending.values()) >= FLUSH_BATCH or age >= FLUSH_INTERVAL):
+            return
+        rows = [
+            {"kind": kind, "subject": subject[:120], "window_start": start,
+             "slot": start // WINDOW_SECONDS % RING_SLOTS, "count": count}
+            for (kind, subject, start), count in _pending.items()
+        ]
+        _pending.clear()
+        _state["pending_since"] = None
+        prune = now - _state["last_prune"] > PRUNE_INTERVAL
+        if prune:
+            _state["last_prune"] = now
+
+    _upsert(rows)
+    if prune:
+        with db.engines[SecurityEvent.__bind_key__].begin() as conn:
+            conn.execute(delete(SecurityEvent).where(SecurityEvent.window_start < now - RETENTION_SECONDS))
+
+
+def record_event(kind, subject):
+    """Count one `kind` event for `subject` in the current window."""
+    now = time.time()
+    key = (kind, subject, _window_start(now))
+    with _lock:
+        _pending[key] = _pending.get(key, 0) + 1
+        if _state["pending_since"] is None:
+            _state["pending_since"] = now
+    flush()
+
+
+def event_counts(kind, subjects=None, since_seconds=RETENTION_SECONDS):
+    """Return {subject: count} for `kind` over the last `since_seconds`, including unflushed events."""
+    cutoff = time.time() - since_seconds
+    query = (
+        select(SecurityEvent.subject, func.sum(SecurityEvent.count))
+        .where(SecurityEvent.kind == kind, SecurityEvent.window_start >= _window_start(cutoff))
+        .group_by(SecurityEvent.subject)
+    )
+    if subjects is not None:
+        query = query.where(SecurityEvent.subject.in_(subjects))
+
+    with db.engines[SecurityEvent.__bind_key__].connect() as conn:
+        counts = dict(conn.execute(query).all())
+
+    with _lock:
+        for (pending_kind, subject, start), count in _pending.items():
+            if pending_kind == kind and start >= _window_start(cutoff) and (subjects is None or subject in subjects):
+                counts[subject] = counts.get(subject, 0) + count
+    return counts
+
+
+def _login_subjects(username, remote_addr):
+    return f"user:{username}", f"ip:{remote_addr}"
+
+
+def record_login_failure(username, remote_addr):
+    """Count a failed login and write it out at once, since other workers throttle on it."""
+    user_subject, ip_subject = _login_subjects(username, remote_addr)
+    record_event(LOGIN_FAILED, user_subject)
+    record_event(LOGIN_FAILED, ip_subject)
+    flush(force=True)
+
+
+def login_throttled(username, remote_addr):
+    """True if this username or address has failed too often to be allowed another attempt."""
+    user_subject, ip_subject = _login_subjects(username, remote_addr)
+    counts = event_counts(
+        LOGIN_FAILED, [user_subject, ip_subject], since_seconds=LOGIN_THROTTLE_WINDOW.total_seconds()
+    )
+    return (counts.get(user_subject, 0) >= LOGIN_MAX_FAILURES_PER_USER
+            or counts.get(ip_subject, 0) >= LOGIN_MAX_FAILURES_PER_IP)
@@ -0,0 +1,115 @@
+"""
+step_timing.py
+
+Time spent on each form page, to find the slow steps of the physical test process.
+
+Recording (`/form`):
+- rendering a page (GET) notes the step and the time in the browser session (`mark_entered`)
+- submitting it (next, save & exit, fail) adds a StepTiming row with both times to the
+  entry's own transaction (`record_step`); a page submitted after a failed validation keeps
+  its original entry time, a reload restarts it
+
+Rows are append-only and keyed by entry id without a foreign key, so timings stay when
+entries are archived or deleted.
+
+`step_stats(days)` summarises the last `days` days per page with NumPy: median and p90 of
+the time to complete the page ("next"), how often it was saved or failed on, and where
+saved forms stall (how many wait on each page, for how long since they were saved).
+Gaps longer than MAX_STEP_SECONDS (page left open overnight) are counted but not timed.
+"""
+
+import time
+from datetime import datetime
+
+import numpy as np
+from flask import session
+from sqlalchemy import select
+
+from models import db, TestEntry, StepTiming, json_key
+from form_config import FORMS_NON_DICT
+from constants import EASTERN_TZ
+
+ACTIONS = ("next", "save", "fail")
+SESSION_KEY = "step_entered"
+MAX_STEP_SECONDS = 12 * 3600
+STATS_DAYS = 90
+
+
+## recording
+
+def mark_entered(step):
+    """Note that form page `step` was just shown to this browser session."""
+    session[SESSION_KEY] = [step, int(time.time())]
+
+
+def record_step(entry, step, action, username):
+    """Add the StepTiming row for submitting page `step` of `entry` to the db session, to be
+    committed with the entry. Nothing is recorded if this session never rendered the page."""
+    entered = session.pop(SESSION_KEY, None)
+    if not entered or entered[0] != step:
+        return
+    if entry.id is None:
+        db.session.add(entry)
+        db.session.flush()
+    db.session.add(StepTiming(entry_id=entry.id, step=step, username=username, action=action,
+                              entered_at=entered[1], submitted_at=int(time.time())))
+
+
+## statistics
+
+def _hours(seconds):
+    return round(float(seconds) / 3600, 1)
+
+
+def _stalls():
+    """(last_step, seconds since saved) of every saved form."""
+    now = datetime.now(EASTERN_TZ).replace(tzinfo=None)
+    rows = db.session.execute(
+        select(json_key(TestEntry.data, "last_step", as_integer=True), TestEntry.timestamp)
+        .where(TestEntry.is_saved.is_(True))
+    ).all()
+    steps = np.array([step or 0 for step, _ in rows], dtype=np.int64)
+    ages = np.array([(now - stamp.replace(tzinfo=None)).total_seconds() if stamp else 0.0 for _, stamp in rows])
+    return steps, ages
+
+
+def step_stats(days=STATS_DAYS):
+    """Per form page: completions with median / p90 seconds, saves, fails, and saved forms
+    waiting on it with their median / longest wait in hours."""
+    since = int(time.time()) - days * 86400
+    rows = db.session.execute(
+        select(StepTiming.step, StepTiming.action, StepTiming.submitted_at - StepTiming.entered_at)
+        .where(StepTiming.submitted_at >= since)
+    ).all()
+    steps = np.array([r[0] for r in rows], dtype=np.int64)
+    actions = np.array([ACTIONS.index(r[1]) if r[1] in ACTIONS else -1 for r in rows], dtype=np.int64)
+    seconds = np.array([r[2] for r in rows], dtype=float)
+    stalled_steps, stalled_ages = _stalls()
+
+    pages = []
+    for index, page in enumerate(FORMS_NON_DICT):
+        on_page = steps == index
+        completed = on_page & (actions == ACTIONS.index("next"))
+        timed = seconds[completed & (seconds <= MAX_STEP_SECONDS)]
+        waiting = stalled_ages[stalled_steps == index]
+        median, p90 = np.percentile(timed, (50, 90)) if timed.size else (None, None)
+        pages.append({
+            "page": index, "label": page.label,
+            "completed": int(completed.sum()), "timed": int(timed.size),
+            "median_seconds": None if median is None else round(float(median)),
+            "p90_seconds": None if p90 is None else round(float(p90)),
+            "saves": int((on_page & (actions == ACTIONS.index("save"))).sum()),
+            "fails": int((on_page & (actions == ACTIONS.index("fail"))).sum()),
+            "saved_waiting": int(waiting.size),
+            "waiting_median_hours": _hours(np.median(waiting)) if waiting.size else None,
+            "waiting_max_hours": _hours(waiting.max()) if waiting.size else None,
+        })
+
+    by_median = [p for p in pages if p["median_seconds"] is not None]
+    return {
+        "days": days,
+        "submissions": len(rows),
+        "pages": pages,
+        "slowest": max(by_median, key=lambda p: p["median_seconds"])["page"] if by_median else None,
+        "most_stalled": max(pages, key=lambda p: p["saved_waiting"])["page"] if stalled_steps.size else None,
+    }
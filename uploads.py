@@ -0,0 +1,246 @@
+"""
+uploads.py
+
+Upload manifest and orphan-file garbage collection.
+
+Every file saved by `utils.process_file_fields` gets an `Upload` row (path, size, field) at
+once, in its own transaction. When a TestEntry whose data references the file is flushed,
+the row is linked to that entry (`entry_id`). Retests copy their parent's data, so a file
+is still referenced while the entry it was uploaded for, one of that entry's retests, or a
+DeletedEntry / archive.py copy of them mentions the path.
+
+Files nobody references any more (uploads replaced on the same page, drafts that were never
+saved, files of deleted entries) are removed by:
+- `delete_entry_uploads(entry_ids)`: right after entries are deleted (admin clear routes),
+  the files uploaded for exactly those entries, unless something else still references them.
+- `flask uploads gc`: incremental sweep over the manifest in id order. Only uploads older than
+  UPLOAD_GC_GRACE are considered, at most `--batch-size` per transaction and `--max-batches`
+  per run; the position is saved in MaintenanceState, so the next run continues where this
+  one stopped and starts over after reaching the end.
+- `flask uploads backfill`: registers files that are on disk but not in the manifest
+  (uploaded before the manifest existed) and links them to the entries that reference them.
+
+Usage:
+    flask --app app uploads backfill
+    flask --app app uploads gc --dry-run
+    flask --app app uploads gc --grace-days 14 --batch-size 200 --max-batches 10
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import event, insert, update
+
+from models import db, TestEntry, DeletedEntry, ArchivedEntry, Upload, load_state, save_state
+from archive import unpack, TEST_ENTRY, DELETED_ENTRY
+from db_engine import RoutingSession
+from constants import UPLOAD_GC_GRACE
+
+GC_STATE = "upload_gc"
+IN_CHUNK = 500                  # ids / paths per IN (...) list
+
+
+def _chunks(values, size=IN_CHUNK):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def _string_values(data):
+    return {v for v in (data or {}).values() if isinstance(v, str) and v}
+
+
+def upload_path(upload_folder, path):
+    """Absolute location of a manifest path, or None if it would leave the upload folder."""
+    root = os.path.abspath(upload_folder)
+    full = os.path.abspath(os.path.join(root, path))
+    return full if full.startswith(root + os.sep) else None
+
+
+def record_upload(path, size, field_name):
+    """Add the manifest row for a file that was just written below UPLOAD_FOLDER."""
+    engine = db.engines[Upload.__bind_key__]
+    with engine.begin() as conn:
+        conn.execute(insert(Upload), {"path": path, "size": size, "field_name": field_name,
+                                      "uploaded_at": datetime.utcnow()})
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _link_uploads(session, _flush_context):
+    """Link not yet linked uploads to the first saved entry that references them."""
+    for entry in list(session.new) + list(session.dirty):
+        if not isinstance(entry, TestEntry) or entry.id is None:
+            continue
+        paths = [v for v in _string_values(entry.data) if "/" in v or os.sep in v]
+        if paths:
+            session.execute(
+                update(Upload)
+                .where(Upload.path.in_(paths), Upload.entry_id.is_(None))
+                .values(entry_id=entry.id)
+                .execution_options(synchronize_session=False)
+            )
+
+
+def referenced_paths(uploads):
+    """Paths of `uploads` that the linked entry, its retests or their deleted/archived copies still mention."""
+    frontier = {u.entry_id for u in uploads if u.entry_id is not None}
+    seen, mentioned = set(), set()
+
+    while frontier:
+        seen |= frontier
+        found = set()
+        for ids in _chunks(frontier):
+            rows = db.session.query(TestEntry.id, TestEntry.data).filter(
+                db.or_(TestEntry.id.in_(ids), TestEntry.parent_id.in_(ids))
+            )
+            for entry_id, data in rows:
+                mentioned |= _string_values(data)
+                found.add(entry_id)
+            for archived in ArchivedEntry.query.filter(
+                ArchivedEntry.kind == TEST_ENTRY,
+                db.or_(ArchivedEntry.entry_id.in_(ids), ArchivedEntry.parent_id.in_(ids)),
+            ):
+                mentioned |= _string_values(unpack(archived)["data"])
+                found.add(archived.entry_id)
+        frontier = found - seen
+
+    for ids in _chunks(seen):
+        for (data,) in db.session.query(DeletedEntry.data).filter(DeletedEntry.original_entry_id.in_(ids)):
+            mentioned |= _string_values(data)
+        for archived in ArchivedEntry.query.filter(ArchivedEntry.kind == DELETED_ENTRY, ArchivedEntry.entry_id.in_(ids)):
+            mentioned |= _string_values(unpack(archived)["data"])
+
+    return {u.path for u in uploads if u.path in mentioned}
+
+
+def _remove(uploads, upload_folder, dry_run=False):
+    """Delete the files and manifest rows of `uploads`; returns (files, bytes) removed."""
+    files = size = 0
+    for upload in uploads:
+        full = upload_path(upload_folder, upload.path)
+        if full and os.path.isfile(full):
+            files += 1
+            size += upload.size
+            if not dry_run:
+                os.remove(full)
+                try:
+                    os.rmdir(os.path.dirname(full))     # drop the CM<serial> folder once it is empty
+                except OSError:
+                    pass
+        if not dry_run:
+            db.session.delete(upload)
+    return files, size
+
+
+def delete_entry_uploads(entry_ids, upload_folder):
+    """Remove the files uploaded for the (already deleted) entries `entry_ids`, unless still
+    referenced elsewhere. Commits; returns the number of files removed."""
+    removed = 0
+    for ids in _chunks(entry_ids):
+        uploads = Upload.query.filter(Upload.entry_id.in_(ids)).all()
+        keep = referenced_paths(uploads)
+        removed += _remove([u for u in uploads if u.path not in keep], upload_folder)[0]
+        db.session.commit()
+    return removed
+
+
+def collect_garbage(upload_folder, *, grace=UPLOAD_GC_GRACE, batch_size=500, max_batches=None, dry_run=False):
+    """Run the incremental sweep; returns (uploads checked, files removed, bytes removed)."""
+    cutoff = datetime.utcnow() - grace
+    cursor = load_state(GC_STATE, {"after_id": 0})["after_id"]
+    checked = files = size = batches = 0
+
+    while max_batches is None or batches < max_batches:
+        uploads = (
+            Upload.query
+            .filter(Upload.id > cursor, Upload.uploaded_at < cutoff)
+            .order_by(Upload.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not uploads:
+            cursor = 0      # reached the end; the next run starts over
+            break
+
+        keep = referenced_paths(uploads)
+        removed = _remove([u for u in uploads if u.path not in keep], upload_folder, dry_run)
+        checked += len(uploads)
+        files += removed[0]
+        size += removed[1]
+        cursor = uploads[-1].id
+        batches += 1
+
+        if not dry_run:
+            save_state(GC_STATE, {"after_id": cursor})
+            db.session.commit()
+
+    if not dry_run:
+        save_state(GC_STATE, {"after_id": cursor})
+        db.session.commit()
+    return checked, files, size
+
+
+def backfill_manifest(upload_folder):
+    """Register files on disk that are missing from the manifest and link them to entries.
+    Returns (files registered, uploads linked)."""
+    known = {path for (path,) in db.session.query(Upload.path)}
+    root = os.path.abspath(upload_folder)
+    registered = 0
+    for directory, _dirs, names in os.walk(root):
+        for name in names:
+            full = os.path.join(directory, name)
+            path = os.path.relpath(full, root)
+            if path not in known:
+                stat = os.stat(full)
+                db.session.add(Upload(path=path, size=stat.st_size,
+                                      uploaded_at=datetime.utcfromtimestamp(stat.st_mtime)))
+                registered += 1
+    db.session.commit()
+
+    unlinked = {path for (path,) in db.session.query(Upload.path).filter(Upload.entry_id.is_(None))}
+    linked = 0
+    last_id = 0
+    while unlinked:
+        rows = (db.session.query(TestEntry.id, TestEntry.data)
+                .filter(TestEntry.id > last_id).order_by(TestEntry.id).limit(IN_CHUNK).all())
+        if not rows:
+            break
+        for entry_id, data in rows:
+            paths = _string_values(data) & unlinked
+            if paths:
+                Upload.query.filter(Upload.path.in_(paths)).update(
+                    {"entry_id": entry_id}, synchronize_session=False)
+                unlinked -= paths
+                linked += len(paths)
+        last_id = rows[-1][0]
+        db.session.commit()
+    return registered, linked
+
+
+uploads_cli = AppGroup("uploads", help="Upload manifest maintenance.")
+
+
+@uploads_cli.command("gc")
+@click.option("--grace-days", default=UPLOAD_GC_GRACE.days, show_default=True,
+              help="Only delete unreferenced uploads older than this.")
+@click.option("--batch-size", default=500, show_default=True, help="Uploads checked per transaction.")
+@click.option("--max-batches", default=None, type=int, help="Stop after this many batches (resume next run).")
+@click.option("--dry-run", is_flag=True, help="Report what would be deleted without deleting it.")
+def gc_command(grace_days, batch_size, max_batches, dry_run):
+    """Delete uploaded files that no entry references any more."""
+    checked, files, size = collect_garbage(
+        current_app.config["UPLOAD_FOLDER"], grace=timedelta(days=grace_days),
+        batch_size=batch_size, max_batches=max_batches, dry_run=dry_run,
+    )
+    verb = "Would remove" if dry_run else "Removed"
+    click.echo(f"Checked {checked} uploads. {verb} {files} files ({size / 1024 ** 2:.1f} MiB).")
+
+
+@uploads_cli.command("backfill")
+def backfill_command():
+    """Add files already on disk to the upload manifest."""
+    registered, linked = backfill_manifest(current_app.config["UPLOAD_FOLDER"])
+    click.echo(f"Registered {registered} files, linked {linked} uploads to entries.")
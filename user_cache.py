@@ -0,0 +1,122 @@
+"""
+user_cache.py
+
+Per-worker cache of `User` rows so `utils.current_user()` rarely has to query users.db.
+
+How it works:
+- `get_cached_user(uid)` rebuilds a `User` from cached column values and attaches it to
+  `db.session` with `merge(load=False)`, which emits no SQL. Changing and committing it
+  works exactly like a freshly loaded user.
+- Entries expire after `USER_CACHE_TTL` and the cache holds at most `USER_CACHE_SIZE`
+  users (least recently used are dropped first).
+- `form_id` is not cached: the form workflow changes it on nearly every POST. It stays
+  unloaded on a cached user and is read from users.db (one primary-key lookup) when used, so
+  it is never stale in any worker.
+- Any committed insert/delete of a `User`, or update of a cached column (promote/demote in
+  the admin routes, password, ...), rewrites a shared token file. Every worker compares that
+  token before trusting its cache, so a change made by one gunicorn worker is seen by the
+  others on their next request.
+"""
+
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from itertools import chain
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached
+
+from models import db, User
+from db_engine import RoutingSession
+from constants import USER_CACHE_TTL, USER_CACHE_SIZE
+
+TOKEN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "users.cache-token")
+
+_cache = OrderedDict()      # user id -> (cached_at, token, column values)
+_cache_lock = threading.Lock()
+UNCACHED = ("form_id",)     # changes with every form step; loaded on access instead
+_columns = [c.key for c in User.__mapper__.column_attrs if c.key not in UNCACHED]
+
+
+def _read_token():
+    try:
+        with open(TOKEN_PATH, "r", encoding="utf-8") as token_file:
+            return token_file.read()
+    except OSError:
+        return ""
+
+
+def _write_token():
+    """Publish a new random token; random instead of a counter so concurrent bumps never collide."""
+    tmp_path = f"{TOKEN_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as token_file:
+            token_file.write(uuid.uuid4().hex)
+        os.replace(tmp_path, TOKEN_PATH)
+    except OSError:
+        pass  # no shared token: other workers fall back to the TTL
+
+
+def invalidate_user_cache():
+    """Forget every cached user in this worker and tell the other workers to do the same."""
+    with _cache_lock:
+        _cache.clear()
+    _write_token()
+
+
+def get_cached_user(uid):
+    """Return the session-attached `User` for `uid` from the cache, or None on a miss."""
+    token = _read_token()
+    with _cache_lock:
+        cached = _cache.get(uid)
+        if cached is None:
+            return None
+        cached_at, cached_token, values = cached
+        if cached_token != token or time.monotonic() - cached_at > USER_CACHE_TTL.total_seconds():
+            del _cache[uid]
+            return None
+        _cache.move_to_end(uid)
+
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def cache_user(user):
+    """Remember the column values of a freshly loaded `user`."""
+    values = {key: getattr(user, key) for key in _columns}
+    token = _read_token()
+    with _cache_lock:
+        _cache[user.id] = (time.monotonic(), token, values)
+        _cache.move_to_end(user.id)
+        while len(_cache) > USER_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def _changes_cache(session, obj):
+    """True if flushing `obj` makes cached users stale: a new or deleted User, or a modified
+    cached column (a change of `form_id` alone does not count)."""
+    if not isinstance(obj, User):
+        return False
+    if obj in session.new or obj in session.deleted:
+        return True
+    attrs = inspect(obj).attrs
+    return any(attrs[key].history.has_changes() for key in _columns)
+
+
+@event.listens_for(RoutingSession, "after_flush")
+def _note_user_changes(session, _flush_context):
+    if any(_changes_cache(session, obj) for obj in chain(session.new, session.dirty, session.deleted)):
+        session.info["users_changed"] = True
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _publish_user_changes(session):
+    if session.info.pop("users_changed", False):
+        invalidate_user_cache()
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _discard_user_changes(session):
+    session.info.pop("users_changed", None)
@@ -3,14 +3,15 @@ Utility functions for the Apollo CM Test Entry app.
 
 Provides core helpers for:
 - Validating individual fields and entire forms (`validate_field`, `validate_form`)
-- Tracking incomplete form steps (`determine_step_from_data`)
+- Tracking incomplete form steps (`determine_step_from_data`) and describing an entry's status (`entry_status`)
+- CSV export columns and rows (`export_header`, `export_row`) and random dummy answers (`dummy_test_data`)
 - Managing locks on entries (`acquire_lock`, `release_lock`)
-- Handling file uploads with unique names (`process_file_fields`)
-- Retrieving the current user (`current_user`)
-- Verifying admin access and logging suspicious attempts (`authenticate_admin`)
-
-Also defines:
-- `fishy_users`: Tracks users who attempt unauthorized admin access.
+- Optimistic concurrency on TestEntry rows (`remember_entry_version`, `entry_changed_elsewhere`,
+  `commit_entry_changes`)
+- Handling file uploads with unique names (`process_file_fields`), recorded in the upload manifest
+- Retrieving the current user (`current_user`), memoized per request and cached per worker
+- Verifying admin access and logging suspicious attempts (`authenticate_admin`) to the
+  shared tracker in `security_events`
 
 Dependencies: Flask `session`, SQLAlchemy `User` and `TestEntry` models, `FORMS_NON_DICT`, `LOCK_TIMEOUT`.
 """
@@ -19,15 +20,18 @@ Dependencies: Flask `session`, SQLAlchemy `User` and `TestEntry` models, `FORMS_
 import os
 import re
 from datetime import datetime
-from flask import session
+from random import randint, uniform, choice
+from flask import session, request, g
+from sqlalchemy.orm.exc import StaleDataError
 from werkzeug.utils import secure_filename
 
 from models import db, User, TestEntry
 from form_config import FORMS_NON_DICT
-from constants import LOCK_TIMEOUT, EASTERN_TZ
-
+from constants import LOCK_TIMEOUT, EASTERN_TZ, SERIAL_MIN, SERIAL_MAX
+from user_cache import get_cached_user, cache_user
+from security_events import record_event, ADMIN_DENIED
+from uploads import record_upload
 
-fishy_users = {}
 
 def validate_field(field, value, data=None):
     """Validate a single field value based on its type and requirements."""
@@ -86,34 +90,120 @@ def determine_step_from_data(data):
     return len(FORMS_NON_DICT)
 
 def acquire_lock(entry_id, username):
-    """Try to claim the lock; returns (success_flag, entry)."""
+    """Try to claim the lock; returns (success_flag, entry).
+    On PostgreSQL the row is first claimed with SELECT ... FOR UPDATE SKIP LOCKED, so a
+    technician racing another claim fails fast instead of queueing behind it; SQLite
+    ignores the row lock and relies on the conditional UPDATE alone.
+    On PostgreSQL the claim runs in a savepoint: a failed claim rolls back only that savepoint,
+    which drops the row lock and keeps the caller's pending changes (SQLite takes no row lock,
+    and a savepoint would open its write transaction early, so a racing claim would fail with
+    "database is locked"). A successful claim commits the session, the caller's changes included."""
     now = datetime.now(EASTERN_TZ)
 
     # ---- new WHERE clause (no imports needed) -----------------
-    q = (
-        TestEntry.query
-        .filter(
-            TestEntry.id == entry_id,                     # implicit AND
-            (                                             # explicit OR via |
-                TestEntry.lock_owner.is_(None) |          #   • lock is free
-                (TestEntry.lock_acquired_at + LOCK_TIMEOUT == now)  # • or expired turned off rn,  fix this or implement it
-            )
-        )
+    lock_is_free = (
+        TestEntry.lock_owner.is_(None) |          #   • lock is free
+        (TestEntry.lock_acquired_at + LOCK_TIMEOUT == now)  # • or expired turned off rn,  fix this or implement it
     )
     # -----------------------------------------------------------
 
-    updated = q.update(
-        {"lock_owner": username, "lock_acquired_at": now},
+    row_locks = db.session.get_bind(TestEntry).dialect.name != "sqlite"
+    claim = db.session.begin_nested() if row_locks else None
+    claimable = (
+        db.session.query(TestEntry.id)
+        .filter(TestEntry.id == entry_id, lock_is_free)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if claimable is None:
+        if claim is not None:
+            claim.rollback()
+        return False, db.session.get(TestEntry, entry_id)
+
+    updated = TestEntry.query.filter(TestEntry.id == entry_id, lock_is_free).update(
+        {"lock_owner": username, "lock_acquired_at": now, "version": TestEntry.version + 1},
         synchronize_session=False,
     )
     db.session.commit()
     return updated == 1, db.session.get(TestEntry, entry_id)
 
 def release_lock(entry):
-    """Free the lock on a TestEntry row that you already own."""
+    """Free the lock on a TestEntry row that you already own.
+    Returns False if the row was changed by someone else in the meantime."""
     entry.lock_owner = None
     entry.lock_acquired_at = None
-    db.session.commit()
+    return commit_entry_changes()
+
+def remember_entry_version(entry):
+    """Record which version of `entry` this browser session last read or wrote."""
+    session['entry_version'] = [entry.id, entry.version]
+
+def entry_changed_elsewhere(entry):
+    """True if `entry` was written (another tab, user or admin) since this session last saw it.
+    Tabs share the session cookie, so the version rendered into the posted page wins when present."""
+    seen = session.get('entry_version')
+    if not seen or seen[0] != entry.id:
+        return False
+    posted = request.form.get('entry_version', '')
+    expected = int(posted) if posted.isdigit() else seen[1]
+    return expected != entry.version
+
+def commit_entry_changes():
+    """Commit the session; on a version conflict roll back and return False instead of raising."""
+    try:
+        db.session.commit()
+    except StaleDataError:
+        db.session.rollback()
+        return False
+    return True
+
+def entry_status(entry):
+    """Human-readable status of one attempt (timelines, travelers)."""
+    if entry.failure:
+        if entry.fail_stored:
+            return "failed, pending retest"
+        return "failed, cleared" if entry.is_finished else "failed, retested"
+    if entry.is_finished:
+        return "finished"
+    return "saved" if entry.is_saved else "in progress"
+
+def export_fields():
+    """All form fields, in form order, as exported to CSV."""
+    return [field for single_form in FORMS_NON_DICT for field in single_form.fields]
+
+def export_header(fields):
+    """CSV header row for `fields`."""
+    return ['Time', 'Users'] + [f.label for f in fields] + ['File', "Test Aborted", "Reason Aborted"]
+
+def export_row(entry, fields):
+    """CSV row of one entry."""
+    row = [entry.timestamp, ", ".join(entry.contributors or [])]
+    row += [entry.data.get(f.name) for f in fields]
+    row += [entry.file_name, "yes" if entry.failure else "no", entry.fail_reason or ""]
+    return row
+
+def dummy_test_data():
+    """Randomized answers for every non-file field of the form (file fields left blank)."""
+    test_data = {}
+    for form_iter in FORMS_NON_DICT:
+        for field in form_iter.fields:
+            name = getattr(field, "name", None)
+            ftype = getattr(field, "type_field", None)
+
+            if not name or ftype is None:
+                continue
+
+            if ftype == "boolean":
+                test_data[name] = choice(["yes", "no"])
+            elif ftype == "integer":
+                test_data[name] = str(randint(SERIAL_MIN, SERIAL_MAX)) if name == "CM_serial" else str(randint(0, 9999))
+            elif ftype == "float":
+                test_data[name] = f"{uniform(0.0, 10.0):.2f}"
+            elif ftype == "text":
+                test_data[name] = "Auto-generated entry"
+            elif ftype == "file":
+                test_data[name] = ""  # Leave blank for file fields
+    return test_data
 
 def process_file_fields(fields, rq, upload_folder, data):
     """Safely saves uploaded files with timestamped names inside a CM-specific subfolder.
@@ -152,6 +242,7 @@ def process_file_fields(fields, rq, upload_folder, data):
                 # Store relative path from upload_folder
                 relative_path = os.path.join(subfolder_safe, full_filename)
                 updated_data[field.name] = relative_path
+                record_upload(relative_path, os.path.getsize(file_path), field.name)
             else:
                 if field.name in data:
                     updated_data[field.name] = data[field.name]
@@ -159,21 +250,34 @@ def process_file_fields(fields, rq, upload_folder, data):
     return updated_data
 
 def current_user():
+    """Return the logged in User. Memoized on `g` for the request and backed by the
+    per-worker cache in `user_cache`, so users.db is queried at most once per request."""
     uid = session.get("user_id")
     if uid is None:
         return None
-    user = User.query.get(uid)
+
+    memo = g.get("current_user_memo")
+    if memo is not None and memo[0] == uid:
+        return memo[1]
+
+    user = get_cached_user(uid)
     if user is None:
-        # Session is stale – user was deleted or DB reset
-        session.pop("user_id", None)
+        user = db.session.get(User, uid)
+        if user is None:
+            # Session is stale – user was deleted or DB reset
+            session.pop("user_id", None)
+            return None
+        cache_user(user)
+
+    g.current_user_memo = (uid, user)
     return user
 
 def authenticate_admin():
     """Returns True if current user is admin, False otherwise.
-    Logs non-admin or unauthenticated users to fishy_users."""
+    Records non-admin or unauthenticated users as ADMIN_DENIED security events."""
     user = current_user()
     if not user or not user.administrator:
         username = user.get_username() if user else "unknown"
-        fishy_users[username] = fishy_users.get(username, 0) + 1
+        record_event(ADMIN_DENIED, username)
         return False
     return True